@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+"""Control groups (cgroup v2), for monitors on whole services or
+containers. The kernel already accounts memory, CPU and processes per
+cgroup, hierarchically, so a cgroup is one read where summing over its
+processes would be thousands.
+"""
+
+import os
+
+import fallfromgrace.process as process
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+# Fields of memory.stat made available, in bytes.
+MEMORY_STAT = ('anon', 'file')
+
+
+def available(root=None):
+    """Returns True if root, by default CGROUP_ROOT, is a cgroup v2
+    (unified) hierarchy."""
+
+    root = root or CGROUP_ROOT
+    return os.path.exists(os.path.join(root, 'cgroup.controllers'))
+
+
+def get_paths(root=None):
+    """Returns the paths of all cgroups below root, relative to it,
+    such as "system.slice/nginx.service". The root cgroup itself has no
+    accounting files and is not included.
+    """
+
+    root = root or CGROUP_ROOT
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        if dirpath != root:
+            paths.append(os.path.relpath(dirpath, root))
+    return paths
+
+
+class Cgroup(object):
+    """A cgroup, identified by its path and the inode of its directory,
+    so a cgroup removed and created again is told apart.
+    """
+
+    __slots__ = ('root', 'path', 'id')
+
+    def __init__(self, path, root=None):
+        root = root or CGROUP_ROOT
+        self.root = root
+        self.path = path
+        self.id = os.stat(os.path.join(root, path)).st_ino
+
+    def __repr__(self):
+        return '<Cgroup %s>' % self.path
+
+    def read(self, name):
+        return process.read_file(os.path.join(self.root, self.path, name))
+
+    def procs(self):
+        """Returns the pids of the processes in the cgroup and its
+        descendants.
+        """
+
+        pids = []
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.root, self.path)):
+            try:
+                data = process.read_file(os.path.join(dirpath, 'cgroup.procs'))
+            except (IOError, OSError):
+                # Removed while walking.
+                continue
+            pids.extend(int(line) for line in data.split())
+        return pids
+
+
+def get_memory(cgroup):
+    """Returns a dict with "rmem", the memory charged to the cgroup
+    (memory.current), and the MEMORY_STAT fields of memory.stat.
+    """
+
+    usage = {'rmem': int(cgroup.read('memory.current'))}
+    for line in cgroup.read('memory.stat').splitlines():
+        key, _, value = line.partition(' ')
+        if key in MEMORY_STAT:
+            usage[key] = int(value)
+    return usage
+
+
+def get_cpu_time(cgroup):
+    """Returns the CPU time used by the cgroup, in seconds."""
+
+    for line in cgroup.read('cpu.stat').splitlines():
+        key, _, value = line.partition(' ')
+        if key == 'usage_usec':
+            return int(value) / 1e6
+    raise ValueError('no usage_usec in cpu.stat')
+
+
+def get_pids(cgroup):
+    """Returns the number of processes and threads in the cgroup."""
+
+    return int(cgroup.read('pids.current'))
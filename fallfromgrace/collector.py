@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+"""Reads from /proc for many processes at once, on a pool of worker
+threads.
+
+Reading /proc/<pid>/... is mostly syscall latency, which is spent
+without the GIL, and can block for a long time on a process whose
+mm is locked (e.g. under memory pressure). Spreading the reads over
+a few threads overlaps the latency, and a timeout per read keeps a
+single stuck process from stalling the whole tick.
+"""
+
+import collections
+import logging
+import os
+import select
+import threading
+import time
+
+log = logging.getLogger('fall-from-grace')
+
+
+class _Worker(object):
+    """State of a worker thread, guarded by Collector.lock."""
+
+    def __init__(self):
+        # The shard being read, and when the read of shard[index]
+        # started, or None between reads.
+        self.job = None
+        self.shard = None
+        self.index = 0
+        self.started = None
+        # Set when the worker was given up on while blocked in a read.
+        self.abandoned = False
+
+
+class _Job(object):
+    """A single call to Collector.map."""
+
+    def __init__(self, func):
+        self.func = func
+        self.results = {}
+        self.slow = set()
+        self.pending = 0
+
+
+class Collector(object):
+    """Runs a function over many pids on a small pool of worker
+    threads, see map().
+
+    The pids are split in shards of shard_size, which the workers take
+    from a shared queue. A call of the function running for longer than
+    timeout seconds is given up on: its pid is reported as slow, the
+    rest of its shard is put back on the queue and the worker, still
+    blocked, is replaced. Until the call returns, the pid is skipped by
+    later calls to map(). If max_stuck workers are blocked, no more are
+    started, and what the pool cannot read is reported as slow.
+    """
+
+    WORKERS = 4
+    SHARD_SIZE = 128
+    TIMEOUT = 1.0
+    MAX_STUCK = 16
+
+    def __init__(self, workers=WORKERS, timeout=TIMEOUT, shard_size=SHARD_SIZE,
+                 max_stuck=MAX_STUCK):
+        self.size = workers
+        self.timeout = timeout
+        self.shard_size = shard_size
+        self.max_stuck = max_stuck
+
+        self.lock = threading.Lock()
+        self.work = threading.Condition(self.lock)
+        # [(job, shard)]
+        self.queue = collections.deque()
+        self.workers = []
+        # {pid: _Worker} blocked reading pid.
+        self.stuck = {}
+        self.timeouts = 0
+
+        # Written to by a worker finishing a job, so map() can wait
+        # for that and a timeout at once.
+        self._wakeup = None
+
+    def map(self, func, pids):
+        """Calls func(pid) for each pid on the workers. Returns
+        ({pid: result}, set of slow pids). func should handle its own
+        errors; pids for which it raises are left out of both.
+        """
+
+        job = _Job(func)
+        with self.lock:
+            todo = []
+            for pid in pids:
+                if pid in self.stuck:
+                    job.slow.add(pid)
+                else:
+                    todo.append(pid)
+            if not todo:
+                return job.results, job.slow
+            if self._wakeup is None:
+                self._wakeup = os.pipe()
+            job.pending = len(todo)
+            size = self.shard_size
+            for i in xrange(0, len(todo), size):
+                self.queue.append((job, todo[i:i + size]))
+            self._spawn()
+            self.work.notify_all()
+
+        wakeup = self._wakeup[0]
+        while True:
+            with self.lock:
+                wait = self._check(job, time.time())
+                if not job.pending:
+                    break
+            if select.select([wakeup], [], [], wait)[0]:
+                os.read(wakeup, 4096)
+        return job.results, job.slow
+
+    def _spawn(self):
+        """Start workers up to the pool size, unless too many are
+        stuck. Threads are started lazily, as they do not survive the
+        fork when daemonizing. Called with the lock held.
+        """
+
+        while len(self.workers) < self.size and len(self.stuck) < self.max_stuck:
+            worker = _Worker()
+            thread = threading.Thread(target=self._work, args=(worker,),
+                                      name='collect-%d' % len(self.workers))
+            thread.daemon = True
+            thread.start()
+            self.workers.append(worker)
+
+    def _check(self, job, now):
+        """Give up on reads of job that have run for too long. Returns
+        the time until the next one might. Called with the lock held.
+        """
+
+        wait = self.timeout
+        for worker in list(self.workers):
+            if worker.job is not job or worker.started is None:
+                continue
+            late = now - worker.started
+            if late < self.timeout:
+                wait = min(wait, self.timeout - late)
+                continue
+
+            pid = worker.shard[worker.index]
+            worker.abandoned = True
+            self.workers.remove(worker)
+            self.stuck[pid] = worker
+            self.timeouts += 1
+            job.slow.add(pid)
+            job.pending -= 1
+            rest = worker.shard[worker.index + 1:]
+            if rest:
+                self.queue.appendleft((job, rest))
+            log.warning('reading pid %s timed out after %.1fs (%d stuck)',
+                        pid, late, len(self.stuck))
+            self._spawn()
+            self.work.notify()
+
+        if not self.workers:
+            # Everyone is stuck, give up on the rest.
+            for other, shard in self.queue:
+                other.slow.update(shard)
+                other.pending -= len(shard)
+            self.queue.clear()
+        return wait
+
+    def _work(self, worker):
+        lock = self.lock
+        while True:
+            with lock:
+                while not self.queue:
+                    self.work.wait()
+                job, shard = self.queue.popleft()
+                worker.job = job
+                worker.shard = shard
+                worker.index = 0
+                worker.started = time.time()
+
+            func = job.func
+            results = job.results
+            for i, pid in enumerate(shard):
+                try:
+                    result = func(pid)
+                    failed = False
+                except Exception, e:
+                    log.warning('failed to read pid %s: %s', pid, e)
+                    failed = True
+
+                with lock:
+                    if worker.abandoned:
+                        del self.stuck[pid]
+                        return
+                    if not failed:
+                        results[pid] = result
+                    job.pending -= 1
+                    if not job.pending:
+                        os.write(self._wakeup[1], '.')
+                    if i + 1 < len(shard):
+                        worker.index = i + 1
+                        worker.started = time.time()
+                    else:
+                        worker.job = None
+                        worker.shard = None
+                        worker.started = None
@@ -8,21 +8,63 @@ import errno
 import logging
 import os
 import re
+import stat
 
 
 log = logging.getLogger('fall-from-grace')
 RE_DOT_D_PRIO = re.compile(r'(\d{2})[-]')
 
 
-def read_dot_d(path):
+class FileCache(object):
+    """Contents of files, read again only if their mtime or size
+    changed, or they were invalidated (e.g. on an inotify event).
+    """
+
+    def __init__(self):
+        # {path: ((mtime, size), content)}
+        self.files = {}
+
+    def read(self, path):
+        """Returns the contents of path. Raises IOError or OSError like
+        reading the file would."""
+
+        st = os.stat(path)
+        if stat.S_ISDIR(st.st_mode):
+            raise IOError(errno.EISDIR, os.strerror(errno.EISDIR), path)
+        version = (st.st_mtime, st.st_size)
+        cached = self.files.get(path)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        content = file(path).read()
+        self.files[path] = (version, content)
+        return content
+
+    def invalidate(self, path):
+        self.files.pop(path, None)
+
+    def clear(self):
+        self.files.clear()
+
+    def prune(self, directory, paths):
+        """Forget files in directory not among paths."""
+
+        for path in self.files.keys():
+            if os.path.dirname(path) == directory and path not in paths:
+                del self.files[path]
+
+
+def read_dot_d(path, cache=None):
     """Returns the catenated file contents of a dot d directory.
 
     Files of the form '^\d{2}-' have a priority given by the
     integer. Files that does not match this defaults to a prio of
     50. Higher prio comes higher in the file.
+
+    If cache, a FileCache, is given, only files that changed are read.
     """
 
     files = []
+    seen = set()
     for filename in os.listdir(path):
         prio_match = RE_DOT_D_PRIO.match(filename)
         prio = None
@@ -32,8 +74,12 @@ def read_dot_d(path):
             except:
                 pass
         full_path = os.path.join(path, filename)
+        seen.add(full_path)
         try:
-            content = file(full_path).read()
+            if cache is not None:
+                content = cache.read(full_path)
+            else:
+                content = file(full_path).read()
             if prio is None:
                 prio = 50
             files.append((prio, content))
@@ -42,6 +88,11 @@ def read_dot_d(path):
                 pass
             else:
                 log.error('cannot read file %s: %s', full_path, exc)
+        except OSError, exc:
+            # Removed since listed.
+            log.error('cannot read file %s: %s', full_path, exc)
+    if cache is not None:
+        cache.prune(path, seen)
     files.sort()
     return '\n'.join(content for prio, content in reversed(files))
 
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+import logging
+import os
+import Queue
+import signal
+import subprocess
+import threading
+import time
+
+import fallfromgrace.stats as stats
+
+log = logging.getLogger('fall-from-grace')
+
+
+class Executor(object):
+    """Runs shell commands on a bounded pool of worker threads, so a
+    slow command does not hold up the main loop.
+
+    At most max_workers commands run at once, at most max_queue wait
+    to run (the rest are dropped and counted) and a command running
+    for longer than timeout seconds is killed.
+    """
+
+    MAX_WORKERS = 4
+    MAX_QUEUE = 64
+    TIMEOUT = 60
+
+    # Histogram buckets for command run time, in seconds.
+    RUN_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 30, 60)
+
+    def __init__(self, max_workers=MAX_WORKERS, max_queue=MAX_QUEUE, timeout=TIMEOUT):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.queue = Queue.Queue(max_queue)
+        self.workers = []
+
+        self.submitted = 0
+        self.dropped = 0
+        self.timed_out = 0
+
+        # Seconds commands waited in the queue, and ran for.
+        self.wait_seconds = stats.Histogram()
+        self.run_seconds = stats.Histogram(self.RUN_BUCKETS)
+
+    def depth(self):
+        """Returns the number of commands waiting to run."""
+
+        return self.queue.qsize()
+
+    def submit(self, prog):
+        """Queue prog to be run. Returns False if it was dropped."""
+
+        # Threads are started lazily, as they do not survive the fork
+        # when daemonizing.
+        if not self.workers:
+            for i in xrange(self.max_workers):
+                worker = threading.Thread(target=self._work, name='exec-%d' % i)
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+
+        try:
+            self.queue.put_nowait((prog, time.time()))
+        except Queue.Full:
+            self.dropped += 1
+            log.warning('exec queue full, dropped %r (%d dropped in total)', prog, self.dropped)
+            return False
+        self.submitted += 1
+        return True
+
+    def join(self):
+        """Wait for all queued commands to finish."""
+
+        self.queue.join()
+
+    def _work(self):
+        while True:
+            prog, queued = self.queue.get()
+            try:
+                self._run(prog, queued)
+            except Exception, e:
+                log.error('exec failed for %r: %s', prog, e)
+            finally:
+                self.queue.task_done()
+
+    def _run(self, prog, queued):
+        start = time.time()
+        self.wait_seconds.observe(start - queued)
+        # TODO (bjorn): Security implications!!!
+        proc = subprocess.Popen(prog, shell=True, preexec_fn=os.setsid)
+
+        delay = 0.01
+        while proc.poll() is None:
+            if time.time() - start > self.timeout:
+                self.timed_out += 1
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                proc.wait()
+                self.run_seconds.observe(time.time() - start)
+                log.warning('exec killed after %.1fs (timeout): %s', time.time() - start, prog)
+                return
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+
+        self.run_seconds.observe(time.time() - start)
+        log.info('exec finished with status %s in %.2fs (queued %.2fs): %s',
+                 proc.returncode, time.time() - start, start - queued, prog)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+"""Recent history of process metrics, for rate of change triggers."""
+
+import array
+
+
+class Ring(object):
+    """Fixed size ring buffer of (time, value) samples, stored
+    interleaved in a single array of doubles.
+    """
+
+    __slots__ = ('samples', 'size', 'next', 'count')
+
+    def __init__(self, size):
+        self.samples = array.array('d', [0.0]) * (2 * size)
+        self.size = size
+        self.next = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, when, value):
+        i = 2 * self.next
+        self.samples[i] = when
+        self.samples[i + 1] = value
+        self.next = (self.next + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def newest(self):
+        i = 2 * ((self.next - 1) % self.size)
+        return self.samples[i], self.samples[i + 1]
+
+    def oldest(self):
+        i = 2 * ((self.next - self.count) % self.size)
+        return self.samples[i], self.samples[i + 1]
+
+    def rate(self):
+        """Returns the change per second between the oldest and newest
+        sample, or 0 with fewer than two samples.
+        """
+
+        if self.count < 2:
+            return 0.0
+        t0, v0 = self.oldest()
+        t1, v1 = self.newest()
+        if t1 <= t0:
+            return 0.0
+        return (v1 - v0) / (t1 - t0)
+
+
+class History(object):
+    """A Ring per variable per process, keyed on pid and start time.
+
+    Rings of exited processes must be dropped with forget().
+    """
+
+    # Number of samples kept per variable. With the default 10 second
+    # tick, rates are over the last minute.
+    SIZE = 7
+
+    def __init__(self, size=SIZE):
+        self.size = size
+        # {pid: (start_time, {name: Ring})}
+        self.procs = {}
+
+    def __len__(self):
+        return len(self.procs)
+
+    def rate(self, pid, start_time, name, value, now):
+        """Add a sample of the named variable of the process and return
+        its rate of change per second over the history.
+        """
+
+        state = self.procs.get(pid)
+        if state is None or state[0] != start_time:
+            state = (start_time, {})
+            self.procs[pid] = state
+        ring = state[1].get(name)
+        if ring is None:
+            ring = state[1][name] = Ring(self.size)
+        if not ring.count or ring.newest()[0] < now:
+            ring.add(now, value)
+        return ring.rate()
+
+    def forget(self, pids):
+        """Drop the history of processes that have exited."""
+
+        for pid in pids:
+            self.procs.pop(pid, None)
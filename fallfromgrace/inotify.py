@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+"""File system events from Linux inotify, through ctypes. See
+inotify(7).
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# Events meaning that a file in a watched directory has changed.
+CHANGED = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# struct inotify_event: wd, mask, cookie, len, followed by the name.
+EVENT = struct.Struct('=iIII')
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        _libc = libc
+    return _libc
+
+
+def _check(result):
+    if result < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return result
+
+
+class Inotify(object):
+    """A non-blocking inotify file descriptor.
+
+    read() returns a list of (wd, mask, name) tuples, where name is
+    the name of the file in the watched directory, or ''.
+    """
+
+    def __init__(self):
+        self.fd = None
+
+    def open(self):
+        """Raises OSError on failure, or AttributeError if inotify is
+        not available at all."""
+
+        self.fd = _check(_get_libc().inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        """Returns the watch descriptor. Raises OSError."""
+
+        return _check(_get_libc().inotify_add_watch(self.fd, path, mask))
+
+    def rm_watch(self, wd):
+        _check(_get_libc().inotify_rm_watch(self.fd, wd))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def read(self):
+        """Returns all pending events."""
+
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            if not data:
+                break
+            parse_events(data, events)
+        return events
+
+
+def parse_events(data, events):
+    """Parses inotify events in data, appending (wd, mask, name) tuples
+    to events.
+    """
+
+    offset = 0
+    while offset + EVENT.size <= len(data):
+        wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+        offset += EVENT.size
+        name = data[offset:offset + length].rstrip('\0')
+        offset += length
+        events.append((wd, mask, name))
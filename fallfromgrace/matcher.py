@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+import re
+import sre_constants
+import sre_parse
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+
+def required_literal(regex):
+    """Returns the longest literal string that any match of the
+    compiled regex must contain, or None if there is none we can
+    find.
+
+    Only top-level runs of literal characters are considered, which is
+    enough for typical cmdline patterns such as "xulrunner-bin
+    .*conkeror".
+    """
+
+    if regex.flags & re.IGNORECASE:
+        return None
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except Exception:
+        return None
+
+    best = ''
+    run = []
+    for op, arg in list(parsed) + [(None, None)]:
+        if op == sre_constants.LITERAL and arg < 256:
+            run.append(chr(arg))
+            continue
+        if len(run) > len(best):
+            best = ''.join(run)
+        run = []
+    return best or None
+
+
+class AhoCorasick(object):
+    """Aho-Corasick automaton, finding all of a set of words in a text
+    in a single pass.
+    """
+
+    def __init__(self, words):
+        """words is a list of (word, value) tuples. search() returns the
+        values of the words found.
+        """
+
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+
+        for word, value in words:
+            state = 0
+            for ch in word:
+                next_state = self.goto[state].get(ch)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][ch] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                state = next_state
+            self.out[state].append(value)
+
+        # Breadth first, so the fail state of a node is done before its
+        # children.
+        queue = list(self.goto[0].values())
+        while queue:
+            state = queue.pop(0)
+            for ch, next_state in self.goto[state].iteritems():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and ch not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(ch, 0)
+                if fail == next_state:
+                    fail = 0
+                self.fail[next_state] = fail
+                self.out[next_state] = self.out[next_state] + self.out[fail]
+
+    def search(self, text):
+        """Returns the set of values for the words found in text."""
+
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        found = set()
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+
+class LRUCache(object):
+    """A dict-like cache holding at most size items, evicting the least
+    recently used. Counts hits and misses.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key):
+        """Returns the cached value for key, or None."""
+
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.items[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if key in self.items:
+            del self.items[key]
+        elif len(self.items) >= self.size:
+            self.items.popitem(last=False)
+        self.items[key] = value
+
+    def clear(self):
+        self.items.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+class Matcher(object):
+    """Matches a cmdline against an ordered list of monitors.
+
+    The literal substrings required by each monitor's cmdline regex
+    are searched for in a single pass, and only the monitors whose
+    literal was found (or that have no usable literal) have their
+    regex run.
+
+    Results are cached per cmdline, as hosts tend to run many
+    processes with identical cmdlines.
+    """
+
+    # Max number of distinct cmdlines to cache results for.
+    CACHE_SIZE = 8192
+
+    def __init__(self, monitors, cache_size=CACHE_SIZE, literals=None):
+        """literals is an optional {monitor: required literal} to take
+        the literals from, as computing them is not free. The literals
+        of another Matcher can be reused this way.
+        """
+
+        self.monitors = list(monitors)
+        self.always = []
+        self.cache = LRUCache(cache_size)
+        # Number of regexes run.
+        self.searches = 0
+        # {monitor: required literal or None}
+        self.literals = {}
+
+        words = []
+        for index, monitor in enumerate(self.monitors):
+            if literals is not None and monitor in literals:
+                literal = literals[monitor]
+            else:
+                literal = required_literal(monitor.cmdline)
+            self.literals[monitor] = literal
+            if literal is None:
+                self.always.append(index)
+            else:
+                words.append((literal, index))
+        self.automaton = AhoCorasick(words)
+
+    def __getstate__(self):
+        # Pickled without the cached matches.
+        state = dict(self.__dict__)
+        state['cache'] = self.cache.size
+        state['searches'] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.cache = LRUCache(state['cache'])
+
+    def match(self, cmdline):
+        """Returns the list of monitors matching cmdline, in config
+        order. The list ends at the first matching "final" monitor.
+
+        The list is shared with the cache and must not be modified.
+        """
+
+        matching = self.cache.get(cmdline)
+        if matching is not None:
+            return matching
+
+        candidates = self.automaton.search(cmdline)
+        if self.always:
+            candidates.update(self.always)
+
+        self.searches += len(candidates)
+        matching = []
+        for index in sorted(candidates):
+            monitor = self.monitors[index]
+            if monitor.cmdline.search(cmdline):
+                matching.append(monitor)
+                if monitor.final:
+                    break
+        self.cache.put(cmdline, matching)
+        return matching
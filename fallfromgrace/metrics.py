@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+"""Per-process metrics, available to triggers as variables.
+
+Each variable is provided by a source, a function from an Environment
+to a dict of values. A source typically reads one file in /proc.
+"""
+
+import fallfromgrace.cgroup as cgroup
+import fallfromgrace.process as process
+import fallfromgrace.psi as psi
+
+
+class MetricError(Exception):
+    """A metric could not be read, typically because the process has
+    gone away."""
+
+
+def read_memory(env):
+    return process.get_memory_usage(env.pid)
+
+
+def read_stat(env):
+    stat = process.get_stat(env.pid)
+    return {'cpu': 100.0 * env.rate('cpu_time', stat['cpu_time']),
+            'threads': stat['threads']}
+
+
+def read_io(env):
+    counters = process.get_io_counters(env.pid)
+    return {'read_bps': env.rate('read_bytes', counters['read_bytes']),
+            'write_bps': env.rate('write_bytes', counters['write_bytes'])}
+
+
+def read_fds(env):
+    return {'fds': process.get_fd_count(env.pid)}
+
+
+def read_smaps(env):
+    return env.cached('smaps', process.get_smaps)
+
+
+def read_psi(env):
+    return psi.get_system(env.now)
+
+
+# Source name -> function returning a dict of variables.
+SOURCES = {
+    'memory': read_memory,
+    'stat': read_stat,
+    'io': read_io,
+    'fds': read_fds,
+    'smaps': read_smaps,
+    'psi': read_psi,
+    }
+
+# System wide variables, the same for every process and cgroup.
+SYSTEM_VARIABLES = set('psi_%s_%s' % (resource, kind) for resource in psi.RESOURCES
+                       for kind in ('some', 'full'))
+
+# Variable name -> source name.
+VARIABLES = {
+    'rmem': 'memory',
+    'vmem': 'memory',
+    'cpu': 'stat',
+    'threads': 'stat',
+    'read_bps': 'io',
+    'write_bps': 'io',
+    'fds': 'fds',
+    'pss': 'smaps',
+    'uss': 'smaps',
+    'swap': 'smaps',
+    }
+VARIABLES.update(dict.fromkeys(SYSTEM_VARIABLES, 'psi'))
+
+
+def read_cgroup_memory(env):
+    return cgroup.get_memory(env.cgroup)
+
+
+def read_cgroup_cpu(env):
+    return {'cpu': 100.0 * env.rate('cpu_time', cgroup.get_cpu_time(env.cgroup))}
+
+
+def read_cgroup_pids(env):
+    return {'pids': cgroup.get_pids(env.cgroup)}
+
+
+# The same for cgroups: memory.current and memory.stat, cpu.stat and
+# pids.current.
+CGROUP_SOURCES = {
+    'memory': read_cgroup_memory,
+    'cpu': read_cgroup_cpu,
+    'pids': read_cgroup_pids,
+    'psi': read_psi,
+    }
+
+CGROUP_VARIABLES = {
+    'rmem': 'memory',
+    'anon': 'memory',
+    'file': 'memory',
+    'cpu': 'cpu',
+    'pids': 'pids',
+    }
+CGROUP_VARIABLES.update(dict.fromkeys(SYSTEM_VARIABLES, 'psi'))
+
+
+# Variables with fractional values: percentages and per second rates.
+# The others are counts of bytes or things.
+FRACTIONAL = set(['cpu', 'read_bps', 'write_bps']) | SYSTEM_VARIABLES
+
+
+# Variables computed against the previous sample, which must be read
+# every tick for the rate to be over the tick.
+SAMPLED = set(['cpu', 'read_bps', 'write_bps'])
+
+
+def is_sampled(name):
+    """Returns True if name is in SAMPLED, or a rate variable."""
+
+    return name in SAMPLED or base_variable(name) != name
+
+
+# Rough relative cost of reading each source, for evaluating the cheap
+# parts of a trigger first. psi is read once per tick for all
+# processes, statm and stat are a single small read, io and fds grow
+# with the process and smaps walks all of its mappings (milliseconds
+# for a large process).
+COST = {
+    'psi': 0,
+    'memory': 1,
+    'stat': 1,
+    'cpu': 1,
+    'pids': 1,
+    'io': 2,
+    'fds': 10,
+    'smaps': 1000,
+    }
+
+
+def cost(variables):
+    """Returns the cost of reading the given variables, of processes or
+    cgroups, each source counted once.
+    """
+
+    sources = set()
+    for var in variables:
+        base = base_variable(var)
+        source = VARIABLES.get(base) or CGROUP_VARIABLES.get(base)
+        if source is not None:
+            sources.add(source)
+    return sum(COST[source] for source in sources)
+
+
+# Variables only available to monitors aggregating over a process
+# tree: "count" is the number of processes.
+AGGREGATE_VARIABLES = set(['count'])
+
+# Ways of aggregating variables over a process tree.
+AGGREGATES = ('sum', 'max')
+
+
+def base_variable(name):
+    """Returns the variable a rate variable such as "rate(rmem)" is the
+    rate of, or name itself if it is not a rate variable.
+    """
+
+    if name.startswith('rate(') and name.endswith(')'):
+        return name[5:-1]
+    return name
+
+
+def is_variable(name, variables=VARIABLES):
+    return base_variable(name) in variables
+
+
+def sources_for(variables, known=VARIABLES):
+    """Returns the set of sources needed for the given variables."""
+
+    return set(known[base_variable(var)] for var in variables
+               if var not in AGGREGATE_VARIABLES)
+
+
+class Samples(object):
+    """The previous sample of each counter of each process, for
+    computing rates between ticks.
+    """
+
+    def __init__(self):
+        # {pid: (start_time, {name: (time, value)})}
+        self.procs = {}
+
+    def __len__(self):
+        return len(self.procs)
+
+    def rate(self, pid, start_time, name, value, now):
+        """Record value for the named counter of the process, and
+        return its rate of change per second since the previous sample,
+        or 0 if there is none.
+        """
+
+        state = self.procs.get(pid)
+        if state is None or state[0] != start_time:
+            state = (start_time, {})
+            self.procs[pid] = state
+        counters = state[1]
+        previous = counters.get(name)
+        counters[name] = (now, value)
+        if previous is None or now <= previous[0]:
+            return 0.0
+        return (value - previous[1]) / (now - previous[0])
+
+    def forget(self, pids):
+        """Drop samples for processes that have exited."""
+
+        for pid in pids:
+            self.procs.pop(pid, None)
+
+
+class Cache(object):
+    """Values of sources that are expensive to read, reused for up to
+    interval seconds per process.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        # {pid: (start_time, {source: (time, values)})}
+        self.procs = {}
+
+    def __len__(self):
+        return len(self.procs)
+
+    def get(self, pid, start_time, source, now):
+        """Returns the values of source for the process if read less
+        than interval seconds before now, else None."""
+
+        state = self.procs.get(pid)
+        if state is None or state[0] != start_time:
+            return None
+        entry = state[1].get(source)
+        if entry is None or now - entry[0] >= self.interval:
+            return None
+        return entry[1]
+
+    def put(self, pid, start_time, source, values, now):
+        state = self.procs.get(pid)
+        if state is None or state[0] != start_time:
+            state = (start_time, {})
+            self.procs[pid] = state
+        state[1][source] = (now, values)
+
+    def forget(self, pids):
+        """Drop the values of processes that have exited."""
+
+        for pid in pids:
+            self.procs.pop(pid, None)
+
+
+class Environment(object):
+    """Lazy mapping from variable name to value for a single pid.
+
+    Sources are read on first access, and each at most once, so an
+    Environment should live for one tick. Rates are computed against
+    samples, and "rate(...)" variables against history, if given.
+    Expensive sources are reused from cache, if given.
+    """
+
+    VARIABLES = VARIABLES
+    SOURCES = SOURCES
+
+    def __init__(self, pid, start_time=None, samples=None, now=0, history=None, cache=None):
+        self.pid = pid
+        self.start_time = start_time
+        self.samples = samples
+        self.history = history
+        self.cache = cache
+        self.now = now
+        self.values = {}
+        # {source: None, or the MetricError from reading it}
+        self.read = {}
+
+    def __contains__(self, name):
+        return is_variable(name, self.VARIABLES)
+
+    def __getitem__(self, name):
+        try:
+            return self.values[name]
+        except KeyError:
+            pass
+
+        base = base_variable(name)
+        if base != name:
+            value = 0.0
+            if self.history is not None:
+                value = self.history.rate(self.pid, self.start_time, base,
+                                          self[base], self.now)
+            self.values[name] = value
+            return value
+
+        source = self.VARIABLES[name]
+        if source not in self.read:
+            self.update(self.fetch([source]))
+        if self.read[source] is not None:
+            raise self.read[source]
+        return self.values[name]
+
+    def fetch(self, sources):
+        """Reads sources, returning {source: dict of values, or
+        MetricError}, to be passed to update. Only touches the samples
+        of this process, so it may run on another thread.
+        """
+
+        fetched = {}
+        for source in sources:
+            try:
+                fetched[source] = self.SOURCES[source](self)
+            except Exception, e:
+                fetched[source] = MetricError('failed to read %s for %s: %s' % (
+                        source, self.describe(), e))
+        return fetched
+
+    def update(self, fetched):
+        """Add the values of sources returned by fetch, unless they
+        were read already."""
+
+        for source, values in fetched.iteritems():
+            if source in self.read:
+                continue
+            if isinstance(values, MetricError):
+                self.read[source] = values
+            else:
+                self.values.update(values)
+                self.read[source] = None
+
+    def describe(self):
+        return 'pid %s' % self.pid
+
+    def cached(self, source, read):
+        """Returns read(pid), or the values from the cache if it was
+        read recently."""
+
+        if self.cache is None:
+            return read(self.pid)
+        values = self.cache.get(self.pid, self.start_time, source, self.now)
+        if values is None:
+            values = read(self.pid)
+            self.cache.put(self.pid, self.start_time, source, values, self.now)
+        return values
+
+    def rate(self, name, value):
+        """Returns the rate of change per second of a counter."""
+
+        if self.samples is None:
+            return 0.0
+        return self.samples.rate(self.pid, self.start_time, name, value, self.now)
+
+
+class CgroupEnvironment(Environment):
+    """Lazy mapping from variable name to value for a cgroup.Cgroup.
+    Samples and history are kept per cgroup path.
+    """
+
+    VARIABLES = CGROUP_VARIABLES
+    SOURCES = CGROUP_SOURCES
+
+    def __init__(self, cgroup, samples=None, now=0, history=None):
+        Environment.__init__(self, cgroup.path, cgroup.id, samples, now, history)
+        self.cgroup = cgroup
+
+    def describe(self):
+        return 'cgroup %s' % self.cgroup.path
+
+
+class Aggregate(object):
+    """Sum and max of variables over a process tree."""
+
+    __slots__ = ('sums', 'maxs', 'count')
+
+    def __init__(self, sums, maxs, count):
+        self.sums = sums
+        self.maxs = maxs
+        self.count = count
+
+    def environment(self, how):
+        """Returns the variables aggregated by how (see AGGREGATES)."""
+
+        if how == 'sum':
+            env = dict(self.sums)
+        else:
+            env = dict(self.maxs)
+        env['count'] = self.count
+        return env
+
+
+def aggregate(snapshot, roots, variables, environment):
+    """Aggregates variables over the process trees rooted at roots.
+
+    This is a single post-order pass over the snapshot, covering each
+    process once even if trees are nested. environment is a function
+    from pid to Environment. Returns {root: Aggregate}. Processes whose
+    metrics cannot be read count as 0.
+    """
+
+    ranges = sorted(filter(None, [snapshot.span(pid) for pid in roots]))
+    variables = list(variables)
+    tree = snapshot.tree
+    order = snapshot.order
+    totals = {}
+
+    end = 0
+    for start, stop in ranges:
+        if stop <= end:
+            # Nested in the previous range, already done.
+            continue
+        end = stop
+        # Reversed depth first order has children before parents.
+        for i in xrange(stop - 1, start - 1, -1):
+            pid = order[i]
+            env = environment(pid)
+            sums = {}
+            for var in variables:
+                try:
+                    sums[var] = env[var]
+                except MetricError:
+                    sums[var] = 0
+            maxs = dict(sums)
+            count = 1
+            for cpid in tree.get(pid, ()):
+                child = totals.get(cpid)
+                if child is None:
+                    continue
+                count += child.count
+                for var in variables:
+                    sums[var] += child.sums[var]
+                    if child.maxs[var] > maxs[var]:
+                        maxs[var] = child.maxs[var]
+            totals[pid] = Aggregate(sums, maxs, count)
+
+    return dict((pid, totals[pid]) for pid in roots if pid in totals)
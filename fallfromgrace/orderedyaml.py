@@ -10,15 +10,18 @@ try:
 except ImportError:
     from ordereddict import OrderedDict
 
+# The libyaml based loader is many times faster, if available.
+BaseLoader = getattr(yaml, 'CLoader', yaml.Loader)
+
 
 def load(data):
-    class OrderedDictYAMLLoader(yaml.Loader):
+    class OrderedDictYAMLLoader(BaseLoader):
         """
         A YAML loader that loads mappings into ordered dictionaries.
         """
 
         def __init__(self, *args, **kwargs):
-            yaml.Loader.__init__(self, *args, **kwargs)
+            BaseLoader.__init__(self, *args, **kwargs)
 
             self.add_constructor(u'tag:yaml.org,2002:map', type(self).construct_yaml_map)
             self.add_constructor(u'tag:yaml.org,2002:omap', type(self).construct_yaml_map)
@@ -3,79 +3,91 @@
 # Copyright (c) 2012 Björn Edström <be@bjrn.se>
 # See LICENSE for details.
 
+"""Parser for actions, such as "term", "stop @ 2m" or
+"exec @ 1h notify-send $PID". The grammar is
+
+    statement : TERM
+              | KILL
+              | STOP AT NUMBER
+              | EXEC AT NUMBER PROGRAM
+              | EXEC PROGRAM
+
+where PROGRAM is the rest of the line.
+"""
+
 import logging
-import ply.lex as lex
-import ply.yacc as yacc
+import re
 
 import fallfromgrace.number as number
 
 log = logging.getLogger('fall-from-grace')
 
-tokens = ('TERM', 'KILL', 'STOP', 'EXEC', 'AT', 'NUMBER', 'PROGRAM')
-
-t_TERM = r'term'
-t_KILL = r'kill'
-t_STOP = r'stop'
-t_AT = r'[@]'
-t_EXEC = r'exec'
-t_PROGRAM = r'.+'
-
-def t_NUMBER(t):
-    r'[0-9\.]+[smh]?'
-    try:
-        t.value = number.unfix(t.value, {
-                's': 1,
-                'm': 60,
-                'h': 60**2})
-    except ValueError:
-        log.error('Integer value too large %d', t.value)
-        t.value = 0
-    return t
-
-t_ignore = " \t"
-
-def t_newline(t):
-    r'\n+'
-    t.lexer.lineno += t.value.count("\n")
-
-def t_error(t):
-    log.error('Illegal character "%s"', t.value[0])
-    raise Exception('Illegal character "%s"' % (t.value[0],))
-    t.lexer.skip(1)
-
-lexer = lex.lex(errorlog=log)
-
-precedence = (
-    ('left', 'AT', 'NUMBER', 'PROGRAM'),
-    )
-
-def p_statement_expr(t):
-    'statement : expression'
-    t[0] = t[1]
-
-def p_expression_action(t):
-    '''expression : TERM
-                  | KILL
-                  | STOP AT NUMBER
-                  | EXEC AT NUMBER PROGRAM
-                  | EXEC PROGRAM'''
-    t[0] = t[1:]
-
-def p_error(t):
-    log.error('Syntax error at "%s"', t.value)
-    raise Exception('Syntax error at "%s"' % (t.value,))
-
-# TODO (bjorn): Suppress writing of the temp files altogether.
-# Also see parser_trigger.py
-parser = yacc.yacc(errorlog=log,
-                   outputdir='/tmp',
-                   debugfile='/tmp/parser_action.out')
+
+TIMES = {'s': 1, 'm': 60, 'h': 60**2}
+
+SPACE = re.compile(r'\s*')
+KEYWORD = re.compile(r'term|kill|stop|exec')
+AT = re.compile(r'@')
+NUMBER = re.compile(r'[0-9.]+[smh]?')
+PROGRAM = re.compile(r'.+')
+END = re.compile(r'\Z')
+
+
+class Parser(object):
+    def __init__(self, s):
+        self.s = s
+        self.pos = 0
+
+    def match(self, regex):
+        """Returns the text matched by regex at the current position,
+        after skipping whitespace, or None."""
+
+        self.pos = SPACE.match(self.s, self.pos).end()
+        m = regex.match(self.s, self.pos)
+        if m is None:
+            return None
+        self.pos = m.end()
+        return m.group()
+
+    def expect(self, regex):
+        value = self.match(regex)
+        if value is None:
+            self.error()
+        return value
+
+    def error(self):
+        at = self.s[self.pos:] or 'end of input'
+        log.error('Syntax error at "%s"', at)
+        raise Exception('Syntax error at "%s"' % (at,))
+
+    def delay(self):
+        value = self.expect(NUMBER)
+        try:
+            return number.unfix(value, TIMES)
+        except ValueError:
+            log.error('Invalid number "%s"', value)
+            raise Exception('Invalid number "%s"' % (value,))
+
+    def statement(self):
+        keyword = self.expect(KEYWORD)
+        if keyword in ('term', 'kill'):
+            parsed = [keyword]
+        elif keyword == 'stop':
+            self.expect(AT)
+            parsed = [keyword, '@', self.delay()]
+        elif self.match(AT) is not None:
+            parsed = [keyword, '@', self.delay(), self.expect(PROGRAM)]
+        else:
+            parsed = [keyword, self.expect(PROGRAM)]
+        self.expect(END)
+        return parsed
+
 
 def parse(s):
     """Parse an action specification.
     """
 
-    parsed = parser.parse(s, lexer=lexer)
+    parsed = Parser(s).statement()
     if not parsed:
         raise ValueError('parse error: failed to parse action')
     return parsed
@@ -3,82 +3,258 @@
 # Copyright (c) 2012 Björn Edström <be@bjrn.se>
 # See LICENSE for details.
 
+"""Parser for triggers, such as "rmem > 1g", "rate(rmem) > 10m/min" or
+"rmem + swap > 2g and not cpu < 50".
+
+This is a small hand written recursive descent parser for the grammar
+
+    statement  : disjunct
+    disjunct   : conjunct (OR conjunct)*
+    conjunct   : negation (AND negation)*
+    negation   : NOT negation | comparison
+    comparison : sum (OP sum)?
+    sum        : product (ADD product)*
+    product    : operand (MUL operand)*
+    operand    : NUMBER | VAR | RATE LPAREN VAR RPAREN | LPAREN disjunct RPAREN
+
+where OP is one of < > <= >= ==, ADD is + or - and MUL is * or /, the
+latter two left associative. Comparisons do not chain. An expression
+is a number, a variable name, a tuple (lhs, op, rhs) for the binary
+operators, including "and" and "or", or ("not", operand). The
+operands of "and", "or" and "not", and the whole statement, must be
+comparisons.
+"""
+
 import logging
-import ply.lex as lex
-import ply.yacc as yacc
+import re
 
 import fallfromgrace.number as number
 
 log = logging.getLogger('fall-from-grace')
 
 
-tokens = ('VAR', 'NUMBER', 'OP1', 'OP2')
+VARIABLES = ('rmem', 'vmem', 'cpu', 'read_bps', 'write_bps', 'fds', 'threads', 'count',
+             'anon', 'file', 'pids', 'pss', 'uss', 'swap', 'psi_memory_some', 'psi_memory_full', 'psi_io_some',
+             'psi_io_full', 'psi_cpu_some', 'psi_cpu_full')
+
+# Seconds per unit of time for rates, as in 50m/min.
+PER = {'s': 1, 'min': 60, 'h': 60**2}
+
+SIZES = {'k': 1024, 'm': 1024**2, 'g': 1024**3}
+
+# Alternatives are tried in order, so NUMBER goes first and the two
+# character operators before the one character ones. A unit is only
+# taken if it is a whole word, so 100/swap is a division.
+TOKEN = re.compile(r'''
+    (?P<NUMBER>[0-9.]+[kmgKMG]?(?:/(?:s|min|h)(?![A-Za-z_]))?)
+  | (?P<VAR>%s)
+  | (?P<OP><=|>=|==|<|>)
+  | (?P<ADD>[-+])
+  | (?P<MUL>[*/])
+  | (?P<AND>and\b)
+  | (?P<OR>or\b)
+  | (?P<NOT>not\b)
+  | (?P<RATE>rate)
+  | (?P<LPAREN>\()
+  | (?P<RPAREN>\))
+  | (?P<SPACE>\s+)
+''' % '|'.join(VARIABLES), re.VERBOSE)
+
+COMPARISONS = ('<', '>', '<=', '>=', '==')
+
+# Operators giving a truth value.
+BOOLEAN = COMPARISONS + ('and', 'or')
+
+
+def is_boolean(expr):
+    """Returns True if expr is a comparison, or a combination of them
+    with "and", "or" and "not"."""
+
+    if not isinstance(expr, tuple):
+        return False
+    if len(expr) == 2:
+        return expr[0] == 'not'
+    return expr[1] in BOOLEAN
+
+
+class PerSecond(float):
+    """A number given with a unit of time, such as 10m/min, in units
+    per second. Only compared with rate variables."""
+
+
+def parse_number(s):
+    value, _, per = s.partition('/')
+    if per:
+        # Not rounded, 0.1/s is a rate.
+        mul = 1
+        if value[-1:].lower() in SIZES:
+            mul = SIZES[value[-1].lower()]
+            value = value[:-1]
+        return PerSecond(float(value) * mul / PER[per])
+    if value[-1:].lower() in SIZES:
+        return number.unfix(value, SIZES)
+    if '.' in value:
+        # Fractions such as ratios and percentages are kept as is.
+        return float(value)
+    return int(value)
+
+
+def is_rate(expr):
+    return isinstance(expr, basestring) and expr.startswith('rate(')
+
+
+def check_units(expr):
+    """Raises unless every number with a unit of time is compared with
+    a rate variable, as in "rate(rmem) > 10m/min".
+    """
+
+    if isinstance(expr, PerSecond):
+        log.error('Unit of time without a rate: %s', expr)
+        raise Exception('Unit of time without a rate: %s' % (expr,))
+    if not isinstance(expr, tuple):
+        return
+    if len(expr) == 3 and expr[1] in COMPARISONS:
+        lhs, _, rhs = expr
+        if (isinstance(rhs, PerSecond) and is_rate(lhs)) or \
+                (isinstance(lhs, PerSecond) and is_rate(rhs)):
+            return
+    for operand in expr[::2] if len(expr) == 3 else expr[1:]:
+        check_units(operand)
+
+
+def tokenize(s):
+    """Returns a list of (type, value) tokens."""
+
+    tokens = []
+    pos = 0
+    while pos < len(s):
+        m = TOKEN.match(s, pos)
+        if m is None:
+            log.error('Illegal character "%s"', s[pos])
+            raise Exception('Illegal character "%s"' % (s[pos],))
+        pos = m.end()
+        kind = m.lastgroup
+        if kind == 'SPACE':
+            continue
+        value = m.group(kind)
+        if kind == 'NUMBER':
+            try:
+                value = parse_number(value)
+            except ValueError:
+                log.error('Invalid number "%s"', value)
+                raise Exception('Invalid number "%s"' % (value,))
+        tokens.append((kind, value))
+    return tokens
+
+
+class Parser(object):
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
 
-t_VAR = r'(rmem|vmem)'
-t_OP1 = r'(<|>)'
-t_OP2 = r'(<=|>=|==)'
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos][0]
+        return None
 
-def t_NUMBER(t):
-    r'[0-9\.]+[kmgKMG]?'
-    try:
-        t.value = number.unfix(t.value, {
-                'k': 1024,
-                'm': 1024**2,
-                'g': 1024**3})
-    except ValueError:
-        log.error('Integer value too large %d', t.value)
-        t.value = 0
-    return t
+    def expect(self, kind):
+        if self.peek() != kind:
+            self.error()
+        value = self.tokens[self.pos][1]
+        self.pos += 1
+        return value
 
-t_ignore = " \t"
+    def error(self):
+        if self.pos < len(self.tokens):
+            at = self.tokens[self.pos][1]
+        else:
+            at = 'end of input'
+        log.error('Syntax error at "%s"', at)
+        raise Exception('Syntax error at "%s"' % (at,))
 
-def t_newline(t):
-    r'\n+'
-    t.lexer.lineno += t.value.count("\n")
+    def statement(self):
+        expr = self.boolean(self.disjunct())
+        if self.peek() is not None:
+            self.error()
+        check_units(expr)
+        return expr
 
-def t_error(t):
-    log.error('Illegal character "%s"', t.value[0])
-    raise Exception('Illegal character "%s"' % (t.value[0],))
-    t.lexer.skip(1)
+    def boolean(self, expr):
+        if not is_boolean(expr):
+            log.error('Not a comparison: %s', expr)
+            raise Exception('Not a comparison: %s' % (expr,))
+        return expr
 
-lexer = lex.lex(errorlog=log)
+    def number(self, expr):
+        if is_boolean(expr):
+            log.error('Not a number: %s', expr)
+            raise Exception('Not a number: %s' % (expr,))
+        return expr
 
-precedence = (
-    ('left', 'OP2', 'OP1'),
-    )
+    def disjunct(self):
+        expr = self.conjunct()
+        while self.peek() == 'OR':
+            self.expect('OR')
+            expr = (self.boolean(expr), 'or', self.boolean(self.conjunct()))
+        return expr
 
-names = {}
+    def conjunct(self):
+        expr = self.negation()
+        while self.peek() == 'AND':
+            self.expect('AND')
+            expr = (self.boolean(expr), 'and', self.boolean(self.negation()))
+        return expr
 
-def p_statement_expr(t):
-    'statement : expression'
-    t[0] = t[1]
+    def negation(self):
+        if self.peek() == 'NOT':
+            self.expect('NOT')
+            return ('not', self.boolean(self.negation()))
+        return self.comparison()
 
-def p_expression_binop(t):
-    '''expression : expression OP2 expression
-                  | expression OP1 expression'''
-    t[0] = (t[1], t[2], t[3])
+    def comparison(self):
+        expr = self.sum()
+        if self.peek() == 'OP':
+            op = self.expect('OP')
+            expr = (self.number(expr), op, self.number(self.sum()))
+        return expr
 
-def p_expression_number(t):
-    '''expression : NUMBER'''
-    t[0] = t[1]
+    def sum(self):
+        expr = self.product()
+        while self.peek() == 'ADD':
+            op = self.expect('ADD')
+            expr = (self.number(expr), op, self.number(self.product()))
+        return expr
 
-def p_expression_var(t):
-    'expression : VAR'
-    t[0] = t[1]
+    def product(self):
+        expr = self.operand()
+        while self.peek() == 'MUL':
+            op = self.expect('MUL')
+            expr = (self.number(expr), op, self.number(self.operand()))
+        return expr
 
-def p_error(t):
-    log.error('Syntax error at "%s"', t.value)
-    raise Exception('Syntax error at "%s"' % (t.value,))
+    def operand(self):
+        kind = self.peek()
+        if kind in ('NUMBER', 'VAR'):
+            return self.expect(kind)
+        if kind == 'RATE':
+            self.expect('RATE')
+            self.expect('LPAREN')
+            var = self.expect('VAR')
+            self.expect('RPAREN')
+            return 'rate(%s)' % (var,)
+        if kind == 'LPAREN':
+            self.expect('LPAREN')
+            expr = self.disjunct()
+            self.expect('RPAREN')
+            return expr
+        self.error()
 
-parser = yacc.yacc(errorlog=log,
-                   outputdir='/tmp',
-                   debugfile='/tmp/parser_trigger.out')
 
 def parse(s):
     """Parse a rule specification.
     """
 
-    parsed = parser.parse(s, lexer=lexer)
-    if len(parsed) != 3:
+    parsed = Parser(tokenize(s)).statement()
+    if not is_boolean(parsed):
         raise ValueError('parsed incorrectly: %s' % (parsed,))
     return parsed
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+"""Process events (fork, exec, exit) from the Linux netlink process
+connector. See linux/connector.h and linux/cn_proc.h.
+
+Listening requires CAP_NET_ADMIN.
+"""
+
+import errno
+import logging
+import os
+import socket
+import struct
+
+log = logging.getLogger('fall-from-grace')
+
+NETLINK_CONNECTOR = 11
+CN_IDX_PROC = 1
+CN_VAL_PROC = 1
+NLMSG_DONE = 3
+
+PROC_CN_MCAST_LISTEN = 1
+PROC_CN_MCAST_IGNORE = 2
+
+FORK = 0x00000001
+EXEC = 0x00000002
+EXIT = 0x80000000
+
+# struct nlmsghdr: len, type, flags, seq, pid
+NLMSGHDR = struct.Struct('=IHHII')
+# struct cn_msg: idx, val, seq, ack, len, flags
+CN_MSG = struct.Struct('=IIIIHH')
+# struct proc_event: what, cpu, timestamp_ns
+PROC_EVENT = struct.Struct('=IIQ')
+# fork: parent_pid, parent_tgid, child_pid, child_tgid
+FORK_EVENT = struct.Struct('=IIII')
+# exec: process_pid, process_tgid
+# exit: process_pid, process_tgid, exit_code, exit_signal
+PID_TGID = struct.Struct('=II')
+
+HEADER_SIZE = NLMSGHDR.size + CN_MSG.size
+
+
+class Overrun(Exception):
+    """Events were lost because we did not keep up. The caller should
+    rescan all processes."""
+
+
+class ProcEvents(object):
+    """A netlink process connector socket.
+
+    read() returns a list of (what, pid, ppid) tuples, where what is
+    FORK, EXEC or EXIT and ppid is only set for FORK. Thread creation
+    and exit is filtered out.
+    """
+
+    # Socket receive buffer. Fork storms can produce a lot of events
+    # between two reads.
+    RCVBUF = 1024 * 1024
+
+    def __init__(self):
+        self.sock = None
+
+    def open(self):
+        """Open the socket and subscribe to events. Raises
+        socket.error on failure, e.g. if not permitted.
+        """
+
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_CONNECTOR)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RCVBUF)
+            sock.bind((0, CN_IDX_PROC))
+            self._control(sock, PROC_CN_MCAST_LISTEN)
+            sock.setblocking(False)
+        except:
+            sock.close()
+            raise
+        self.sock = sock
+
+    def _control(self, sock, op):
+        payload = struct.pack('=I', op)
+        cn_msg = CN_MSG.pack(CN_IDX_PROC, CN_VAL_PROC, 0, 0, len(payload), 0)
+        nlmsghdr = NLMSGHDR.pack(HEADER_SIZE + len(payload), NLMSG_DONE, 0, 0, os.getpid())
+        sock.send(nlmsghdr + cn_msg + payload)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self._control(self.sock, PROC_CN_MCAST_IGNORE)
+            except socket.error:
+                pass
+            self.sock.close()
+            self.sock = None
+
+    def read(self):
+        """Returns all pending events. Raises Overrun if events were
+        lost.
+        """
+
+        events = []
+        while True:
+            try:
+                data = self.sock.recv(4096)
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                if e.errno == errno.ENOBUFS:
+                    raise Overrun()
+                raise
+            parse_messages(data, events)
+        return events
+
+
+def parse_messages(data, events):
+    """Parses netlink messages in data, appending (what, pid, ppid)
+    tuples to events.
+    """
+
+    offset = 0
+    while offset + HEADER_SIZE + PROC_EVENT.size <= len(data):
+        length = NLMSGHDR.unpack_from(data, offset)[0]
+        if length < HEADER_SIZE:
+            break
+        what = PROC_EVENT.unpack_from(data, offset + HEADER_SIZE)[0]
+        body = offset + HEADER_SIZE + PROC_EVENT.size
+        if what == FORK:
+            parent_pid, parent_tgid, child_pid, child_tgid = \
+                FORK_EVENT.unpack_from(data, body)
+            if child_pid == child_tgid:
+                events.append((FORK, child_pid, parent_tgid))
+        elif what in (EXEC, EXIT):
+            pid, tgid = PID_TGID.unpack_from(data, body)
+            if pid == tgid:
+                events.append((what, pid, None))
+        # Messages are 4 byte aligned.
+        offset += (length + 3) & ~3
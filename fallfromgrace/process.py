@@ -3,11 +3,56 @@
 # Copyright (c) 2012 Björn Edström <be@bjrn.se>
 # See LICENSE for details.
 
+import errno
 import logging
+import os
 import psutil
 
 log = logging.getLogger('fall-from-grace')
 
+PROC_ROOT = '/proc'
+
+
+def read_file(path, bufsize=4096):
+    """Returns the contents of a (small) file, such as the ones in
+    /proc, with as little overhead as possible.
+    """
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        data = os.read(fd, bufsize)
+        if len(data) < bufsize:
+            return data
+        chunks = [data]
+        while data:
+            data = os.read(fd, bufsize)
+            chunks.append(data)
+        return ''.join(chunks)
+    finally:
+        os.close(fd)
+
+
+# Indexes into the list returned by parse_stat. Field N in proc(5)
+# has index N - 3.
+STAT_PPID = 1
+STAT_UTIME = 11
+STAT_STIME = 12
+STAT_NUM_THREADS = 17
+STAT_STARTTIME = 19
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def parse_stat(stat):
+    """Parses the contents of /proc/<pid>/stat. Returns the list of
+    fields following the comm field, starting with the state.
+
+    The comm field may itself contain spaces and parentheses, so we
+    split on the last closing parenthesis.
+    """
+
+    return stat[stat.rindex(')') + 2:].split(' ')
+
 
 def get_pids():
     """Yields a snapshot of currently active process ids."""
@@ -29,6 +74,9 @@ def get_cmdline(pid):
         return None
 
 
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
 def get_memory_usage(pid):
     """Returns a dict with memory usage information for the given
     pid. The dict has the following keys:
@@ -37,10 +85,63 @@ def get_memory_usage(pid):
     "rmem": residential memory usage.
     """
 
-    proc = psutil.Process(pid)
-    usage = {}
-    usage['rmem'], usage['vmem'] = proc.get_memory_info()
-    return usage
+    return get_backend().memory_usage(pid)
+
+
+# Fields of smaps summed for get_smaps, in kB.
+SMAPS_FIELDS = ('Pss', 'Private_Clean', 'Private_Dirty', 'Swap')
+
+
+def parse_smaps(data):
+    """Sums the SMAPS_FIELDS over the mappings in the contents of
+    /proc/<pid>/smaps (or smaps_rollup, which has a single one).
+    Returns {field: bytes}.
+    """
+
+    totals = dict.fromkeys(SMAPS_FIELDS, 0)
+    for line in data.splitlines():
+        key, _, value = line.partition(':')
+        if key in totals:
+            totals[key] += int(value.split()[0]) * 1024
+    return totals
+
+
+def get_smaps(pid):
+    """Returns a dict with memory usage information from
+    /proc/<pid>/smaps_rollup, which is expensive to read as the kernel
+    walks the page tables of the process:
+
+    "pss": proportional set size, shared pages divided by the number
+           of processes sharing them,
+    "uss": unique set size, the pages only this process uses,
+    "swap": swapped out memory.
+    """
+
+    return get_backend().smaps(pid)
+
+
+def get_stat(pid):
+    """Returns a dict with:
+
+    "cpu_time": user and system CPU time in seconds,
+    "threads": number of threads.
+    """
+
+    return get_backend().cpu_stat(pid)
+
+
+def get_io_counters(pid):
+    """Returns a dict with "read_bytes" and "write_bytes", the number of
+    bytes read from and written to storage by pid.
+    """
+
+    return get_backend().io_counters(pid)
+
+
+def get_fd_count(pid):
+    """Returns the number of open file descriptors of pid."""
+
+    return get_backend().fd_count(pid)
 
 
 def get_parent_pids(pid):
@@ -57,40 +158,555 @@ def get_parent_pids(pid):
     return pids
 
 
-def get_snapshot():
-    """Returns a snapshot of currently running processes.
-
-    Specifically, returns (tree, cmdlines) where tree is a dict from
-    pid to a set of children, and cmdlines is a dict from pid to
-    cmdline.
+class ProcfsBackend(object):
+    """Snapshot backend reading /proc/<pid>/stat and /proc/<pid>/cmdline
+    directly, without creating any per-process objects. The metrics of
+    processes are read from /proc/<pid> as well.
     """
 
-    tree = {}
-    cmdlines = {}
-    for proc in psutil.get_process_list():
+    name = 'procfs'
+
+    def __init__(self, root=PROC_ROOT):
+        self.root = root
+
+    def available(self):
+        return os.path.isdir(self.root)
+
+    def pids(self):
+        """Returns the list of pids."""
+
+        return [int(entry) for entry in os.listdir(self.root) if entry.isdigit()]
+
+    def scan(self):
+        """Yields (pid, ppid, start_time, comm) for all processes."""
+
+        for pid in self.pids():
+            info = self.stat(pid)
+            if info is not None:
+                yield info
+
+    def stat(self, pid):
+        """Returns (pid, ppid, start_time, comm) for pid, or None if
+        the process does not exist.
+        """
+
         try:
-            ppid = proc.ppid
-        except Exception, e:
-            continue
+            stat = read_file('%s/%d/stat' % (self.root, pid))
+        except (IOError, OSError):
+            # The process went away while we were looking.
+            return None
         try:
-            cmdline = ' '.join(proc.cmdline)
+            rpar = stat.rindex(')')
+            fields = stat[rpar + 2:].split(' ')
+            return (pid, int(fields[STAT_PPID]),
+                    int(fields[STAT_STARTTIME]), stat[stat.index('(') + 1:rpar])
+        except (ValueError, IndexError), e:
+            log.warning('failed to parse stat for pid %s: %s', pid, e)
+            return None
+
+    def cmdline(self, pid):
+        """Returns the cmdline of the given pid, or None."""
+
+        try:
+            data = read_file('%s/%d/cmdline' % (self.root, pid))
+        except (IOError, OSError):
+            return None
+        # Same semantics as psutil: empty arguments are dropped.
+        return ' '.join([arg for arg in data.split('\0') if arg])
+
+    def memory_usage(self, pid):
+        statm = read_file('%s/%d/statm' % (self.root, pid)).split(' ', 2)
+        usage = {}
+        usage['vmem'] = int(statm[0]) * PAGE_SIZE
+        usage['rmem'] = int(statm[1]) * PAGE_SIZE
+        return usage
+
+    def smaps(self, pid):
+        """Falls back to adding up /proc/<pid>/smaps on kernels before
+        4.14."""
+
+        try:
+            data = read_file('%s/%d/smaps_rollup' % (self.root, pid))
+        except (IOError, OSError), e:
+            if e.errno != errno.ENOENT or not os.path.exists('%s/%d' % (self.root, pid)):
+                raise
+            data = read_file('%s/%d/smaps' % (self.root, pid), 65536)
+        totals = parse_smaps(data)
+        return {'pss': totals['Pss'],
+                'uss': totals['Private_Clean'] + totals['Private_Dirty'],
+                'swap': totals['Swap']}
+
+    def cpu_stat(self, pid):
+        fields = parse_stat(read_file('%s/%d/stat' % (self.root, pid)))
+        stat = {}
+        stat['cpu_time'] = float(int(fields[STAT_UTIME]) + int(fields[STAT_STIME])) / CLOCK_TICKS
+        stat['threads'] = int(fields[STAT_NUM_THREADS])
+        return stat
+
+    def io_counters(self, pid):
+        counters = {}
+        for line in read_file('%s/%d/io' % (self.root, pid)).splitlines():
+            key, _, value = line.partition(':')
+            if key in ('read_bytes', 'write_bytes'):
+                counters[key] = int(value)
+        return counters
+
+    def fd_count(self, pid):
+        return len(os.listdir('%s/%d/fd' % (self.root, pid)))
+
+
+class PsutilBackend(object):
+    """Snapshot backend using psutil, for snapshots and metrics.
+    Slower, but portable."""
+
+    name = 'psutil'
+
+    def available(self):
+        return True
+
+    def pids(self):
+        """Returns the list of pids."""
+
+        return psutil.get_pid_list()
+
+    def scan(self):
+        """Yields (pid, ppid, start_time, comm) for all processes."""
+
+        for proc in psutil.get_process_list():
+            try:
+                ppid = proc.ppid
+                start_time = proc.create_time
+                comm = proc.name
+            except Exception, e:
+                continue
+            yield proc.pid, ppid, start_time, comm
+
+    def stat(self, pid):
+        """Returns (pid, ppid, start_time, comm) for pid, or None if
+        the process does not exist.
+        """
+
+        try:
+            proc = psutil.Process(pid)
+            return pid, proc.ppid, proc.create_time, proc.name
         except Exception, e:
-            continue
-        cmdlines[proc.pid] = cmdline
-        if ppid not in tree:
-            tree[ppid] = set()
-        if proc.pid not in tree:
-            tree[proc.pid] = set()
-        tree[ppid].add(proc.pid)
-    return tree, cmdlines
+            return None
+
+    def cmdline(self, pid):
+        """Returns the cmdline of the given pid, or None."""
+
+        return get_cmdline(pid)
+
+    def memory_usage(self, pid):
+        rmem, vmem = psutil.Process(pid).get_memory_info()
+        return {'rmem': rmem, 'vmem': vmem}
+
+    def smaps(self, pid):
+        # psutil cannot parse smaps of current kernels, which are the
+        # only ones to have it.
+        return ProcfsBackend().smaps(pid)
+
+    def cpu_stat(self, pid):
+        proc = psutil.Process(pid)
+        times = proc.get_cpu_times()
+        return {'cpu_time': times.user + times.system,
+                'threads': proc.get_num_threads()}
+
+    def io_counters(self, pid):
+        counters = psutil.Process(pid).get_io_counters()
+        return {'read_bytes': counters.read_bytes,
+                'write_bytes': counters.write_bytes}
+
+    def fd_count(self, pid):
+        return psutil.Process(pid).get_num_fds()
+
+
+BACKENDS = {
+    'procfs': ProcfsBackend,
+    'psutil': PsutilBackend,
+    }
+
+_backend = None
+_table = None
+_collector = None
+
+
+def set_backend(name):
+    """Select the snapshot backend by name, see BACKENDS."""
+
+    global _backend, _table
+
+    if name not in BACKENDS:
+        raise ValueError('unknown snapshot backend %r' % (name,))
+    backend = BACKENDS[name]()
+    if not backend.available():
+        raise ValueError('snapshot backend %r is not available' % (name,))
+    _backend = backend
+    _table = None
+
+
+def set_collector(collector):
+    """Read processes in parallel on collector, a
+    collector.Collector, or serially if None.
+    """
+
+    global _collector
+
+    _collector = collector
+    if _table is not None:
+        _table.collector = collector
+
+
+def get_backend():
+    """Returns the snapshot backend in use. Defaults to reading /proc
+    directly, falling back to psutil if /proc is not available.
+    """
+
+    global _backend
+
+    if _backend is None:
+        backend = ProcfsBackend()
+        if not backend.available():
+            log.warning('%s not available, using psutil', PROC_ROOT)
+            backend = PsutilBackend()
+        _backend = backend
+    return _backend
+
+
+class Snapshot(object):
+    """A snapshot of running processes.
+
+    tree is a dict from pid to a set of children, cmdlines a dict from
+    pid to cmdline and start_times a dict from pid to process start
+    time. spawned and exited are the sets of pids that appeared and
+    disappeared since the previous snapshot. A pid that was reused is
+    in both.
+
+    For backwards compatibility a snapshot unpacks as (tree, cmdlines).
+    """
+
+    def __init__(self, tree, cmdlines, start_times=None, spawned=None, exited=None):
+        self.tree = tree
+        self.cmdlines = cmdlines
+        self.start_times = start_times if start_times is not None else {}
+        self.spawned = spawned if spawned is not None else set(cmdlines)
+        self.exited = exited if exited is not None else set()
+
+        # Euler tour of the tree, see _index.
+        self.order = None
+        self.spans = None
+
+    def __iter__(self):
+        return iter((self.tree, self.cmdlines))
+
+    def _index(self):
+        """Lay out the tree in depth first order, so that the
+        descendants of a pid are the slice order[start + 1:end] where
+        (start, end) = spans[pid]. Done iteratively, once per snapshot.
+        """
+
+        tree = self.tree
+        order = []
+        spans = {}
+
+        children = set()
+        for cpids in tree.itervalues():
+            children.update(cpids)
+        roots = [pid for pid in tree if pid not in children]
+
+        for root in sorted(roots):
+            # Stack of (pid, iterator over children).
+            spans[root] = len(order)
+            order.append(root)
+            stack = [(root, iter(tree[root]))]
+            while stack:
+                pid, it = stack[-1]
+                for cpid in it:
+                    if cpid in spans:
+                        continue
+                    spans[cpid] = len(order)
+                    order.append(cpid)
+                    stack.append((cpid, iter(tree.get(cpid, ()))))
+                    break
+                else:
+                    stack.pop()
+                    spans[pid] = (spans[pid], len(order))
+
+        self.order = order
+        self.spans = spans
+
+    def span(self, pid):
+        """Returns (start, end) such that order[start] is pid and
+        order[start + 1:end] its descendants, or None.
+        """
+
+        if self.spans is None:
+            self._index()
+        return self.spans.get(pid)
+
+    def descendants(self, pid):
+        """Returns a list of all descendants of pid."""
+
+        span = self.span(pid)
+        if span is None:
+            return []
+        return self.order[span[0] + 1:span[1]]
+
+
+class ProcessTable(object):
+    """Process table kept up to date across snapshots.
+
+    Processes are identified by (pid, start time), so pid reuse is
+    detected. The cmdline is only read for new processes, or when the
+    comm changes (the process exec'd), and parent/child links are only
+    touched when the parent changes. The /proc directory still has to
+    be listed and every stat read, but the rest of the work is
+    proportional to process churn rather than the number of processes.
+
+    An exec keeping the comm (python running python), or a process
+    rewriting its argv (setproctitle), does not change the comm. So
+    the cmdline of a process that was first seen with the cmdline of
+    its parent, between fork and exec, is read again for the next
+    UNSETTLED_SCANS rescans. Every cmdline is read again once per
+    CMDLINE_REFRESH rescans, spread over the rescans.
+
+    The table can also be kept up to date from process events, see
+    on_fork, on_exec and on_exit, in which case no rescan is needed.
+
+    Given a collector.Collector, a rescan reads the processes on its
+    workers. Processes that could not be read in time are kept as they
+    were.
+    """
+
+    CMDLINE_REFRESH = 30
+    UNSETTLED_SCANS = 3
+
+    def __init__(self, backend=None, collector=None):
+        self.backend = backend
+        self.collector = collector
+        self.tree = {}
+        self.cmdlines = {}
+        self.start_times = {}
+        self.comms = {}
+        self.ppids = {}
+        # {pid: rescans left} of processes with the cmdline of their
+        # parent.
+        self.unsettled = {}
+        self.scans = 0
+
+        # Changes since the last snapshot.
+        self.spawned = set()
+        self.exited = set()
+
+    def _backend(self):
+        if self.backend is None:
+            return get_backend()
+        return self.backend
+
+    def _add(self, pid, start_time, comm, cmdline):
+        self.cmdlines[pid] = cmdline
+        self.start_times[pid] = start_time
+        self.comms[pid] = comm
+        if pid not in self.tree:
+            self.tree[pid] = set()
+        self.spawned.add(pid)
+
+    def _link(self, pid, ppid):
+        tree = self.tree
+        old_ppid = self.ppids.get(pid)
+        if old_ppid != ppid:
+            if old_ppid is not None and old_ppid in tree:
+                tree[old_ppid].discard(pid)
+            self.ppids[pid] = ppid
+            if ppid not in tree:
+                tree[ppid] = set()
+            tree[ppid].add(pid)
+
+    def _forget(self, pid, reused=False):
+        del self.cmdlines[pid]
+        del self.start_times[pid]
+        del self.comms[pid]
+        self.unsettled.pop(pid, None)
+        ppid = self.ppids.pop(pid)
+        if ppid in self.tree:
+            self.tree[ppid].discard(pid)
+        if not reused:
+            # Any children were reparented, which is picked up when
+            # scanning them.
+            self.tree.pop(pid, None)
+        # A reused pid is added to spawned again once read.
+        self.spawned.discard(pid)
+        self.exited.add(pid)
+
+    def _changed(self, info):
+        """Returns True if the cmdline of the process in info needs to
+        be read."""
+
+        pid = info[0]
+        if self.start_times.get(pid) != info[2] or self.comms[pid] != info[3]:
+            return True
+        return pid in self.unsettled or (pid + self.scans) % self.CMDLINE_REFRESH == 0
+
+    def _refresh(self, info, cmdlines=None):
+        """Bring a single process up to date given (pid, ppid,
+        start_time, comm) from the backend. Returns False if the
+        process could not be read. The cmdline is taken from cmdlines,
+        if read already.
+        """
+
+        pid, ppid, start_time, comm = info
+        known = self.start_times.get(pid)
+        if known != start_time:
+            if known is not None:
+                self._forget(pid, reused=True)
+            if cmdlines is not None:
+                cmdline = cmdlines.get(pid)
+            else:
+                cmdline = self._backend().cmdline(pid)
+            if cmdline is None:
+                return False
+            self._add(pid, start_time, comm, cmdline)
+        elif self._changed(info):
+            if cmdlines is not None:
+                cmdline = cmdlines.get(pid)
+            else:
+                cmdline = self._backend().cmdline(pid)
+            if cmdline is not None:
+                self.cmdlines[pid] = cmdline
+                self.comms[pid] = comm
+            left = self.unsettled.pop(pid, 0) - 1
+            if left > 0 and cmdline == self.cmdlines.get(ppid):
+                self.unsettled[pid] = left
+        self._link(pid, ppid)
+        return True
+
+    def update(self):
+        """Rescan processes and return a Snapshot."""
+
+        self.scans += 1
+        if self.collector is not None:
+            alive = self._scan_parallel()
+        else:
+            alive = set()
+            for info in self._backend().scan():
+                if self._refresh(info):
+                    alive.add(info[0])
+
+        for pid in set(self.start_times) - alive:
+            self._forget(pid)
+
+        # After the scan, when the parents are known.
+        cmdlines = self.cmdlines
+        for pid in self.spawned:
+            cmdline = cmdlines[pid]
+            if cmdline and cmdline == cmdlines.get(self.ppids[pid]):
+                self.unsettled[pid] = self.UNSETTLED_SCANS
+
+        return self.snapshot()
+
+    def _scan_parallel(self):
+        """Read the stat of all processes, and the cmdline of new and
+        exec'd ones, on the collector. Returns the set of pids alive or
+        too slow to tell.
+        """
+
+        backend = self._backend()
+        collector = self.collector
+        infos, slow = collector.map(backend.stat, backend.pids())
+        changed = [info[0] for info in infos.itervalues()
+                   if info is not None and self._changed(info)]
+        cmdlines, slow_cmdlines = collector.map(backend.cmdline, changed)
+
+        alive = set(pid for pid in slow if pid in self.start_times)
+        for pid, info in infos.iteritems():
+            if info is None:
+                continue
+            if pid in slow_cmdlines:
+                if self.start_times.get(pid) == info[2]:
+                    alive.add(pid)
+                continue
+            if self._refresh(info, cmdlines):
+                alive.add(pid)
+        return alive
+
+    def on_fork(self, pid):
+        """A process was created. Returns True if it was added."""
+
+        info = self._backend().stat(pid)
+        if info is None:
+            return False
+        return self._refresh(info)
+
+    def on_exec(self, pid):
+        """A process exec'd. Returns True if it is in the table."""
+
+        info = self._backend().stat(pid)
+        if info is None:
+            return False
+        if pid in self.comms:
+            # Force a re-read of the cmdline.
+            self.comms[pid] = None
+        return self._refresh(info)
+
+    def on_exit(self, pid):
+        """A process exited."""
+
+        if pid in self.start_times:
+            children = list(self.tree.get(pid, ()))
+            self._forget(pid)
+            # The kernel reparents them to init, or a subreaper, which
+            # the next rescan picks up. Until then they stay in the
+            # tree below init.
+            for child in children:
+                if child in self.ppids:
+                    self._link(child, 1)
+
+    def snapshot(self):
+        """Returns a Snapshot of the table, with the changes since the
+        previous snapshot. The dicts in the snapshot are owned by the
+        table and are changed in place as the table is updated.
+        """
+
+        spawned, exited = self.spawned, self.exited
+        self.spawned = set()
+        self.exited = set()
+        return Snapshot(self.tree, self.cmdlines, self.start_times, spawned, exited)
+
+
+def get_table():
+    """Returns the process table used by get_snapshot."""
+
+    global _table
+
+    if _table is None:
+        _table = ProcessTable(collector=_collector)
+    return _table
+
+
+def get_snapshot(backend=None):
+    """Returns a Snapshot of currently running processes, see above.
+    It unpacks as (tree, cmdlines) where tree is a dict from pid to a
+    set of children, and cmdlines is a dict from pid to cmdline.
+
+    Without a backend, state is kept between calls so only changes
+    are read. Given a backend, a full one-off snapshot is made.
+    """
+
+    if backend is not None:
+        return ProcessTable(backend).update()
+    return get_table().update()
 
 
 def walk_children(tree, pid):
     """Yields all children of pid given in tree (returned from
-    get_snapshot above).
+    get_snapshot above), depth first.
     """
 
-    for cpid in tree[pid]:
-        yield cpid
-        for ccpid in walk_children(tree, cpid):
-            yield ccpid
+    stack = [iter(tree[pid])]
+    while stack:
+        for cpid in stack[-1]:
+            yield cpid
+            stack.append(iter(tree.get(cpid, ())))
+            break
+        else:
+            stack.pop()
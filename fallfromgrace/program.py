@@ -3,20 +3,37 @@
 # Copyright (c) 2012 Björn Edström <be@bjrn.se>
 # See LICENSE for details.
 
+import cProfile
 import errno
+import hashlib
+import json
 import logging
 import operator
 import os
+import pstats
 import re
+import select
 import signal
+import StringIO
 import subprocess
 import time
 
+import fallfromgrace.cgroup as cgroup
+import fallfromgrace.collector as collector
 import fallfromgrace.config
+import fallfromgrace.executor as executor
+import fallfromgrace.history as history
+import fallfromgrace.inotify as inotify
+import fallfromgrace.matcher as matcher
+import fallfromgrace.metrics as metrics
 import fallfromgrace.number as number
 import fallfromgrace.parser_action as parser_action
 import fallfromgrace.parser_trigger as parser_trigger
+import fallfromgrace.proc_events as proc_events
 import fallfromgrace.process as process
+import fallfromgrace.psi as psi
+import fallfromgrace.ratelimit as ratelimit
+import fallfromgrace.stats as stats
 import fallfromgrace.orderedyaml as orderedyaml
 
 log = logging.getLogger('fall-from-grace')
@@ -39,6 +56,10 @@ class Monitor(object):
         # cmdline.
         self.cmdline = None
 
+        # _sre.SRE_Pattern: compiled regex matching on cgroup path,
+        # for monitors on cgroups instead of processes.
+        self.cgroup = None
+
         # [(Trigger, Action)]: list of tuples (trigger, action).
         self.actions = None
 
@@ -48,17 +69,52 @@ class Monitor(object):
         # if this monitor triggers, do not consider other monitors.
         self.final = False
 
+        # set: the variables referenced by the triggers.
+        self.variables = set()
+
+        # set: the variables read whatever the outcome of the triggers,
+        # which can be read ahead.
+        self.required = set()
+
+        # if set, one of metrics.AGGREGATES: evaluate triggers on the
+        # variables aggregated over the process and its descendants.
+        self.aggregate = None
+
+        # act on the 'root' process only, or the whole 'tree'.
+        self.target = 'root'
+
+        # the YAML fragment this monitor was loaded from, to tell
+        # whether it changed on reload.
+        self.conf = None
+
     def __repr__(self):
-        return '<Monitor name=%r cmdline=%r actions=%r check_children=%r final=%r>' % (
-            self.name, self.cmdline, self.actions, self.check_children, self.final)
+        return '<Monitor name=%r cmdline=%r cgroup=%r actions=%r check_children=%r final=%r aggregate=%r>' % (
+            self.name, self.cmdline, self.cgroup, self.actions, self.check_children, self.final,
+            self.aggregate)
+
+
+def divide(a, b):
+    """Division for triggers, where anything divided by zero is 0."""
+
+    if not b:
+        return 0
+    return float(a) / b
 
 
 class Trigger(object):
     """Class implements safe evaluation of some expressions given an
-    environment. Currently supports comparison of integers, such as:
-
-    t = Trigger('a < 123')
-    True == t.evaluate({'a': 20})
+    environment. Supports comparisons of arithmetic on integers,
+    combined with "and", "or" and "not", such as:
+
+    t = Trigger('a + b < 123 and not c > 1')
+    True == t.evaluate({'a': 20, 'b': 3, 'c': 0})
+
+    The expression is compiled to a closure once, so evaluation does
+    not need to look at the parsed expression. The operands of "and"
+    and "or" are evaluated cheapest first, by metrics.cost, and the
+    rest only if needed, so an expensive variable is not read when a
+    cheap one decides the outcome. Variables computed against earlier
+    samples, such as rates, are read on every evaluation regardless.
     """
 
     OPS = {
@@ -67,6 +123,10 @@ class Trigger(object):
         '>': operator.gt,
         '<=': operator.le,
         '>=': operator.ge,
+        '+': operator.add,
+        '-': operator.sub,
+        '*': operator.mul,
+        '/': divide,
         }
 
     def __init__(self, expr):
@@ -75,29 +135,148 @@ class Trigger(object):
             self.expr = parser_trigger.parse(expr)
         except Exception, e:
             raise ConfigException('parse error %r: %s' % (expr, e))
+        self.variables = set()
+        self._evaluate = self._compile(self.expr)
+        # The variables read by every evaluation, whatever the values.
+        required = self._required(self.expr)
+        # Sampled variables that could be skipped, read before
+        # evaluating.
+        self.sampled = [var for var in sorted(self.variables)
+                        if metrics.is_sampled(var) and var not in required]
+        self.required = required | set(self.sampled)
 
     def __str__(self):
         return self.s
 
-    def evaluate(self, env):
-        # Set variables
-        new = []
-        for tok in self.expr:
-            val = tok
-            if val in env:
-                val = env[val]
-            new.append(val)
+    def __getstate__(self):
+        # The closure cannot be pickled. It is compiled again from the
+        # parsed expression, without parsing.
+        state = dict(self.__dict__)
+        del state['_evaluate']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.variables = set()
+        self._evaluate = self._compile(self.expr)
+
+    def _leaves(self, expr):
+        """Returns the set of variables in expr."""
+
+        if isinstance(expr, basestring):
+            return set([expr])
+        if isinstance(expr, tuple):
+            leaves = set()
+            for operand in expr[::2] if len(expr) == 3 else expr[1:]:
+                leaves |= self._leaves(operand)
+            return leaves
+        return set()
+
+    def _ordered(self, expr):
+        """Returns the operands of a chain of "and" or "or", such as
+        "a and b and c", cheapest first.
+        """
+
+        op_str = expr[1]
+        operands = []
+        todo = [expr]
+        while todo:
+            e = todo.pop()
+            if isinstance(e, tuple) and len(e) == 3 and e[1] == op_str:
+                todo.extend((e[2], e[0]))
+            else:
+                operands.append(e)
+        # sorted is stable: equally cheap operands keep their order.
+        return sorted(operands, key=lambda e: metrics.cost(self._leaves(e)))
+
+    def _required(self, expr):
+        if isinstance(expr, tuple):
+            if len(expr) == 3 and expr[1] in ('and', 'or'):
+                return self._required(self._ordered(expr)[0])
+            if len(expr) == 2:
+                return self._required(expr[1])
+        return self._leaves(expr)
+
+    def _compile(self, expr):
+        # Rates and metrics.FRACTIONAL are fractional, other values
+        # are integers.
+        def conv(tok):
+            if tok.startswith('rate(') or tok in metrics.FRACTIONAL:
+                return float
+            return int
+
+        if isinstance(expr, basestring):
+            self.variables.add(expr)
+            vconv = conv(expr)
+            def evaluate(env):
+                return vconv(env[expr])
+            return evaluate
+
+        if isinstance(expr, (int, long, float)):
+            if not isinstance(expr, float):
+                expr = int(expr)
+            def evaluate(env):
+                return expr
+            return evaluate
+
+        if not isinstance(expr, tuple) or len(expr) not in (2, 3):
+            raise ConfigException('unknown trigger %s' % self.s)
+
+        if len(expr) == 2:
+            if expr[0] != 'not':
+                raise ConfigException('unknown trigger %s' % self.s)
+            operand = self._compile(expr[1])
+            def evaluate(env):
+                return not operand(env)
+            return evaluate
+
+        lhs, op_str, rhs = expr
+        if op_str in ('and', 'or'):
+            operands = [self._compile(e) for e in self._ordered(expr)]
+            if op_str == 'and':
+                def evaluate(env):
+                    for operand in operands:
+                        if not operand(env):
+                            return False
+                    return True
+            else:
+                def evaluate(env):
+                    for operand in operands:
+                        if operand(env):
+                            return True
+                    return False
+            return evaluate
+
+        if op_str not in self.OPS:
+            raise ConfigException('unknown trigger %s' % self.s)
+        op = self.OPS[op_str]
+
+        # Most triggers are a variable against a number: look it up
+        # directly instead of through a closure per operand.
+        if isinstance(lhs, basestring) and isinstance(rhs, (int, long, float)):
+            self.variables.add(lhs)
+            lconv = conv(lhs)
+            if not isinstance(rhs, float):
+                rhs = int(rhs)
+            def evaluate(env):
+                return op(lconv(env[lhs]), rhs)
+            return evaluate
+
+        lhs, rhs = self._compile(lhs), self._compile(rhs)
+        def evaluate(env):
+            return op(lhs(env), rhs(env))
+        return evaluate
 
+    def evaluate(self, env):
         try:
-            op_str = new[1]
-            if op_str in self.OPS:
-                op_func = self.OPS[op_str]
-                return op_func(int(new[0]), int(new[2]))
+            for var in self.sampled:
+                env[var]
+            return self._evaluate(env)
+        except metrics.MetricError:
+            raise
         except Exception, e:
             raise ConfigException('unknown trigger %s: %s' % (self.s, e))
 
-        raise ConfigException('unknown trigger %s' % self.s)
-
 
 class Action(object):
     """This class represents an action to take on a program.
@@ -107,87 +286,98 @@ class Action(object):
         self.action_str = action_str
         self.action_list = parser_action.parse(action_str)
 
-        # TODO (bjorn): Have a global state instead of per-action?
-        self.exec_state = {}
+        # Seconds between actions on the same process, if limited.
+        self.interval = None
+        if '@' in self.action_list:
+            self.interval = self.action_list[2]
 
     def __str__(self):
         return self.action_str
 
-    def action(self, pid, name):
-        """Perform this action on the given pid.
+    def action(self, pid, name, group=(), start_time=None, cgroup=None,
+               executor=None, limiter=None):
+        """Perform this action on the given pid. Signals are also sent
+        to the pids in group. Actions with "@ TIME" are taken at most
+        once per TIME for each process, identified by pid and
+        start_time, as kept by limiter, a ratelimit.RateLimiter (if
+        none is given they are not limited).
+
+        Given cgroup, a cgroup.Cgroup, the action is on the processes
+        in it instead, and limited per cgroup.
+
+        exec actions are run by executor, an executor.Executor, if
+        given. Signals are always sent directly.
 
         Will either succeed or log and error.
         """
 
         what = self.action_list[0]
 
+        owner = pid
+        if cgroup is not None:
+            owner, start_time = cgroup.path, cgroup.id
+
+        key = None
+        if self.interval is not None and limiter is not None:
+            key = (name, self.action_str, owner, start_time)
+            if not limiter.allow(key, time.time()):
+                return False
+
+        if cgroup is not None:
+            pids = cgroup.procs()
+            if not pids and what != 'exec':
+                return False
+            pid, group = (pids[0], pids[1:]) if pids else ('', ())
+
         try:
             if what == 'exec':
-                return self._execute(pid, name)
+                run = self._execute(pid, name, cgroup, executor)
             elif what == 'kill':
-                return self._signal(pid, name, signal.SIGKILL)
+                run = self._signal(pid, name, signal.SIGKILL, group)
             elif what == 'term':
-                return self._signal(pid, name, signal.SIGTERM)
+                run = self._signal(pid, name, signal.SIGTERM, group)
             elif what == 'stop':
-                return self._signal(pid, name, signal.SIGSTOP)
+                run = self._signal(pid, name, signal.SIGSTOP, group)
         except Exception, e:
-            log.warning('action failed for %s with %s', pid, e)
-
-    def _execute(self, pid, name):
-        prog = self.action_list[-1]
-        state_key = '%s %s' % (name, prog)
-        at = None
-        last = self.exec_state.get(state_key, 0)
-
-        if '@' in self.action_list:
-            at = self.action_list[2]
-
-        run = False
-        if at is None:
-            run = True
-        elif at is not None:
-            if time.time() - last > at:
-                run = True
-
-        if run:
-            prog_expand = prog
-            prog_expand = prog_expand.replace('$PID', str(pid))
-            prog_expand = prog_expand.replace('$NAME', name)
-
-            self._do_exec(prog_expand)
-
-            self.exec_state[state_key] = time.time()
+            log.warning('action failed for %s with %s', owner, e)
+            return None
 
+        if run and key is not None:
+            limiter.record(key, owner, self.interval, time.time())
         return run
 
-    def _signal(self, pid, name, sig):
-        state_key = '%s %s' % (name, sig)
-        at = None
-        last = self.exec_state.get(state_key, 0)
+    def _execute(self, pid, name, cgroup=None, executor=None):
+        prog = self.action_list[-1]
+        prog_expand = prog
+        prog_expand = prog_expand.replace('$PID', str(pid))
+        prog_expand = prog_expand.replace('$NAME', name)
+        if cgroup is not None:
+            prog_expand = prog_expand.replace('$CGROUP', cgroup.path)
 
-        if '@' in self.action_list:
-            at = self.action_list[2]
+        if self._do_exec(prog_expand, executor) is False:
+            # Dropped, try again next time.
+            return False
+        return True
 
-        run = False
-        if at is None:
-            run = True
-        elif at is not None:
-            if time.time() - last > at:
-                run = True
+    def _signal(self, pid, name, sig, group=()):
+        self._do_signal(pid, sig)
 
-        if run:
+        for gpid in group:
             try:
-                self._do_signal(pid, sig)
+                self._do_signal(gpid, sig)
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    log.warning('failed to signal %s: %s', gpid, e)
 
-                self.exec_state[state_key] = time.time()
-            except Exception, e:
-                # Handle above
-                raise
+        return True
 
-        return run
+    def _do_exec(self, prog, executor=None):
+        """Wrapper for unit testing. Runs prog in the background if there
+        is an executor, else waits for it.
+        """
 
-    def _do_exec(self, prog):
-        """Wrapper for unit testing."""
+        if executor is not None:
+            return executor.submit(prog)
 
         # TODO (bjorn): Security implications!!!
         subprocess.call(prog, shell=True)
@@ -208,37 +398,110 @@ class Configuration(object):
       cmdline: <regex>
       actions:
         <Trigger>: <Action>
+
+    or, for a cgroup (v2) rather than processes:
+
+    <name>:
+      cgroup: <regex>
+      actions:
+        <Trigger>: <Action>
     """
 
+    CONF_PATH = '/etc/fall-from-grace.conf'
+    DOT_D_PATH = '/etc/fall-from-grace.d'
+
+    # The parsed config is cached here between restarts, as JSON. Bump
+    # the version when the format changes.
+    CACHE_PATH = '/var/lib/fall-from-grace/config.cache'
+    CACHE_VERSION = 4
+
     def __init__(self):
         # TODO (bjorn): Encapsulate this?
         self.monitor = []
 
-    def validate_trigger(self, trigger):
+        # matcher.Matcher: finds the monitors matching a cmdline.
+        self.matcher = matcher.Matcher([])
+
+        # The monitors on cgroups, in order.
+        self.cgroups = []
+
+        # The yaml the monitors were loaded from.
+        self.yaml_str = None
+
+        # The cache key of what is in CACHE_PATH, if we know it.
+        self.cache_key = None
+
+        # Contents of the config files, so only changed files are read
+        # on reload.
+        self.files = fallfromgrace.config.FileCache()
+
+    def validate_trigger(self, trigger, variables=metrics.VARIABLES,
+                         aggregates=metrics.AGGREGATE_VARIABLES):
+        """Returns the Trigger for the string trigger, or raises."""
+
         trig = Trigger(trigger)
-        trig.evaluate({'rmem': 0, 'vmem': 0})
+        for var in trig.variables:
+            if not metrics.is_variable(var, variables) and var not in aggregates:
+                raise ConfigException('unknown variable %s' % var)
+        trig.evaluate(dict.fromkeys(trig.variables, 0))
+        return trig
 
     def validate_action(self, action):
-        action = Action(action)
+        """Returns the Action for the string action, or raises."""
+
+        return Action(action)
+
+    def load(self, yaml_str, conf=None):
+        """Read config yaml from the string given, or use conf, the
+        yaml already parsed.
 
-    def load(self, yaml_str):
-        """Read config yaml from the string given."""
+        Monitors whose fragment is unchanged since the last load are
+        kept as they are, and so is the matcher (and its cache) if no
+        monitor changed.
+        """
+
+        if yaml_str == self.yaml_str:
+            log.info('config file unchanged')
+            return
 
-        conf = orderedyaml.load(yaml_str)
+        if conf is None:
+            conf = orderedyaml.load(yaml_str)
+        old = dict((m.name, m) for m in self.monitor)
         monitor = []
+        added = []
+        modified = []
 
         for name, monitor_conf in conf.iteritems():
-            m = self.load_fragment(name, monitor_conf)
+            m = old.get(name)
+            if m is None or m.conf != monitor_conf:
+                if m is None:
+                    added.append(name)
+                else:
+                    modified.append(name)
+                m = self.load_fragment(name, monitor_conf)
             monitor.append(m)
 
         # success
         log.info('successfully read config file: monitors %s', ' '.join(m.name for m in monitor))
-
+        if self.yaml_str is not None:
+            removed = [m.name for m in self.monitor if m.name not in conf]
+            log.info('config changes: %d added %s, %d modified %s, %d removed %s, %d unchanged',
+                     len(added), ' '.join(added), len(modified), ' '.join(modified),
+                     len(removed), ' '.join(removed), len(monitor) - len(added) - len(modified))
+
+        if monitor != self.monitor:
+            self.matcher = matcher.Matcher([m for m in monitor if m.cmdline is not None],
+                                           literals=self.matcher.literals)
+            self.cgroups = [m for m in monitor if m.cgroup is not None]
         self.monitor = monitor
+        self.yaml_str = yaml_str
 
     def load_fragment(self, name, monitor_conf):
         """Load part of the config file with validation."""
 
+        if 'cgroup' in monitor_conf:
+            return self.load_cgroup_fragment(name, monitor_conf)
+
         if not 'cmdline' in monitor_conf:
             raise ConfigException('failed to read config file: %s has no "cmdline"' % name)
 
@@ -251,17 +514,19 @@ class Configuration(object):
         try:
             cmdline = re.compile(monitor_conf['cmdline'])
         except Exception, e:
-            raise ConfigException('failed to compile cmdline %r: %s' % (cmdline, e))
+            raise ConfigException('failed to compile cmdline %r: %s' % (monitor_conf['cmdline'], e))
 
-        for trigger, action in monitor_conf['actions'].iteritems():
+        actions = []
+        for trigger_str, action_str in monitor_conf['actions'].iteritems():
             try:
-                self.validate_action(action)
+                action = self.validate_action(action_str)
             except Exception, e:
-                raise ConfigException('invalid action: %s' % action)
+                raise ConfigException('invalid action: %s' % action_str)
             try:
-                self.validate_trigger(trigger)
+                trigger = self.validate_trigger(trigger_str)
             except Exception, e:
-                raise ConfigException('invalid trigger: %s - %s' % (trigger, e))
+                raise ConfigException('invalid trigger: %s - %s' % (trigger_str, e))
+            actions.append((trigger, action))
 
         check_children = None
         if 'children' in monitor_conf:
@@ -277,26 +542,81 @@ class Configuration(object):
             if final not in (True, False):
                 raise ConfigException('invalid value for "final", must be boolean')
 
+        aggregate = monitor_conf.get('aggregate')
+        if aggregate is not None:
+            if aggregate not in metrics.AGGREGATES:
+                raise ConfigException('invalid value for "aggregate", must be one of %s' %
+                                      ', '.join(metrics.AGGREGATES))
+            if check_children:
+                raise ConfigException('"aggregate" and "children" cannot be combined')
+
+        target = monitor_conf.get('target', 'root')
+        if target not in ('root', 'tree'):
+            raise ConfigException('invalid value for "target", must be root or tree')
+
         m = Monitor()
         m.name = name
+        m.conf = monitor_conf
         m.cmdline = cmdline
         m.actions = []
         if check_children is not None:
             m.check_children = check_children
         if final is not None:
             m.final = final
+        m.aggregate = aggregate
+        m.target = target
+
+        for trigger, action in actions:
+            m.actions.append((trigger, action))
+            m.variables.update(trigger.variables)
+            m.required.update(trigger.required)
+
+        if m.aggregate is None and m.variables & metrics.AGGREGATE_VARIABLES:
+            raise ConfigException('%s: %s only available with "aggregate"' % (
+                    name, ', '.join(m.variables & metrics.AGGREGATE_VARIABLES)))
+        system = set(map(metrics.base_variable, m.variables)) & metrics.SYSTEM_VARIABLES
+        if m.aggregate is not None and system:
+            raise ConfigException('%s: %s cannot be aggregated' % (name, ', '.join(system)))
+        return m
+
+    def load_cgroup_fragment(self, name, monitor_conf):
+        """Load a monitor on cgroups with validation."""
+
+        for key in ('cmdline', 'children', 'aggregate', 'target'):
+            if key in monitor_conf:
+                raise ConfigException('failed to read config file: %s: "cgroup" and "%s" '
+                                      'cannot be combined' % (name, key))
+
+        if not monitor_conf.get('actions'):
+            raise ConfigException('failed to read config file: %s has no "actions"' % name)
 
+        try:
+            path = re.compile(monitor_conf['cgroup'])
+        except Exception, e:
+            raise ConfigException('failed to compile cgroup %r: %s' % (monitor_conf['cgroup'], e))
+
+        final = monitor_conf.get('final', False)
+        if final not in (True, False):
+            raise ConfigException('invalid value for "final", must be boolean')
+
+        m = Monitor()
+        m.name = name
+        m.conf = monitor_conf
+        m.cgroup = path
+        m.final = final
+        m.actions = []
         for trigger_str, action_str in monitor_conf['actions'].iteritems():
             try:
-                trigger = Trigger(trigger_str)
+                action = self.validate_action(action_str)
             except Exception, e:
-                raise ConfigException('failed to parse trigger %r: %s' % (trigger_str, e))
+                raise ConfigException('invalid action: %s' % action_str)
             try:
-                action = Action(action_str)
+                trigger = self.validate_trigger(trigger_str, metrics.CGROUP_VARIABLES, ())
             except Exception, e:
-                raise ConfigException('failed to parse action %r: %s' % (action_str, e))
-
+                raise ConfigException('invalid trigger: %s - %s' % (trigger_str, e))
             m.actions.append((trigger, action))
+            m.variables.update(trigger.variables)
+            m.required.update(trigger.required)
         return m
 
     def load_from_file(self):
@@ -305,13 +625,13 @@ class Configuration(object):
         try:
             conf_data = ''
             try:
-                conf_data = file('/etc/fall-from-grace.conf', 'r').read()
+                conf_data = self.files.read(self.CONF_PATH)
             except:
                 pass
 
             dot_d = ''
             try:
-                dot_d = fallfromgrace.config.read_dot_d('/etc/fall-from-grace.d')
+                dot_d = fallfromgrace.config.read_dot_d(self.DOT_D_PATH, self.files)
             except OSError, e:
                 if e.errno == errno.ENOENT:
                     pass
@@ -320,9 +640,15 @@ class Configuration(object):
 
             conf_cat = '\n'.join([conf_data, dot_d])
             if not conf_cat.strip():
-                raise IOError(errno.ENOENT, '/etc/fall-from-grace.conf or /etc/fall-from-grace.d does not exist')
+                raise IOError(errno.ENOENT, '%s or %s does not exist' % (
+                        self.CONF_PATH, self.DOT_D_PATH))
 
+            key = self.make_cache_key(conf_cat)
+            if self.yaml_str is None and self.load_cache(key, conf_cat):
+                return
             self.load(conf_cat)
+            if key != self.cache_key:
+                self.save_cache(key)
         except Exception, e:
             log.error('failed to read config file: %s', e)
             if self.monitor:
@@ -330,6 +656,109 @@ class Configuration(object):
                          ' '.join(m.name for m in self.monitor))
             return
 
+    def make_cache_key(self, yaml_str):
+        """Returns the cache key for yaml_str, read from the config
+        files: the cache version, the hash of yaml_str and the mtimes of
+        the files."""
+
+        mtimes = []
+        paths = [self.CONF_PATH]
+        try:
+            paths.extend(os.path.join(self.DOT_D_PATH, name)
+                         for name in sorted(os.listdir(self.DOT_D_PATH)))
+        except OSError:
+            pass
+        for path in paths:
+            try:
+                mtimes.append((path, os.stat(path).st_mtime))
+            except OSError:
+                pass
+        return (self.CACHE_VERSION, hashlib.sha1(yaml_str).hexdigest(), mtimes)
+
+    def load_cache(self, key, yaml_str):
+        """Use the parsed config in CACHE_PATH, if it is for key. It is
+        validated like the config files. Returns True if it was used.
+        """
+
+        try:
+            fd = os.open(self.CACHE_PATH, os.O_RDONLY | os.O_NOFOLLOW)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                log.warning('cannot read config cache %s: %s', self.CACHE_PATH, e)
+            return False
+        f = os.fdopen(fd, 'rb')
+        try:
+            try:
+                # Only trust a cache that no one but us could have
+                # written.
+                for st in (os.fstat(fd), os.stat(os.path.dirname(self.CACHE_PATH))):
+                    if st.st_uid != os.geteuid() or st.st_mode & 0o022:
+                        raise ValueError('not owned by us, or writable by others')
+                cached = json.load(f, object_pairs_hook=orderedyaml.OrderedDict)
+                if cached['key'] != json.loads(json.dumps(key)):
+                    return False
+                conf = orderedyaml.OrderedDict((name, _from_json(monitor_conf))
+                                   for name, monitor_conf in cached['conf'])
+                self.load(yaml_str, conf)
+            finally:
+                f.close()
+        except Exception, e:
+            log.warning('cannot read config cache %s: %s', self.CACHE_PATH, e)
+            return False
+
+        self.cache_key = key
+        log.info('successfully read config cache %s', self.CACHE_PATH)
+        return True
+
+    def save_cache(self, key):
+        """Write the parsed config to CACHE_PATH."""
+
+        try:
+            data = json.dumps({'key': key,
+                               'conf': [(m.name, m.conf) for m in self.monitor]})
+        except (TypeError, ValueError), e:
+            log.warning('cannot write config cache %s: %s', self.CACHE_PATH, e)
+            return
+
+        tmp = self.CACHE_PATH + '.tmp'
+        try:
+            try:
+                os.unlink(tmp)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            os.rename(tmp, self.CACHE_PATH)
+        except (IOError, OSError), e:
+            # The directory does not exist when not run as a daemon.
+            level = logging.WARNING
+            if getattr(e, 'errno', None) == errno.ENOENT:
+                level = logging.DEBUG
+            log.log(level, 'cannot write config cache %s: %s', self.CACHE_PATH, e)
+            return
+        self.cache_key = key
+
+
+def _from_json(obj):
+    """Returns obj, loaded from JSON, with strings as yaml loads them:
+    str if ascii, else unicode."""
+
+    if isinstance(obj, unicode):
+        try:
+            return obj.encode('ascii')
+        except UnicodeError:
+            return obj
+    if isinstance(obj, list):
+        return [_from_json(item) for item in obj]
+    if isinstance(obj, dict):
+        return orderedyaml.OrderedDict((_from_json(k), _from_json(v)) for k, v in obj.iteritems())
+    return obj
+
 
 class FallFromGrace(object):
     """Main program class for fall-from-grace.
@@ -339,16 +768,190 @@ class FallFromGrace(object):
     # Number of seconds between process enumeration / rule evaluation.
     SLEEP_TIME = 10
 
+    # Number of seconds between full rescans of all processes, when
+    # process events are used to keep the process table up to date.
+    RESCAN_TIME = 120
+
+    # Number of ticks to profile on SIGUSR1, where to write the stats,
+    # and the number of functions to log.
+    PROFILE_TICKS = 5
+    PROFILE_DIR = '/var/lib/fall-from-grace'
+    PROFILE_TOP = 20
+
+    # Seconds to wait after a config file changes before reloading, so
+    # a burst of changes results in one reload.
+    RELOAD_DELAY = 1
+
+    # With PSI triggers (--psi), the next tick runs as soon as tasks
+    # stall on memory for PSI_STALL seconds within PSI_WINDOW seconds,
+    # but at most once per PSI_MIN_INTERVAL. Without memory pressure,
+    # ticks are then PSI_SLEEP_TIME apart.
+    PSI_STALL = 0.2
+    PSI_WINDOW = 2
+    PSI_MIN_INTERVAL = 1
+    PSI_SLEEP_TIME = 30
+
+    # Seconds pss, uss and swap of a process are reused for, as
+    # reading smaps_rollup is expensive. See --smaps-interval.
+    SMAPS_INTERVAL = 30
+
     def __init__(self, options, args):
         self.options = options
         self.args = args
         self.running = True
         self.config = Configuration()
 
+        self.executor = executor.Executor()
+        self.limiter = ratelimit.RateLimiter()
+
+        # collector.Collector reading /proc on worker threads, or None
+        # to read serially.
+        self.collector = None
+        workers = getattr(options, 'collectors', 0)
+        if workers:
+            self.collector = collector.Collector(workers)
+        process.set_collector(self.collector)
+
+        # proc_events.ProcEvents, if listening for process events.
+        self.events = None
+        self._next_rescan = 0
+
+        # Paths of the cgroups matched in the last tick, and whether
+        # the cgroup v2 hierarchy is available (None until checked).
+        self._cgroup_paths = set()
+        self._cgroups_available = None
+
+        # {pid: metrics.Environment} for the current tick.
+        self._environments = {}
+        self._snapshot = process.Snapshot({}, {})
+        self._start_times = {}
+        self._now = time.time()
+
+        # Previous samples of counters, for rate variables.
+        self.samples = metrics.Samples()
+
+        # Recent values of variables, for rate(...) triggers.
+        self.history = history.History()
+
+        # Values of expensive sources, reused between ticks.
+        interval = getattr(options, 'smaps_interval', None)
+        if interval is None:
+            interval = self.SMAPS_INTERVAL
+        self.cache = metrics.Cache(interval)
+
+        # File descriptors watched by the main loop: {fd: handler}.
+        self.poller = select.poll()
+        self.handlers = {}
+
+        # inotify.Inotify watching the config files, the directories
+        # watched {wd: path}, and when to reload.
+        self.inotify = None
+        self._config_wds = {}
+        self._reload_at = None
+
+        # psi.Trigger on system wide memory pressure, the ones on the
+        # matched cgroups {path: psi.Trigger}, and whether one fired.
+        self.psi = None
+        self._psi_cgroups = {}
+        self._wake = False
+
+        # Metrics about ourselves, and the stats.Server serving them.
+        self.stats = stats.Registry()
+        self._stats_server = None
+        self._init_stats()
+
+        # Ticks left to profile, and the cProfile.Profile collecting.
+        self._profile_ticks = 0
+        self._profiler = None
+
+        backend = getattr(options, 'backend', None)
+        if backend is not None:
+            process.set_backend(backend)
+
         # TODO (bjorn): A little bit hacky, but aids with
         # unit-testing.
         self._testing = False
 
+    def _init_stats(self):
+        registry = self.stats
+        counter = registry.counter
+
+        self.ticks = counter('fallfromgrace_ticks_total', 'Ticks run.')
+        self.tick_seconds = registry.histogram(
+            'fallfromgrace_tick_seconds', 'Time spent in a tick.')
+        self.stage_seconds = {}
+        for stage in ('snapshot', 'match', 'act', 'aggregate', 'cgroup'):
+            self.stage_seconds[stage] = registry.histogram(
+                'fallfromgrace_tick_stage_seconds', 'Time spent in each stage of a tick.',
+                {'stage': stage})
+        self.overruns = counter('fallfromgrace_tick_overruns_total',
+                                'Ticks that took longer than the tick interval.')
+        registry.register('fallfromgrace_tick_interval_seconds', 'gauge',
+                          'Seconds between ticks.', lambda: self.SLEEP_TIME)
+        self.last_tick = 0
+        registry.register('fallfromgrace_last_tick_timestamp_seconds', 'gauge',
+                          'When the last tick finished.', lambda: self.last_tick)
+
+        registry.register('fallfromgrace_processes', 'gauge',
+                          'Processes seen in the last tick.',
+                          lambda: len(self._snapshot.cmdlines))
+        self.scanned = counter('fallfromgrace_processes_scanned_total',
+                               'Processes looked at in ticks.')
+        registry.register('fallfromgrace_regex_searches_total', 'counter',
+                          'Cmdline regexes run, since the config was loaded.',
+                          lambda: self.config.matcher.searches)
+        registry.register('fallfromgrace_match_cache_hits_total', 'counter',
+                          'Cmdlines found in the match cache.',
+                          lambda: self.config.matcher.cache.hits)
+        registry.register('fallfromgrace_match_cache_misses_total', 'counter',
+                          'Cmdlines not found in the match cache.',
+                          lambda: self.config.matcher.cache.misses)
+
+        self.triggers_evaluated = counter('fallfromgrace_triggers_evaluated_total',
+                                          'Triggers evaluated.')
+        self.triggers_fired = counter('fallfromgrace_triggers_fired_total',
+                                      'Triggers that hit.')
+        self.actions_taken = counter('fallfromgrace_actions_total',
+                                     'Actions taken, not counting rate limited ones.')
+
+        registry.register('fallfromgrace_ratelimit_entries', 'gauge',
+                          'Actions currently rate limited.', lambda: len(self.limiter))
+        registry.register('fallfromgrace_ratelimit_evicted_total', 'counter',
+                          'Rate limits dropped because there were too many.',
+                          lambda: self.limiter.evicted)
+
+        ex = self.executor
+        registry.register('fallfromgrace_exec_queue_depth', 'gauge',
+                          'Commands waiting to run.', ex.depth)
+        registry.register('fallfromgrace_exec_submitted_total', 'counter',
+                          'Commands queued to run.', lambda: ex.submitted)
+        registry.register('fallfromgrace_exec_dropped_total', 'counter',
+                          'Commands dropped because the queue was full.', lambda: ex.dropped)
+        registry.register('fallfromgrace_exec_timed_out_total', 'counter',
+                          'Commands killed for running too long.', lambda: ex.timed_out)
+        registry.register('fallfromgrace_exec_wait_seconds', 'histogram',
+                          'Time commands waited in the queue.', ex.wait_seconds)
+        registry.register('fallfromgrace_exec_run_seconds', 'histogram',
+                          'Time commands ran for.', ex.run_seconds)
+
+        if self.collector is not None:
+            co = self.collector
+            registry.register('fallfromgrace_collect_timeouts_total', 'counter',
+                              'Reads of /proc given up on for taking too long.',
+                              lambda: co.timeouts)
+            registry.register('fallfromgrace_collect_stuck', 'gauge',
+                              'Reads of /proc given up on that have not returned.',
+                              lambda: len(co.stuck))
+
+    def _serve_stats(self, address):
+        server = stats.Server(self.stats, address)
+        try:
+            server.start()
+        except Exception, e:
+            log.error('cannot serve stats on %s: %s', address, e)
+            return
+        self._stats_server = server
+
     def _read_conf(self):
         try:
             self.config.load_from_file()
@@ -358,55 +961,502 @@ class FallFromGrace(object):
             log.error('unhandled exception from config load: %s', e)
 
     def _get_environment(self, pid):
-        # TODO (bjorn): In the future we may be interested in a more
-        # diverse set of variables.
-        return process.get_memory_usage(pid)
+        """Returns the (lazy) trigger variables for pid. They are
+        shared by all monitors for the rest of the tick.
+        """
+
+        env = self._environments.get(pid)
+        if env is None:
+            env = metrics.Environment(pid, self._start_times.get(pid),
+                                      self.samples, self._now, self.history, self.cache)
+            self._environments[pid] = env
+        return env
+
+    def _prefetch(self, snapshot, matches):
+        """Read the metrics the matching monitors need on the
+        collector, so the reads overlap and a process stuck in /proc
+        does not hold up the tick. Variables that could not be read in
+        time fail like ones of a process that has gone away.
+
+        Only the variables every evaluation reads are read ahead, the
+        rest of an "and" or "or" is read when (and if) it is needed.
+        Aggregates read all variables of the tree anyway.
+        """
+
+        wanted = {}
+        sources_of = {}
+        for pid, monitors in matches:
+            for monitor in monitors:
+                sources = sources_of.get(monitor)
+                if sources is None:
+                    variables = monitor.required
+                    if monitor.aggregate is not None:
+                        variables = monitor.variables
+                    sources = sources_of[monitor] = metrics.sources_for(variables)
+                if not sources:
+                    continue
+                pids = [pid]
+                if monitor.check_children or monitor.aggregate is not None:
+                    pids.extend(snapshot.descendants(pid))
+                for p in pids:
+                    if p in wanted:
+                        wanted[p].update(sources)
+                    else:
+                        wanted[p] = set(sources)
+        if not wanted:
+            return
+
+        envs = dict((pid, self._get_environment(pid)) for pid in wanted)
+        fetched, slow = self.collector.map(lambda pid: envs[pid].fetch(wanted[pid]),
+                                           list(wanted))
+        for pid, values in fetched.iteritems():
+            envs[pid].update(values)
+        for pid in slow:
+            error = metrics.MetricError('timed out reading pid %s' % pid)
+            envs[pid].update(dict((source, error) for source in wanted[pid]))
 
     def _act(self, pid, monitor):
         """Maybe do something with the process."""
 
         #log.debug('proc %s monitor %s', pid, monitor)
 
-        try:
-            env = self._get_environment(pid)
-        except Exception, e:
-            log.warning('failed to get environment for pid %s - %s', pid, e)
-            return
+        env = self._get_environment(pid)
+        group = ()
+        if monitor.target == 'tree':
+            group = self._snapshot.descendants(pid)
+        self._run_actions(pid, monitor, env, group)
+
+    def _act_aggregate(self, snapshot, matches):
+        """Maybe do something with process trees, given the list of
+        (pid, monitor) for monitors with "aggregate". For each monitor,
+        only the topmost matching pids are roots of trees.
+        """
+
+        pids = {}
+        for pid, monitor in matches:
+            pids.setdefault(monitor, []).append(pid)
+
+        # {variables: [(root, monitor)]}: trees are only aggregated
+        # over the variables of the monitors they are roots for, so an
+        # expensive variable of one monitor is not read for the others.
+        roots_of = {}
+        for monitor, mpids in pids.iteritems():
+            variables = frozenset(monitor.variables - metrics.AGGREGATE_VARIABLES)
+            roots = roots_of.setdefault(variables, [])
+            end = 0
+            for span, pid in sorted((snapshot.span(pid), pid) for pid in mpids):
+                if span is not None and span[0] >= end:
+                    roots.append((pid, monitor))
+                    end = span[1]
+
+        for variables, roots in roots_of.iteritems():
+            totals = metrics.aggregate(snapshot, set(pid for pid, _ in roots), variables,
+                                       self._get_environment)
+            for pid, monitor in roots:
+                if pid not in totals:
+                    continue
+                env = totals[pid].environment(monitor.aggregate)
+                group = ()
+                if monitor.target == 'tree':
+                    group = snapshot.descendants(pid)
+                self._run_actions(pid, monitor, env, group)
+
+    def _act_cgroups(self):
+        """Maybe do something with cgroups. Each cgroup matching a
+        monitor is a few reads of the kernel's accounting for it, however
+        many processes are in it.
+        """
+
+        monitors = self.config.cgroups
+        if monitors and self._cgroups_available is None:
+            self._cgroups_available = cgroup.available()
+            if not self._cgroups_available:
+                log.warning('%s is not a cgroup v2 hierarchy, ignoring monitors %s',
+                            cgroup.CGROUP_ROOT, ' '.join(m.name for m in monitors))
+
+        paths = set()
+        if monitors and self._cgroups_available:
+            for path in cgroup.get_paths():
+                cg = env = None
+                for monitor in monitors:
+                    if not monitor.cgroup.search(path):
+                        continue
+                    if cg is None:
+                        try:
+                            cg = cgroup.Cgroup(path)
+                        except OSError:
+                            # Removed since listed.
+                            break
+                        env = metrics.CgroupEnvironment(cg, self.samples, self._now, self.history)
+                        paths.add(path)
+                    self._run_actions(path, monitor, env, cgroup=cg)
+                    if monitor.final:
+                        break
+
+        gone = self._cgroup_paths - paths
+        if self.psi is not None:
+            for path in paths - self._cgroup_paths:
+                self._watch_cgroup_pressure(path)
+            for path in gone:
+                self._unwatch_cgroup_pressure(path)
+        self.samples.forget(gone)
+        self.history.forget(gone)
+        self.limiter.forget(gone)
+        self._cgroup_paths = paths
+
+    def _run_actions(self, pid, monitor, env, group=(), cgroup=None):
+        """Evaluate the triggers of monitor in env, and act on pid (and
+        group) for those that hit. Given cgroup, pid is its path and the
+        actions are on the processes in it.
+        """
 
         for trigger, action in monitor.actions:
+            self.triggers_evaluated.inc()
             try:
                 triggered = trigger.evaluate(env)
+            except metrics.MetricError, e:
+                log.warning('failed to get environment for %s %s - %s',
+                            'pid' if cgroup is None else 'cgroup', pid, e)
+                return
             except Exception, e:
                 log.error('failed to evaluate trigger %r: %s', trigger, e)
                 continue
 
             if triggered:
+                self.triggers_fired.inc()
                 try:
-                    did_action = action.action(pid, monitor.name)
+                    if cgroup is not None:
+                        did_action = action.action(None, monitor.name, cgroup=cgroup,
+                                                   executor=self.executor,
+                                                   limiter=self.limiter)
+                    else:
+                        did_action = action.action(pid, monitor.name, group,
+                                                   self._start_times.get(pid),
+                                                   executor=self.executor,
+                                                   limiter=self.limiter)
 
                     if did_action:
-                        log.info('Monitor %s and %s hit on pid %s, action: %s',
-                                 monitor.name, trigger, pid, action)
+                        self.actions_taken.inc()
+                        log.info('Monitor %s and %s hit on %s %s, action: %s',
+                                 monitor.name, trigger, 'pid' if cgroup is None else 'cgroup',
+                                 pid, action)
                 except Exception, e:
                     log.error('failed to evaluate action %s: %s', action, e)
 
-    def _tick(self):
-        tree, cmdlines = process.get_snapshot()
-        for pid, cmdline in cmdlines.iteritems():
-            for monitor in self.config.monitor:
-                if monitor.cmdline.search(cmdline):
+    def _watch(self, fd, handler, mask=select.POLLIN):
+        """Have the main loop call handler() when fd is ready."""
+
+        self.poller.register(fd, mask)
+        self.handlers[fd] = handler
+
+    def _unwatch(self, fd):
+        self.poller.unregister(fd)
+        del self.handlers[fd]
+
+    def _watch_pressure(self):
+        """Wake up the main loop on system wide memory pressure, and on
+        that of the matched cgroups."""
+
+        trigger = psi.Trigger(os.path.join(psi.PRESSURE_ROOT, 'memory'),
+                              self.PSI_STALL, self.PSI_WINDOW)
+        try:
+            trigger.open()
+        except (IOError, OSError), e:
+            log.warning('cannot watch memory pressure, polling every %ds: %s',
+                        self.SLEEP_TIME, e)
+            return
+        self.psi = trigger
+        self._watch(trigger.fileno(), self._handle_pressure, select.POLLPRI)
+        for path in self._cgroup_paths:
+            self._watch_cgroup_pressure(path)
+        log.info('watching memory pressure')
+
+    def _watch_cgroup_pressure(self, path):
+        trigger = psi.Trigger(os.path.join(cgroup.CGROUP_ROOT, path, 'memory.pressure'),
+                              self.PSI_STALL, self.PSI_WINDOW)
+        try:
+            trigger.open()
+        except (IOError, OSError), e:
+            log.warning('cannot watch memory pressure of cgroup %s: %s', path, e)
+            return
+        self._psi_cgroups[path] = trigger
+        self._watch(trigger.fileno(), lambda: self._handle_pressure(path), select.POLLPRI)
+
+    def _unwatch_cgroup_pressure(self, path):
+        trigger = self._psi_cgroups.pop(path, None)
+        if trigger is not None:
+            self._unwatch(trigger.fileno())
+            trigger.close()
+
+    def _handle_pressure(self, path=None):
+        """Memory pressure crossed the threshold: tick now."""
+
+        if path is not None and not os.path.isdir(os.path.join(cgroup.CGROUP_ROOT, path)):
+            # The cgroup was removed, which polls as an error.
+            self._unwatch_cgroup_pressure(path)
+            return
+        log.debug('memory pressure%s, ticking early', path and ' in cgroup %s' % path or '')
+        self._wake = True
+
+    def _sleep_time(self):
+        """Returns the seconds until the next tick. Watching memory
+        pressure, ticks can be far apart while there is none."""
+
+        if self.psi is not None and not psi.get_system(self._now)['psi_memory_some']:
+            return self.PSI_SLEEP_TIME
+        return self.SLEEP_TIME
+
+    def _wait(self, timeout):
+        """Sleep for timeout seconds, handling watched fds and pending
+        reloads meanwhile."""
+
+        if not self.handlers:
+            time.sleep(timeout)
+            return
+
+        deadline = time.time() + timeout
+        while self.running:
+            now = time.time()
+            if self._wake:
+                self._wake = False
+                deadline = min(deadline, max(now, self.last_tick + self.PSI_MIN_INTERVAL))
+            if self._reload_at is not None and now >= self._reload_at:
+                self._reload_at = None
+                self.reload(changed_only=True)
+                continue
+            remaining = deadline - now
+            if remaining <= 0:
+                break
+            if self._reload_at is not None:
+                remaining = min(remaining, self._reload_at - now)
+            try:
+                ready = self.poller.poll(remaining * 1000)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, mask in ready:
+                try:
+                    self.handlers[fd]()
+                except Exception, e:
+                    log.error('uncaught exception handling fd %s: %s', fd, e)
+
+    def _watch_config(self):
+        """Reload when the config files change, using inotify."""
+
+        watcher = inotify.Inotify()
+        try:
+            watcher.open()
+        except Exception, e:
+            log.warning('cannot watch config files, reload with SIGHUP: %s', e)
+            return
+        self.inotify = watcher
+        self._add_config_watches()
+        self._watch(watcher.fileno(), self._handle_config_events)
+
+    def _add_config_watches(self):
+        """Watch the directory of the conf file, and the dot-d directory
+        if it exists and is not watched already."""
+
+        watched = set(self._config_wds.values())
+        mask = inotify.CHANGED | inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF | inotify.IN_ONLYDIR
+        for path in (os.path.dirname(self.config.CONF_PATH), self.config.DOT_D_PATH):
+            if path in watched:
+                continue
+            try:
+                self._config_wds[self.inotify.add_watch(path, mask)] = path
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    log.warning('cannot watch %s: %s', path, e)
+
+    def _handle_config_events(self):
+        """Schedule a reload RELOAD_DELAY seconds after the last change
+        to a config file."""
+
+        config = self.config
+        changed = False
+        for wd, mask, name in self.inotify.read():
+            if mask & inotify.IN_Q_OVERFLOW:
+                # Events were lost, so anything may have changed.
+                config.files.clear()
+                changed = True
+                continue
+            directory = self._config_wds.get(wd)
+            if directory is None:
+                continue
+            if mask & inotify.IN_IGNORED:
+                # The directory is gone.
+                del self._config_wds[wd]
+                changed = True
+                continue
+            path = os.path.join(directory, name)
+            if directory == config.DOT_D_PATH or path in (config.CONF_PATH, config.DOT_D_PATH):
+                config.files.invalidate(path)
+                changed = True
+
+        if changed:
+            # The dot-d directory may have been created.
+            self._add_config_watches()
+            self._reload_at = time.time() + self.RELOAD_DELAY
+
+    def _open_events(self):
+        events = proc_events.ProcEvents()
+        try:
+            events.open()
+        except Exception, e:
+            log.warning('cannot listen for process events, polling instead: %s', e)
+            return
+        self.events = events
+        self._watch(events.fileno(), self._handle_proc_events)
+        log.info('listening for process events')
+
+    def _handle_proc_events(self):
+        """Keep the process table up to date from process events, and
+        check new processes against the monitors right away.
+        """
+
+        table = process.get_table()
+        try:
+            events = self.events.read()
+        except proc_events.Overrun:
+            log.warning('process events were lost, rescanning on next tick')
+            self._next_rescan = 0
+            return
+
+        fresh = set()
+        for what, pid, ppid in events:
+            if what == proc_events.EXIT:
+                table.on_exit(pid)
+                fresh.discard(pid)
+            elif what == proc_events.FORK:
+                if table.on_fork(pid):
+                    fresh.add(pid)
+            elif table.on_exec(pid):
+                fresh.add(pid)
+
+        # Changes are left in the table for the next tick.
+        self._snapshot = process.Snapshot(table.tree, table.cmdlines, table.start_times,
+                                          set(), set())
+        self._environments = {}
+        self._start_times = table.start_times
+        self._now = time.time()
+        match = self.config.matcher.match
+        for pid in fresh:
+            for monitor in match(table.cmdlines[pid]):
+                # Aggregates wait for the tree to grow, until the tick.
+                if monitor.aggregate is None:
                     self._act(pid, monitor)
 
-                    if monitor.check_children:
-                        try:
-                            cpids = process.walk_children(tree, pid)
-                        except Exception, e:
-                            log.warning('failed to get children for pid %s: %s', pid, e)
-                        for cpid in cpids:
+    def _get_snapshot(self):
+        """Rescans processes, unless the process table is kept up to
+        date by process events.
+        """
+
+        if self.events is not None:
+            now = time.time()
+            if now < self._next_rescan:
+                return process.get_table().snapshot()
+            self._next_rescan = now + self.RESCAN_TIME
+        return process.get_snapshot()
+
+    def _tick(self):
+        start = time.time()
+        snapshot = self._get_snapshot()
+        cmdlines = snapshot.cmdlines
+        self.samples.forget(snapshot.exited)
+        self.history.forget(snapshot.exited)
+        self.cache.forget(snapshot.exited)
+        self.limiter.forget(snapshot.exited)
+        self._snapshot = snapshot
+        self._environments = {}
+        self._start_times = snapshot.start_times
+        self._now = time.time()
+        self.limiter.expire(self._now)
+        self.stage_seconds['snapshot'].observe(self._now - start)
+
+        match = self.config.matcher.match
+        matches = []
+        for pid, cmdline in cmdlines.iteritems():
+            monitors = match(cmdline)
+            if monitors:
+                matches.append((pid, monitors))
+        matched = time.time()
+        self.stage_seconds['match'].observe(matched - self._now)
+
+        if self.collector is not None:
+            self._prefetch(snapshot, matches)
+
+        # (pid, monitor) pairs done this tick. If a pid was already done
+        # as the descendant of a matching pid, so was its subtree.
+        done = set()
+        aggregates = []
+        for pid, monitors in matches:
+            for monitor in monitors:
+                if monitor.aggregate is not None:
+                    aggregates.append((pid, monitor))
+                    continue
+                if (pid, monitor) in done:
+                    continue
+                done.add((pid, monitor))
+                self._act(pid, monitor)
+
+                if monitor.check_children:
+                    for cpid in snapshot.descendants(pid):
+                        if (cpid, monitor) not in done:
+                            done.add((cpid, monitor))
                             self._act(cpid, monitor)
 
-                    if monitor.final:
-                        break
+        acted = time.time()
+        self.stage_seconds['act'].observe(acted - matched)
+
+        if aggregates:
+            self._act_aggregate(snapshot, aggregates)
+        aggregated = time.time()
+        self.stage_seconds['aggregate'].observe(aggregated - acted)
+
+        if self.config.cgroups or self._cgroup_paths:
+            self._act_cgroups()
+        end = time.time()
+        self.stage_seconds['cgroup'].observe(end - aggregated)
+
+        self.ticks.inc()
+        self.scanned.inc(len(cmdlines))
+        self.tick_seconds.observe(end - start)
+        self.last_tick = end
+        if end - start > self.SLEEP_TIME:
+            self.overruns.inc()
+            log.warning('tick took %.1fs, longer than the %ds interval',
+                        end - start, self.SLEEP_TIME)
+
+    def _profiled_tick(self):
+        if self._profiler is None:
+            self._profiler = cProfile.Profile()
+        try:
+            self._profiler.runcall(self._tick)
+        finally:
+            self._profile_ticks -= 1
+            if not self._profile_ticks:
+                profiler = self._profiler
+                self._profiler = None
+                self._write_profile(profiler)
+
+    def _write_profile(self, profiler):
+        """Save the stats of profiler to PROFILE_DIR, and log the
+        functions with the most cumulative time."""
+
+        out = StringIO.StringIO()
+        profile = pstats.Stats(profiler, stream=out)
+        path = os.path.join(self.PROFILE_DIR, time.strftime('profile-%Y%m%d-%H%M%S.pstats'))
+        try:
+            profile.dump_stats(path)
+            log.info('profile written to %s', path)
+        except (IOError, OSError), e:
+            log.error('failed to write profile to %s: %s', path, e)
+
+        profile.sort_stats('cumulative').print_stats(self.PROFILE_TOP)
+        for line in out.getvalue().splitlines():
+            if line.strip():
+                log.info('profile: %s', line)
 
     def run(self):
         """fall-from-grace main loop."""
@@ -414,14 +1464,34 @@ class FallFromGrace(object):
         log.info('starting up fall-from-grace')
         self._read_conf()
 
+        if getattr(self.options, 'events', False) and self.events is None:
+            self._open_events()
+
+        if getattr(self.options, 'watch', False) and self.inotify is None:
+            self._watch_config()
+
+        if getattr(self.options, 'psi', False) and self.psi is None:
+            self._watch_pressure()
+
+        address = getattr(self.options, 'stats', None)
+        if address and self._stats_server is None:
+            self._serve_stats(address)
+
         while self.running:
             try:
-                self._tick()
+                if self._profile_ticks:
+                    self._profiled_tick()
+                else:
+                    self._tick()
             except Exception, e:
                 log.error('uncaught exception in main loop: %s', e)
             if self._testing:
                 break
-            time.sleep(self.SLEEP_TIME)
+            self._wait(self._sleep_time())
+
+        if self._stats_server is not None:
+            self._stats_server.stop()
+            self._stats_server = None
 
     def shutdown(self, *args):
         """Shutdown the program. Bound in the executable to TERM (or
@@ -431,10 +1501,30 @@ class FallFromGrace(object):
         log.info('shutting down')
         self.running = False
 
-    def reload(self, *args):
+    def profile(self, *args):
+        """Profile the next PROFILE_TICKS ticks. Bound in the executable
+        to SIGUSR1.
+        """
+
+        if self._profile_ticks:
+            log.info('already profiling')
+            return
+        log.info('profiling the next %d ticks', self.PROFILE_TICKS)
+        self._profile_ticks = self.PROFILE_TICKS
+
+    def reload(self, signum=None, frame=None, changed_only=False):
         """Reload the program configuration file. Bound in the
-        executable to SIGHUP.
+        executable to SIGHUP. Files are read again even if they look
+        unchanged, unless changed_only, as on inotify events, which
+        invalidate the files that changed.
         """
 
         log.info('reloading')
+        if not changed_only:
+            self.config.files.clear()
+        cache = self.config.matcher.cache
+        log.info('match cache: %d entries, %d hits, %d misses',
+                 len(cache), cache.hits, cache.misses)
+        start = time.time()
         self._read_conf()
+        log.info('reloaded in %.1f ms', (time.time() - start) * 1000)
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+"""Pressure stall information (PSI): the share of time tasks were
+stalled waiting for memory, io or cpu. See
+Documentation/accounting/psi.rst in the kernel.
+
+Besides reading the averages, a PSI trigger can be registered on a
+pressure file, which then polls as POLLPRI when stall time within a
+window crosses a threshold.
+"""
+
+import os
+
+import fallfromgrace.process as process
+
+PRESSURE_ROOT = '/proc/pressure'
+
+RESOURCES = ('memory', 'io', 'cpu')
+
+
+def parse(data):
+    """Parses the contents of a pressure file. Returns {'some': {'avg10':
+    ..., 'avg60': ..., 'avg300': ..., 'total': ...}, 'full': {...}}.
+    Averages are percentages, total is in microseconds.
+    """
+
+    pressure = {}
+    for line in data.splitlines():
+        fields = line.split()
+        if not fields:
+            continue
+        values = {}
+        for field in fields[1:]:
+            key, _, value = field.partition('=')
+            values[key] = float(value)
+        pressure[fields[0]] = values
+    return pressure
+
+
+def available(root=None):
+    return os.path.exists(os.path.join(root or PRESSURE_ROOT, 'memory'))
+
+
+# (now, variables) of the last get_system call.
+_system = (None, None)
+
+
+def get_system(now):
+    """Returns the system wide 10 second averages as trigger variables,
+    psi_<resource>_some and psi_<resource>_full, in percent, or 0 if
+    not available. Read once per now, so all processes in a tick share
+    a single read.
+    """
+
+    global _system
+
+    if _system[0] == now:
+        return _system[1]
+    variables = {}
+    for resource in RESOURCES:
+        try:
+            pressure = parse(process.read_file(os.path.join(PRESSURE_ROOT, resource)))
+        except (IOError, OSError):
+            # Not available on this kernel: no pressure.
+            pressure = {}
+        for kind in ('some', 'full'):
+            variables['psi_%s_%s' % (resource, kind)] = pressure.get(kind, {}).get('avg10', 0.0)
+    _system = (now, variables)
+    return variables
+
+
+class Trigger(object):
+    """A PSI trigger on a pressure file: polls as POLLPRI whenever
+    tasks were stalled for more than stall seconds within window
+    seconds. kind is "some" or "full".
+    """
+
+    def __init__(self, path, stall, window, kind='some'):
+        self.path = path
+        self.spec = '%s %d %d' % (kind, stall * 1000000, window * 1000000)
+        self.fd = None
+
+    def open(self):
+        """Raises OSError on failure, e.g. if PSI is disabled or the
+        threshold is invalid."""
+
+        fd = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
+        try:
+            os.write(fd, self.spec + '\0')
+        except OSError:
+            os.close(fd)
+            raise
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
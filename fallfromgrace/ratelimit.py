@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+import heapq
+import logging
+
+log = logging.getLogger('fall-from-grace')
+
+
+class RateLimiter(object):
+    """Remembers until when an action must not be taken again, per key.
+
+    Keys are typically (monitor name, action, pid, start time). Entries
+    are dropped when they expire, when their pid exits, and, oldest
+    expiry first, when there are more than max_size of them.
+    """
+
+    MAX_SIZE = 65536
+
+    # Log evictions the first time, then every this many.
+    LOG_EVICTIONS = 10000
+
+    def __init__(self, max_size=MAX_SIZE):
+        self.max_size = max_size
+        # {key: (time after which the action may be taken again, pid)}
+        self.until = {}
+        # [(until, key)]. Replaced and forgotten entries stay here
+        # until popped.
+        self.heap = []
+        # {pid: set(keys)}
+        self.pids = {}
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.until)
+
+    def allow(self, key, now):
+        """Returns True if the action for key may be taken at now."""
+
+        entry = self.until.get(key)
+        return entry is None or now > entry[0]
+
+    def record(self, key, pid, interval, now):
+        """Record that the action for key was taken on pid at now, and
+        must not be taken again for interval seconds.
+        """
+
+        until = now + interval
+        if key not in self.until:
+            self.pids.setdefault(pid, set()).add(key)
+        self.until[key] = (until, pid)
+        heapq.heappush(self.heap, (until, key))
+
+        if len(self.until) > self.max_size:
+            self._evict()
+        if len(self.heap) > 2 * max(self.max_size, len(self.until)):
+            self.heap = [(until, key) for key, (until, _) in self.until.iteritems()]
+            heapq.heapify(self.heap)
+
+    def _evict(self):
+        before = self.evicted
+        while len(self.until) > self.max_size:
+            until, key = heapq.heappop(self.heap)
+            if self._remove(key, until):
+                self.evicted += 1
+        if not before or before // self.LOG_EVICTIONS != self.evicted // self.LOG_EVICTIONS:
+            log.warning('rate limit state full, %d entries evicted in total', self.evicted)
+
+    def _remove(self, key, until):
+        """Remove key if its entry is the one from the heap."""
+
+        entry = self.until.get(key)
+        if entry is None or entry[0] != until:
+            return False
+        del self.until[key]
+        keys = self.pids[entry[1]]
+        keys.discard(key)
+        if not keys:
+            del self.pids[entry[1]]
+        return True
+
+    def expire(self, now):
+        """Drop the entries that no longer limit anything."""
+
+        heap = self.heap
+        while heap and heap[0][0] < now:
+            until, key = heapq.heappop(heap)
+            self._remove(key, until)
+
+    def forget(self, pids):
+        """Drop the entries of processes that have exited."""
+
+        for pid in pids:
+            for key in self.pids.pop(pid, ()):
+                del self.until[key]
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+"""Counters and histograms about fall-from-grace itself, served in the
+Prometheus text format over HTTP, on TCP or a unix socket.
+"""
+
+import BaseHTTPServer
+import bisect
+import logging
+import os
+import SocketServer
+import threading
+
+log = logging.getLogger('fall-from-grace')
+
+
+# Default histogram buckets, in seconds.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Counter(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class Histogram(object):
+    """Counts observations in buckets. May be observed from several
+    threads."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        """Returns (cumulative counts per bucket, sum, count)."""
+
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = []
+        running = 0
+        for n in counts:
+            running += n
+            cumulative.append(running)
+        return cumulative, total, count
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                          .replace('"', '\\"').replace('\n', '\\n'))
+                             for name, value in sorted(labels.iteritems()))
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Registry(object):
+    """A set of named metrics. Each metric is a Counter, a Histogram
+    or a function returning the current value.
+    """
+
+    def __init__(self):
+        # Names, in the order added.
+        self.metrics = []
+        # {name: (type, help, [(labels, metric)])}
+        self.index = {}
+
+    def register(self, name, kind, help, metric, labels=None):
+        if name not in self.index:
+            self.index[name] = (kind, help, [])
+            self.metrics.append(name)
+        self.index[name][2].append((labels or {}, metric))
+        return metric
+
+    def counter(self, name, help, labels=None):
+        return self.register(name, 'counter', help, Counter(), labels)
+
+    def histogram(self, name, help, labels=None, buckets=BUCKETS):
+        return self.register(name, 'histogram', help, Histogram(buckets), labels)
+
+    def render(self):
+        """Returns all metrics in the Prometheus text format."""
+
+        lines = []
+        for name in self.metrics:
+            kind, help, series = self.index[name]
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, metric in series:
+                if isinstance(metric, Histogram):
+                    cumulative, total, count = metric.snapshot()
+                    for le, n in zip(metric.buckets + (float('inf'),), cumulative):
+                        bucket = dict(labels, le=format_value(float(le)))
+                        lines.append('%s_bucket%s %d' % (name, format_labels(bucket), n))
+                    lines.append('%s_sum%s %s' % (name, format_labels(labels), format_value(total)))
+                    lines.append('%s_count%s %d' % (name, format_labels(labels), count))
+                    continue
+                if isinstance(metric, Counter):
+                    value = metric.value
+                else:
+                    try:
+                        value = metric()
+                    except Exception, e:
+                        log.warning('failed to read metric %s: %s', name, e)
+                        continue
+                lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix sockets have no client address.
+        return str(self.client_address and self.client_address[0])
+
+    def log_message(self, format, *args):
+        log.debug('stats: ' + format, *args)
+
+
+class TCPServer(BaseHTTPServer.HTTPServer):
+    allow_reuse_address = True
+
+
+class UnixServer(SocketServer.UnixStreamServer):
+    def server_bind(self):
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+        SocketServer.UnixStreamServer.server_bind(self)
+
+
+class Server(object):
+    """Serves a Registry on address, which is either a path to a unix
+    socket or [host:]port. Listens on localhost if no host is given.
+    """
+
+    def __init__(self, registry, address):
+        self.registry = registry
+        self.address = address
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        """Bind and serve from a daemon thread. Raises socket.error on
+        failure."""
+
+        if '/' in self.address:
+            server = UnixServer(self.address, Handler)
+        else:
+            host, _, port = self.address.rpartition(':')
+            server = TCPServer((host or '127.0.0.1', int(port)), Handler)
+        server.registry = self.registry
+        self.server = server
+        self.thread = threading.Thread(target=server.serve_forever, name='stats')
+        self.thread.daemon = True
+        self.thread.start()
+        log.info('serving stats on %s', self.address)
+
+    def stop(self):
+        if self.server is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        if isinstance(self.server, UnixServer):
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+        self.server = None
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+"""Benchmark of reading pss, uss and swap (/proc/<pid>/smaps_rollup),
+compared to rmem (/proc/<pid>/statm).
+
+The cost of smaps_rollup is the kernel walking the page tables of the
+process, which a synthetic /proc cannot show. So this starts a child
+process on the live /proc that touches the given number of MB of
+memory, and times the reads of it.
+
+usage: python test/bench_smaps.py [MB ...]
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import fallfromgrace.process as process
+
+# Touches a page of every 4k of argv[1] MB, then waits for stdin.
+CHILD = r"""
+import sys
+data = bytearray(int(sys.argv[1]) * 1024 * 1024)
+for i in xrange(0, len(data), 4096):
+    data[i] = 1
+sys.stdout.write('ready\n')
+sys.stdout.flush()
+sys.stdin.read()
+"""
+
+
+def bench(read, pid, rounds=50):
+    """Returns the best seconds per read."""
+
+    best = None
+    for _ in xrange(rounds):
+        start = time.time()
+        read(pid)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main(args):
+    sizes = [int(arg) for arg in args] or [64, 512]
+    backend = process.ProcfsBackend()
+    print '%8s %14s %14s' % ('MB', 'statm', 'smaps_rollup')
+    for mb in sizes:
+        child = subprocess.Popen([sys.executable, '-c', CHILD, str(mb)],
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        try:
+            child.stdout.readline()
+            statm = bench(backend.memory_usage, child.pid)
+            smaps = bench(backend.smaps, child.pid)
+        finally:
+            child.stdin.close()
+            child.wait()
+        print '%8d %11.1f us %11.1f us' % (mb, statm * 1e6, smaps * 1e6)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+"""Benchmark of the process snapshot backends.
+
+psutil always reads the real /proc, so the two backends are compared
+head to head on the live system. The procfs backend is additionally
+timed on synthetic /proc trees to show how it scales.
+
+usage: python test/bench_snapshot.py [count ...]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import fallfromgrace.process as process
+
+import fakeproc
+
+
+def bench(backend, rounds=5):
+    """Returns (best seconds per snapshot, number of processes)."""
+
+    best = None
+    for _ in xrange(rounds):
+        start = time.time()
+        tree, cmdlines = process.get_snapshot(backend)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, len(cmdlines)
+
+
+def report(label, elapsed, count):
+    print '%-24s %7d procs %9.2f ms %7.2f us/proc' % (
+        label, count, elapsed * 1000, elapsed * 1e6 / max(count, 1))
+
+
+def main(args):
+    counts = [int(arg) for arg in args] or [1000, 10000]
+
+    for name in ('psutil', 'procfs'):
+        elapsed, count = bench(process.BACKENDS[name]())
+        report('%s (live /proc)' % name, elapsed, count)
+
+    for count in counts:
+        proc = fakeproc.FakeProc(count)
+        try:
+            elapsed, count = bench(process.ProcfsBackend(proc.root))
+            report('procfs (synthetic)', elapsed, count)
+        finally:
+            proc.cleanup()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+"""Benchmark of startup: importing fallfromgrace.program, loading a
+config and running the first tick on the live /proc.
+
+Each round runs in a fresh interpreter, so nothing is warm. The
+triggers never fire, so no actions are taken.
+
+usage: python test/bench_startup.py [monitors [rounds]]
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def make_config(monitors):
+    conf = []
+    for i in xrange(monitors):
+        conf.append("""monitor%d:
+  cmdline: ^/usr/bin/never-running-%d( |$)
+  actions:
+    rmem > 1000g: term
+    rate(rmem) > 100g/min: exec @ 1h true
+""" % (i, i))
+    return '\n'.join(conf)
+
+
+def child(monitors):
+    """Runs in a fresh interpreter and prints the elapsed times."""
+
+    start = time.time()
+    sys.path.insert(0, ROOT)
+    import fallfromgrace.program as ffg
+    imported = time.time()
+
+    grace = ffg.FallFromGrace(None, [])
+    grace.config.load(make_config(monitors))
+    loaded = time.time()
+
+    grace._tick()
+    ticked = time.time()
+
+    print imported - start, loaded - imported, ticked - loaded
+
+
+def main(args):
+    monitors = 100
+    rounds = 10
+    if args:
+        monitors = int(args[0])
+    if len(args) > 1:
+        rounds = int(args[1])
+
+    samples = []
+    for _ in xrange(rounds):
+        output = subprocess.check_output(
+            [sys.executable, __file__, '--child', str(monitors)])
+        samples.append([float(x) for x in output.split()])
+
+    print 'monitors %d, best of %d fresh interpreters' % (monitors, rounds)
+    for i, label in enumerate(('import', 'config load', 'first tick')):
+        print '%-12s %8.2f ms' % (label, min(s[i] for s in samples) * 1000)
+    print '%-12s %8.2f ms' % ('total', min(sum(s) for s in samples) * 1000)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        child(int(sys.argv[2]))
+    else:
+        main(sys.argv[1:])
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+"""Benchmark of the whole tick pipeline on synthetic /proc trees.
+
+For each process count, a fake /proc is built and FallFromGrace ticks
+over it with signals and exec mocked out. Time is reported per stage:
+snapshot, cmdline matching, trigger evaluation (including reading the
+metrics) and actions. Each scenario runs in a forked child, so the
+reported peak RSS is its own.
+
+Results can be saved as a baseline, and later runs compared against
+it: the exit status is 1 if any stage got slower, or the peak RSS
+larger, by more than the tolerance.
+
+usage: python test/bench_tick.py [options] [count ...]
+"""
+
+import json
+import optparse
+import os
+import resource
+import sys
+import time
+
+import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import fallfromgrace.process as process
+import fallfromgrace.program as ffg
+
+import fakeproc
+
+# Cmdline distributions, as [(weight, cmdline)].
+CMDLINES = {
+    'default': fakeproc.DEFAULT_CMDLINES,
+    # Every process is different, so the match cache does not help.
+    'distinct': [(1, '/usr/bin/worker --id %d' % i) for i in xrange(20000)],
+    'single': [(1, 'php-fpm: pool www')],
+    }
+
+# Monitors which match the default cmdlines. php-fpm and make have
+# triggers that fire, every tick for php-fpm.
+MONITORS = """php:
+  cmdline: ^php-fpm
+  actions:
+    rmem > 100k: term
+    rate(rmem) > 1m/s: kill
+
+gunicorn:
+  cmdline: gunicorn
+  children: 1
+  actions:
+    cpu > 90: stop @ 1m
+    fds > 1000: exec @ 1h logger too many fds
+
+chrome:
+  cmdline: chrome --type=renderer
+  final: 1
+  actions:
+    rmem > 2g: kill
+
+make:
+  cmdline: ^make
+  aggregate: sum
+  actions:
+    rmem > 1m: exec @ 1h logger build too large
+    count > 1000: term
+"""
+
+# Filler monitors which never match.
+FILLER = """unused%d:
+  cmdline: ^/opt/unused-%d/bin/daemon
+  actions:
+    vmem > 1g: term
+"""
+
+STAGES = ('snapshot', 'match', 'trigger', 'action', 'other', 'total')
+
+
+def make_config(monitors, smaps=False):
+    """Returns the config with the given number of monitors. With
+    smaps, the memory triggers are on pss instead of rmem."""
+
+    config = MONITORS
+    if smaps:
+        config = config.replace('rmem', 'pss')
+    return config + '\n'.join(FILLER % (i, i) for i in xrange(max(monitors - 4, 0)))
+
+
+class StageTimer(object):
+    """Wraps functions to add up the time spent in them per stage."""
+
+    def __init__(self):
+        self.times = dict.fromkeys(STAGES, 0.0)
+
+    def wrap(self, stage, func):
+        times = self.times
+        clock = time.time
+
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                times[stage] += clock() - start
+        return timed
+
+    def reset(self):
+        for stage in STAGES:
+            self.times[stage] = 0.0
+
+
+def run_scenario(root, monitors, ticks, collectors=0, smaps=False, smaps_interval=None):
+    """Ticks over the fake /proc at root, reading it on collectors
+    worker threads if given, with triggers on pss if smaps. Returns
+    {'first': {stage: seconds}, 'steady': {stage: seconds}, 'maxrss_kb':
+    ...}.
+    """
+
+    process.PROC_ROOT = root
+    process._backend = process.ProcfsBackend(root)
+    process._table = None
+
+    grace = ffg.FallFromGrace(optparse.Values({'collectors': collectors,
+                                               'smaps_interval': smaps_interval}), [])
+    grace.config.load(make_config(monitors, smaps))
+    grace.executor.submit = mock.Mock(return_value=True)
+
+    timer = StageTimer()
+    grace._get_snapshot = timer.wrap('snapshot', grace._get_snapshot)
+    grace.config.matcher.match = timer.wrap('match', grace.config.matcher.match)
+
+    def tick():
+        timer.reset()
+        start = time.time()
+        grace._tick()
+        times = dict(timer.times)
+        times['total'] = time.time() - start
+        times['other'] = times['total'] - sum(times[stage] for stage in STAGES[:4])
+        return times
+
+    with mock.patch('os.kill'):
+        with mock.patch.object(ffg.Trigger, 'evaluate',
+                               timer.wrap('trigger', ffg.Trigger.evaluate.im_func)):
+            with mock.patch.object(ffg.Action, 'action',
+                                   timer.wrap('action', ffg.Action.action.im_func)):
+                first = tick()
+                steady = [tick() for _ in xrange(ticks)]
+
+    best = dict((stage, min(times[stage] for times in steady)) for stage in STAGES)
+    return {'first': first, 'steady': best,
+            'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def run_forked(root, monitors, ticks, *args):
+    """Runs the scenario in a child process and returns its result."""
+
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        status = 1
+        try:
+            result = run_scenario(root, monitors, ticks, *args)
+            os.write(wfd, json.dumps(result))
+            status = 0
+        finally:
+            os._exit(status)
+    os.close(wfd)
+    data = []
+    while True:
+        chunk = os.read(rfd, 65536)
+        if not chunk:
+            break
+        data.append(chunk)
+    os.close(rfd)
+    _, status = os.waitpid(pid, 0)
+    if status != 0:
+        raise RuntimeError('benchmark child failed with status %d' % status)
+    return json.loads(''.join(data))
+
+
+def report(count, result):
+    print '  %-26s %s %9s' % ('', ' '.join('%9s' % stage for stage in STAGES), 'peak rss')
+    for label in ('first', 'steady'):
+        times = result[label]
+        print '  %-26s %s %6d MB' % (
+            label, ' '.join('%7.1fms' % (times[stage] * 1000) for stage in STAGES),
+            result['maxrss_kb'] / 1024)
+    print '  %-26s %8.2fus/proc' % ('steady total', result['steady']['total'] * 1e6 / count)
+
+
+def compare(results, baseline, tolerance):
+    """Returns a list of regressions of results against baseline."""
+
+    regressions = []
+    for name, result in sorted(results.iteritems()):
+        old = baseline.get(name)
+        if old is None:
+            continue
+        for stage in STAGES:
+            if stage == 'other':
+                continue
+            new_time, old_time = result['steady'][stage], old['steady'][stage]
+            # Ignore noise in stages that take next to no time.
+            if new_time > old_time * tolerance and new_time - old_time > 0.005:
+                regressions.append('%s: %s %.1fms -> %.1fms' % (
+                        name, stage, old_time * 1000, new_time * 1000))
+        if result['maxrss_kb'] > old['maxrss_kb'] * tolerance:
+            regressions.append('%s: peak rss %d kB -> %d kB' % (
+                    name, old['maxrss_kb'], result['maxrss_kb']))
+    return regressions
+
+
+def main(args):
+    parser = optparse.OptionParser(usage='%prog [options] [count ...]')
+    parser.add_option('--depth', type='int', default=4,
+                      help='maximum depth of the process tree')
+    parser.add_option('--cmdlines', type='choice', choices=sorted(CMDLINES), default='default',
+                      help='cmdline distribution: %s' % ', '.join(sorted(CMDLINES)))
+    parser.add_option('--monitors', type='int', default=50,
+                      help='number of monitors in the config')
+    parser.add_option('--ticks', type='int', default=3,
+                      help='number of steady state ticks, the best is reported')
+    parser.add_option('--collectors', type='int', default=0,
+                      help='read /proc on this many worker threads')
+    parser.add_option('--smaps', action='store_true', default=False,
+                      help='trigger on pss, read from smaps_rollup, instead of rmem')
+    parser.add_option('--smaps-interval', type='float', default=None,
+                      help='seconds to reuse smaps values for (default: the daemon\'s)')
+    parser.add_option('--save', metavar='FILE', help='save results as a baseline')
+    parser.add_option('--baseline', metavar='FILE', help='compare results to a baseline')
+    parser.add_option('--tolerance', type='float', default=1.5,
+                      help='allowed slowdown relative to the baseline')
+    options, args = parser.parse_args(args)
+    counts = [int(arg) for arg in args] or [1000, 10000, 100000]
+
+    results = {}
+    for count in counts:
+        name = '%d/%s/depth%d/monitors%d' % (count, options.cmdlines, options.depth,
+                                            options.monitors)
+        if options.collectors:
+            name += '/collectors%d' % options.collectors
+        if options.smaps:
+            name += '/smaps'
+            if options.smaps_interval is not None:
+                name += '%g' % options.smaps_interval
+        start = time.time()
+        proc = fakeproc.FakeProc(count, depth=options.depth,
+                                 cmdlines=CMDLINES[options.cmdlines], smaps=options.smaps)
+        print '%s (fixture built in %.1fs)' % (name, time.time() - start)
+        try:
+            results[name] = run_forked(proc.root, options.monitors, options.ticks,
+                                       options.collectors, options.smaps, options.smaps_interval)
+        finally:
+            proc.cleanup()
+        report(count, results[name])
+
+    if options.save:
+        f = open(options.save, 'w')
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.close()
+
+    if options.baseline:
+        f = open(options.baseline)
+        baseline = json.load(f)
+        f.close()
+        regressions = compare(results, baseline, options.tolerance)
+        for regression in regressions:
+            print 'REGRESSION', regression
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
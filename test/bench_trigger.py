@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+"""Benchmark of trigger evaluation.
+
+A simple comparison is timed compiled, as triggers are evaluated now,
+and interpreted from the parsed expression, as they were before they
+were compiled. Compound triggers are timed compiled only. The
+variables are a plain dict, so only evaluation is measured.
+
+usage: python test/bench_trigger.py [rounds]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import fallfromgrace.program as ffg
+
+TRIGGERS = [
+    'rmem > 1g',
+    'rate(rmem) > 10m/min',
+    'rmem + swap > 2g',
+    'rmem > 1g and cpu > 50',
+    '(pss > 1g or fds > 10k) and not cpu > 50',
+    ]
+
+
+def interpret(trigger, env):
+    """Trigger.evaluate before triggers were compiled."""
+
+    new = []
+    for tok in trigger.expr:
+        val = tok
+        if val in env:
+            val = env[val]
+        new.append(val)
+    return ffg.Trigger.OPS[new[1]](int(new[0]), int(new[2]))
+
+
+def bench(evaluate, trigger, envs, rounds):
+    """Returns the best evaluations per second of three runs."""
+
+    best = None
+    for _ in xrange(3):
+        start = time.time()
+        for i in xrange(rounds):
+            evaluate(trigger, envs[i & 1])
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return rounds / best
+
+
+def report(label, trigger, per_second):
+    print '%-12s %-44s %10d evaluations/s' % (label, trigger, per_second)
+
+
+def main(args):
+    rounds = int(args[0]) if args else 200000
+    envs = []
+    for i in (100, 1500):
+        env = dict.fromkeys(ffg.parser_trigger.VARIABLES, i * 1024 * 1024)
+        env['cpu'] = i / 10.0
+        env['rate(rmem)'] = i * 1024.0
+        envs.append(env)
+
+    compiled = lambda trigger, env: trigger.evaluate(env)
+    for s in TRIGGERS:
+        trigger = ffg.Trigger(s)
+        if len(trigger.expr) == 3 and all(not isinstance(tok, tuple) for tok in trigger.expr):
+            for env in envs:
+                assert interpret(trigger, env) == trigger.evaluate(env)
+            report('interpreted', s, bench(interpret, trigger, envs, rounds))
+        report('compiled', s, bench(compiled, trigger, envs, rounds))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
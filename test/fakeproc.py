@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+"""Helpers for building synthetic /proc trees, for tests and
+benchmarks.
+"""
+
+import os
+import random
+import shutil
+import tempfile
+
+# A rough approximation of what a busy build/web host runs.
+DEFAULT_CMDLINES = [
+    (40, 'php-fpm: pool www'),
+    (20, '/usr/bin/python /usr/bin/gunicorn app:wsgi -w 8'),
+    (10, '/opt/google/chrome/chrome --type=renderer --lang=en-US'),
+    (10, 'make -j16'),
+    (10, '/bin/sh -c gcc -O2 -c foo.c -o foo.o'),
+    (5, '/usr/lib/gcc/x86_64-linux-gnu/4.7/cc1 -quiet foo.c'),
+    (4, 'xulrunner-bin /usr/share/conkeror/application.ini'),
+    (1, 'firefox'),
+    ]
+
+
+def write_file(path, data):
+    f = open(path, 'w')
+    f.write(data)
+    f.close()
+
+
+def write_stat(root, pid, ppid, comm, start_time=1000, utime=0, stime=0, threads=1):
+    fields = ['S', str(ppid)] + ['0'] * 9 + [str(utime), str(stime)] + ['0'] * 4 + \
+        [str(threads), '0', str(start_time)] + ['0'] * 30
+    write_file(os.path.join(root, str(pid), 'stat'),
+               '%d (%s) %s\n' % (pid, comm, ' '.join(fields)))
+
+
+def write_io(root, pid, read_bytes=0, write_bytes=0):
+    write_file(os.path.join(root, str(pid), 'io'),
+               'rchar: 0\nwchar: 0\nsyscr: 0\nsyscw: 0\n'
+               'read_bytes: %d\nwrite_bytes: %d\ncancelled_write_bytes: 0\n' % (
+            read_bytes, write_bytes))
+
+
+SMAPS_ROLLUP = """00400000-7ffc50031000 ---p 00000000 00:00 0                          [rollup]
+Rss:              %(rss)8d kB
+Pss:              %(pss)8d kB
+Pss_Anon:         %(pss)8d kB
+Pss_File:                0 kB
+Pss_Shmem:               0 kB
+Shared_Clean:     %(shared)8d kB
+Shared_Dirty:            0 kB
+Private_Clean:           0 kB
+Private_Dirty:    %(private)8d kB
+Referenced:       %(rss)8d kB
+Anonymous:        %(private)8d kB
+LazyFree:                0 kB
+AnonHugePages:           0 kB
+ShmemPmdMapped:          0 kB
+FilePmdMapped:           0 kB
+Shared_Hugetlb:          0 kB
+Private_Hugetlb:         0 kB
+Swap:             %(swap)8d kB
+SwapPss:          %(swap)8d kB
+Locked:                  0 kB
+"""
+
+
+def write_smaps(root, pid, pss_kb=200, private_kb=100, shared_kb=300, swap_kb=0):
+    write_file(os.path.join(root, str(pid), 'smaps_rollup'), SMAPS_ROLLUP % {
+            'rss': private_kb + shared_kb, 'pss': pss_kb, 'private': private_kb,
+            'shared': shared_kb, 'swap': swap_kb})
+
+
+def write_process(root, pid, ppid, cmdline, comm=None, start_time=1000,
+                  rss_pages=100, vms_pages=1000, fds=3, smaps=False, **kwargs):
+    """Writes the /proc/<pid> files we read for one process under
+    root, and smaps_rollup if smaps. Extra keyword arguments are passed
+    to write_stat.
+    """
+
+    path = os.path.join(root, str(pid))
+    os.mkdir(path)
+    if comm is None:
+        comm = os.path.basename(cmdline.split(' ')[0])[:15]
+    write_stat(root, pid, ppid, comm, start_time, **kwargs)
+    write_file(os.path.join(path, 'cmdline'), '\0'.join(cmdline.split(' ')) + '\0')
+    write_file(os.path.join(path, 'statm'), '%d %d 0 0 0 0 0\n' % (vms_pages, rss_pages))
+    write_io(root, pid)
+    os.mkdir(os.path.join(path, 'fd'))
+    for fd in xrange(fds):
+        write_file(os.path.join(path, 'fd', str(fd)), '')
+    if smaps:
+        write_smaps(root, pid)
+
+
+def pick_cmdline(rng, cmdlines):
+    total = sum(weight for weight, _ in cmdlines)
+    point = rng.uniform(0, total)
+    for weight, cmdline in cmdlines:
+        point -= weight
+        if point <= 0:
+            return cmdline
+    return cmdlines[-1][1]
+
+
+def make_tree(root, count, depth=4, cmdlines=None, seed=0, smaps=False):
+    """Populates root with count synthetic processes, arranged in a
+    tree of at most the given depth below pid 1. Returns a dict from
+    pid to (ppid, cmdline).
+    """
+
+    if cmdlines is None:
+        cmdlines = DEFAULT_CMDLINES
+    rng = random.Random(seed)
+
+    procs = {1: (0, '/sbin/init')}
+    write_process(root, 1, 0, '/sbin/init', smaps=smaps)
+    # last[level] is the most recently created pid at that level.
+    last = [1]
+    for pid in xrange(2, count + 1):
+        level = rng.randint(1, min(depth, len(last)))
+        ppid = last[level - 1]
+        cmdline = pick_cmdline(rng, cmdlines)
+        write_process(root, pid, ppid, cmdline, start_time=1000 + pid, smaps=smaps)
+        procs[pid] = (ppid, cmdline)
+        if level < len(last):
+            last[level] = pid
+        else:
+            last.append(pid)
+    return procs
+
+
+class FakeProc(object):
+    """A temporary directory populated with a synthetic /proc."""
+
+    def __init__(self, count=0, **kwargs):
+        self.root = tempfile.mkdtemp(prefix='fakeproc-')
+        self.procs = {}
+        if count:
+            self.procs = make_tree(self.root, count, **kwargs)
+
+    def cleanup(self):
+        shutil.rmtree(self.root, ignore_errors=True)
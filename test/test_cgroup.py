@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import fallfromgrace.cgroup as cgroup
+import fallfromgrace.metrics as metrics
+
+
+def write_cgroup(root, path, memory=0, anon=0, usage_usec=0, pids=()):
+    """Writes the files of a cgroup below root."""
+
+    directory = os.path.join(root, path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    files = {
+        'memory.current': '%d\n' % memory,
+        'memory.stat': 'anon %d\nfile 4096\nkernel 8192\n' % anon,
+        'cpu.stat': 'usage_usec %d\nuser_usec 0\nsystem_usec 0\n' % usage_usec,
+        'pids.current': '%d\n' % len(pids),
+        'cgroup.procs': ''.join('%d\n' % pid for pid in pids),
+        }
+    for name, data in files.iteritems():
+        f = open(os.path.join(directory, name), 'w')
+        f.write(data)
+        f.close()
+
+
+class CgroupTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        open(os.path.join(self.root, 'cgroup.controllers'), 'w').close()
+        write_cgroup(self.root, 'system.slice/nginx.service', memory=3 << 20,
+                     anon=2 << 20, usage_usec=1500000, pids=[10, 11])
+        write_cgroup(self.root, 'system.slice/nginx.service/worker', pids=[12])
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_cgroup(self):
+        self.assertTrue(cgroup.available(self.root))
+        self.assertEquals(['system.slice', 'system.slice/nginx.service',
+                           'system.slice/nginx.service/worker'],
+                          sorted(cgroup.get_paths(self.root)))
+
+        cg = cgroup.Cgroup('system.slice/nginx.service', self.root)
+        self.assertEquals([10, 11, 12], sorted(cg.procs()))
+        self.assertEquals({'rmem': 3 << 20, 'anon': 2 << 20, 'file': 4096},
+                          cgroup.get_memory(cg))
+        self.assertEquals(1.5, cgroup.get_cpu_time(cg))
+        self.assertEquals(2, cgroup.get_pids(cg))
+
+    def test_environment(self):
+        cg = cgroup.Cgroup('system.slice/nginx.service', self.root)
+        samples = metrics.Samples()
+        env = metrics.CgroupEnvironment(cg, samples, now=10)
+        self.assertEquals(3 << 20, env['rmem'])
+        self.assertEquals(2, env['pids'])
+        self.assertEquals(0.0, env['cpu'])
+        self.assertFalse('vmem' in env)
+
+        # 1.5s of CPU time in 3s is 50%.
+        write_cgroup(self.root, 'system.slice/nginx.service', usage_usec=3000000)
+        env = metrics.CgroupEnvironment(cg, samples, now=13)
+        self.assertEquals(50.0, env['cpu'])
+
+        os.unlink(os.path.join(self.root, 'system.slice/nginx.service/pids.current'))
+        self.assertRaises(metrics.MetricError, lambda: env['pids'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+import threading
+import time
+import unittest
+
+import fallfromgrace.collector as collector
+
+
+class CollectorTest(unittest.TestCase):
+    def test_map(self):
+        co = collector.Collector(workers=3, shard_size=7)
+        results, slow = co.map(lambda pid: pid * 2, range(100))
+        self.assertEquals(dict((pid, pid * 2) for pid in range(100)), results)
+        self.assertEquals(set(), slow)
+
+        self.assertEquals(({}, set()), co.map(lambda pid: pid, []))
+
+    def test_errors(self):
+        def read(pid):
+            if pid % 2:
+                raise IOError('gone')
+            return pid
+
+        results, slow = collector.Collector(workers=2).map(read, range(10))
+        self.assertEquals([0, 2, 4, 6, 8], sorted(results))
+        self.assertEquals(set(), slow)
+
+    def test_timeout(self):
+        release = threading.Event()
+
+        def read(pid):
+            if pid == 5:
+                release.wait()
+            return pid
+
+        co = collector.Collector(workers=2, timeout=0.1, shard_size=4)
+        start = time.time()
+        results, slow = co.map(read, range(12))
+        self.assertTrue(time.time() - start < 1)
+        self.assertEquals(set([5]), slow)
+        self.assertEquals(set(range(12)) - set([5]), set(results))
+        self.assertEquals(1, co.timeouts)
+        self.assertEquals(2, len(co.workers))
+
+        # The pid is skipped while the read is stuck.
+        results, slow = co.map(read, [5, 6])
+        self.assertEquals(({6: 6}, set([5])), (results, slow))
+
+        release.set()
+        for i in range(100):
+            if not co.stuck:
+                break
+            time.sleep(0.01)
+        self.assertEquals({5: 5, 6: 6}, co.map(read, [5, 6])[0])
+
+    def test_all_stuck(self):
+        release = threading.Event()
+        co = collector.Collector(workers=2, timeout=0.05, shard_size=1, max_stuck=2)
+        results, slow = co.map(lambda pid: release.wait(), range(5))
+        workers = co.workers
+        release.set()
+        self.assertEquals({}, results)
+        self.assertEquals(set(range(5)), slow)
+        self.assertEquals([], workers)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+import time
+import unittest
+
+import fallfromgrace.executor as executor
+
+
+class ExecutorTest(unittest.TestCase):
+    def test_run(self):
+        ex = executor.Executor(max_workers=2)
+        self.assertEquals(True, ex.submit('true'))
+        self.assertEquals(True, ex.submit('exit 3'))
+        ex.join()
+        self.assertEquals((2, 0, 0), (ex.submitted, ex.dropped, ex.timed_out))
+
+    def test_timeout(self):
+        ex = executor.Executor(max_workers=1, timeout=0.2)
+        start = time.time()
+        ex.submit('sleep 10')
+        ex.join()
+        self.assertEquals(1, ex.timed_out)
+        self.assertTrue(time.time() - start < 5)
+
+    def test_drop(self):
+        ex = executor.Executor(max_workers=1, max_queue=1, timeout=0.5)
+        ex.submit('sleep 10')
+        time.sleep(0.1)
+        self.assertEquals(True, ex.submit('true'))
+        self.assertEquals(False, ex.submit('true'))
+        self.assertEquals(1, ex.dropped)
+        ex.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
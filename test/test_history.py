@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+import unittest
+
+import fallfromgrace.history as history
+import fallfromgrace.metrics as metrics
+import fallfromgrace.program as ffg
+
+
+class RingTest(unittest.TestCase):
+    def test_ring(self):
+        ring = history.Ring(3)
+        self.assertEquals(0.0, ring.rate())
+
+        ring.add(0, 100)
+        self.assertEquals(0.0, ring.rate())
+        ring.add(10, 200)
+        self.assertEquals(10.0, ring.rate())
+        ring.add(20, 200)
+        ring.add(30, 800)
+        self.assertEquals(3, len(ring))
+        self.assertEquals((10, 200), ring.oldest())
+        self.assertEquals((30, 800), ring.newest())
+        self.assertEquals(30.0, ring.rate())
+
+
+class HistoryTest(unittest.TestCase):
+    def test_rate_trigger(self):
+        hist = history.History(size=7)
+        trigger = ffg.Trigger('rate(rmem) > 50m/min')
+
+        for i in xrange(7):
+            env = metrics.Environment(42, 1000, now=10.0 * i, history=hist)
+            env.values['rmem'] = i * 100 * 1024**2
+            self.assertEquals(i > 0, trigger.evaluate(env))
+
+        # Leak stops: the rate drops as the window moves on.
+        for i in xrange(7, 14):
+            env = metrics.Environment(42, 1000, now=10.0 * i, history=hist)
+            env.values['rmem'] = 600 * 1024**2
+            self.assertEquals(i < 12, trigger.evaluate(env))
+
+    def test_reclaim(self):
+        hist = history.History()
+        hist.rate(1, 5, 'rmem', 10, 0.0)
+        hist.rate(2, 5, 'rmem', 10, 0.0)
+        hist.rate(2, 5, 'rmem', 20, 10.0)
+        self.assertEquals(0.0, hist.rate(2, 6, 'rmem', 30, 20.0))
+
+        hist.forget([1, 2, 3])
+        self.assertEquals(0, len(hist))
+
+    def test_config(self):
+        config = ffg.Configuration()
+        config.load("""leak:
+  cmdline: leaky
+  actions:
+    rate(rmem) > 50m/min: exec logger leaking
+""")
+        self.assertEquals(set(['rate(rmem)']), config.monitor[0].variables)
+        self.assertEquals(set(['memory']), metrics.sources_for(config.monitor[0].variables))
+
+
+if __name__ == '__main__':
+    unittest.main()
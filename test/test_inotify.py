@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import fallfromgrace.config as config
+import fallfromgrace.inotify as inotify
+
+
+class InotifyTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.inotify = inotify.Inotify()
+        self.inotify.open()
+
+    def tearDown(self):
+        self.inotify.close()
+        shutil.rmtree(self.dir)
+
+    def test_events(self):
+        wd = self.inotify.add_watch(self.dir, inotify.CHANGED)
+        self.assertEquals([], self.inotify.read())
+
+        f = open(os.path.join(self.dir, 'a.conf'), 'w')
+        f.write('x')
+        f.close()
+        os.rename(os.path.join(self.dir, 'a.conf'), os.path.join(self.dir, 'b.conf'))
+
+        self.assertEquals([(wd, inotify.IN_CREATE, 'a.conf'),
+                           (wd, inotify.IN_CLOSE_WRITE, 'a.conf'),
+                           (wd, inotify.IN_MOVED_FROM, 'a.conf'),
+                           (wd, inotify.IN_MOVED_TO, 'b.conf')], self.inotify.read())
+
+    def test_not_a_directory(self):
+        path = os.path.join(self.dir, 'a.conf')
+        open(path, 'w').close()
+        self.assertRaises(OSError, self.inotify.add_watch, path, inotify.IN_ONLYDIR)
+
+
+class FileCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, content):
+        f = open(os.path.join(self.dir, name), 'w')
+        f.write(content)
+        f.close()
+
+    def test_read_dot_d(self):
+        self.write('10-a', 'a')
+        self.write('90-b', 'b')
+        cache = config.FileCache()
+        self.assertEquals('b\na', config.read_dot_d(self.dir, cache))
+
+        # Unchanged files are not read again.
+        path = os.path.join(self.dir, '10-a')
+        cache.files[path] = (cache.files[path][0], 'cached')
+        self.assertEquals('b\ncached', config.read_dot_d(self.dir, cache))
+
+        cache.invalidate(path)
+        os.unlink(os.path.join(self.dir, '90-b'))
+        self.assertEquals('a', config.read_dot_d(self.dir, cache))
+        self.assertEquals([path], cache.files.keys())
+
+
+if __name__ == '__main__':
+    unittest.main()
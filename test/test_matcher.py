@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+import random
+import re
+import unittest
+
+import fallfromgrace.matcher as matcher
+import fallfromgrace.program as ffg
+
+
+def make_monitor(name, cmdline, final=False):
+    monitor = ffg.Monitor()
+    monitor.name = name
+    monitor.cmdline = re.compile(cmdline)
+    monitor.final = final
+    return monitor
+
+
+def naive_match(monitors, cmdline):
+    matching = []
+    for monitor in monitors:
+        if monitor.cmdline.search(cmdline):
+            matching.append(monitor)
+            if monitor.final:
+                break
+    return matching
+
+
+class MatcherTest(unittest.TestCase):
+    def test_required_literal(self):
+        self.assertEquals('xulrunner-bin ',
+                          matcher.required_literal(re.compile('xulrunner-bin .*conkeror')))
+        self.assertEquals('firefox', matcher.required_literal(re.compile('firefox$')))
+        self.assertEquals('.py', matcher.required_literal(re.compile(r'\.py')))
+        self.assertEquals('php-fpm: pool ',
+                          matcher.required_literal(re.compile('php-fpm: pool (www|api)')))
+        self.assertEquals(None, matcher.required_literal(re.compile('foo|bar')))
+        self.assertEquals(None, matcher.required_literal(re.compile('(?i)firefox')))
+        self.assertEquals(None, matcher.required_literal(re.compile('.*')))
+
+    def test_aho_corasick(self):
+        automaton = matcher.AhoCorasick([('he', 1), ('she', 2), ('his', 3), ('hers', 4)])
+        self.assertEquals(set([1, 2, 4]), automaton.search('ushers'))
+        self.assertEquals(set([3]), automaton.search('this'))
+        self.assertEquals(set(), automaton.search('xyz'))
+
+    def test_final_and_order(self):
+        monitors = [make_monitor('a', 'fire'),
+                    make_monitor('b', 'fox', final=True),
+                    make_monitor('c', 'firefox'),
+                    make_monitor('d', '(?i)FIRE')]
+        m = matcher.Matcher(monitors)
+
+        self.assertEquals(['a', 'b'], [x.name for x in m.match('firefox')])
+        self.assertEquals(['a', 'd'], [x.name for x in m.match('fire')])
+        self.assertEquals(['d'], [x.name for x in m.match('FIRE')])
+        self.assertEquals([], m.match('chrome'))
+
+    def test_cache(self):
+        m = matcher.Matcher([make_monitor('a', 'fire')], cache_size=2)
+
+        self.assertEquals(['a'], [x.name for x in m.match('firefox')])
+        self.assertEquals(['a'], [x.name for x in m.match('firefox')])
+        self.assertEquals((1, 1), (m.cache.hits, m.cache.misses))
+
+        m.match('chrome')
+        m.match('firefox')
+        m.match('gcc')
+        self.assertEquals(2, len(m.cache))
+        self.assertEquals(None, m.cache.items.get('chrome'))
+
+        m.cache.clear()
+        self.assertEquals((0, 0, 0), (len(m.cache), m.cache.hits, m.cache.misses))
+
+    def test_same_as_naive(self):
+        rng = random.Random(0)
+        words = ['php', 'fpm', 'chrome', 'gcc', 'make', 'python', 'firefox', '-j', ' ']
+        monitors = []
+        for i in xrange(200):
+            pattern = '.*'.join(rng.sample(words, rng.randint(1, 3)))
+            monitors.append(make_monitor(str(i), pattern, final=rng.random() < 0.1))
+        m = matcher.Matcher(monitors)
+
+        for _ in xrange(500):
+            cmdline = ' '.join(rng.choice(words) for _ in xrange(rng.randint(1, 6)))
+            self.assertEquals(naive_match(monitors, cmdline), m.match(cmdline))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+import mock
+import os
+import unittest
+
+import fallfromgrace.metrics as metrics
+import fallfromgrace.process as process
+import fallfromgrace.program as ffg
+
+import fakeproc
+
+
+class EnvironmentTest(unittest.TestCase):
+    @mock.patch('fallfromgrace.process.get_memory_usage')
+    def test_lazy(self, get_memory_usage):
+        get_memory_usage.return_value = {'rmem': 10, 'vmem': 20}
+
+        env = metrics.Environment(1234)
+        self.assertEquals(False, get_memory_usage.called)
+
+        self.assertEquals(True, ffg.Trigger('rmem > 5').evaluate(env))
+        self.assertEquals(True, ffg.Trigger('vmem > 15').evaluate(env))
+        get_memory_usage.assert_called_once_with(1234)
+
+    @mock.patch('fallfromgrace.process.get_memory_usage')
+    def test_error(self, get_memory_usage):
+        get_memory_usage.side_effect = IOError('no such process')
+
+        env = metrics.Environment(1234)
+        self.assertRaises(metrics.MetricError, lambda: env['rmem'])
+        self.assertRaises(metrics.MetricError, lambda: ffg.Trigger('rmem > 5').evaluate(env))
+
+    def test_variables(self):
+        config = ffg.Configuration()
+        config.load("""foo:
+  cmdline: foo
+  actions:
+    rmem > 1g: term
+    vmem > 2g: kill
+""")
+        self.assertEquals(set(['rmem', 'vmem']), config.monitor[0].variables)
+        self.assertEquals(set(['memory']), metrics.sources_for(config.monitor[0].variables))
+
+    def test_aggregate(self):
+        tree = {0: set([1, 10]), 1: set([2, 3]), 2: set([4]), 3: set(), 4: set(), 10: set()}
+        snapshot = process.Snapshot(tree, {})
+
+        def environment(pid):
+            env = metrics.Environment(pid)
+            if pid == 3:
+                env.read['memory'] = metrics.MetricError('gone')
+            else:
+                env.values['rmem'] = pid * 10
+            return env
+
+        totals = metrics.aggregate(snapshot, [1, 2, 10], ['rmem'], environment)
+
+        self.assertEquals({'rmem': 70, 'count': 4}, totals[1].environment('sum'))
+        self.assertEquals({'rmem': 40, 'count': 4}, totals[1].environment('max'))
+        self.assertEquals({'rmem': 60, 'count': 2}, totals[2].environment('sum'))
+        self.assertEquals({'rmem': 100, 'count': 1}, totals[10].environment('sum'))
+
+
+class ProcMetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.proc = fakeproc.FakeProc()
+        self.patcher = mock.patch('fallfromgrace.process._backend',
+                                  process.ProcfsBackend(self.proc.root))
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.proc.cleanup()
+
+    def test_variables(self):
+        ticks = process.CLOCK_TICKS
+        fakeproc.write_process(self.proc.root, 50, 1, 'spinner', start_time=9,
+                               utime=10 * ticks, stime=0, threads=4, fds=7)
+        samples = metrics.Samples()
+
+        env = metrics.Environment(50, 9, samples, now=100.0)
+        self.assertEquals(4, env['threads'])
+        self.assertEquals(7, env['fds'])
+        self.assertEquals(0, env['cpu'])
+        self.assertEquals(0, env['read_bps'])
+        self.assertEquals(process.PAGE_SIZE * 100, env['rmem'])
+
+        # 5 seconds of CPU time and 10 MB read in 10 seconds.
+        fakeproc.write_stat(self.proc.root, 50, 1, 'spinner', 9,
+                            utime=12 * ticks, stime=3 * ticks, threads=4)
+        fakeproc.write_io(self.proc.root, 50, read_bytes=10 * 1024**2)
+        env = metrics.Environment(50, 9, samples, now=110.0)
+        self.assertEquals(50, env['cpu'])
+        self.assertEquals(1024**2, env['read_bps'])
+        self.assertEquals(0, env['write_bps'])
+        self.assertEquals(True, ffg.Trigger('cpu >= 50').evaluate(env))
+        self.assertEquals(True, ffg.Trigger('read_bps > 1023k').evaluate(env))
+
+        # pid reuse starts over.
+        env = metrics.Environment(50, 10, samples, now=120.0)
+        self.assertEquals(0, env['cpu'])
+
+        samples.forget([50])
+        self.assertEquals(0, len(samples))
+
+    def test_smaps(self):
+        fakeproc.write_process(self.proc.root, 60, 1, 'worker', start_time=3)
+        fakeproc.write_smaps(self.proc.root, 60, pss_kb=200, private_kb=100, swap_kb=50)
+        cache = metrics.Cache(30)
+
+        env = metrics.Environment(60, 3, now=100.0, cache=cache)
+        self.assertEquals(200 * 1024, env['pss'])
+        self.assertEquals(100 * 1024, env['uss'])
+        self.assertEquals(50 * 1024, env['swap'])
+
+        # Reused within the interval, for the same process only.
+        fakeproc.write_smaps(self.proc.root, 60, pss_kb=400)
+        self.assertEquals(200 * 1024, metrics.Environment(60, 3, now=129.0, cache=cache)['pss'])
+        self.assertEquals(400 * 1024, metrics.Environment(60, 4, now=129.0, cache=cache)['pss'])
+        self.assertEquals(400 * 1024, metrics.Environment(60, 3, now=130.0, cache=cache)['pss'])
+        cache.forget([60])
+        self.assertEquals(0, len(cache))
+
+        # Kernels without smaps_rollup.
+        os.rename(os.path.join(self.proc.root, '60', 'smaps_rollup'),
+                  os.path.join(self.proc.root, '60', 'smaps'))
+        f = open(os.path.join(self.proc.root, '60', 'smaps'), 'a')
+        f.write('7f0000000000-7f0000001000 rw-p 00000000 00:00 0\n'
+                'Pss:                  4 kB\nPrivate_Dirty:        4 kB\n')
+        f.close()
+        self.assertEquals({'pss': 404 * 1024, 'uss': 104 * 1024, 'swap': 0},
+                          process.get_smaps(60))
+        self.assertRaises(OSError, process.get_smaps, 61)
+
+
+
+class PsutilMetricsTest(unittest.TestCase):
+    @mock.patch('fallfromgrace.process._backend', process.PsutilBackend())
+    def test_variables(self):
+        env = metrics.Environment(os.getpid())
+        self.assertTrue(env['rmem'] > 0)
+        self.assertTrue(env['vmem'] >= env['rmem'])
+        self.assertTrue(env['threads'] >= 1)
+        self.assertTrue(env['fds'] >= 3)
+        self.assertEquals(0, env['cpu'])
+        self.assertRaises(metrics.MetricError, lambda: metrics.Environment(2**22 + 1)['rmem'])
+
+
+if __name__ == '__main__':
+    unittest.main()
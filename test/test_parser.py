@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+import unittest
+
+import fallfromgrace.parser_action as parser_action
+import fallfromgrace.parser_trigger as parser_trigger
+
+
+class TriggerParserTest(unittest.TestCase):
+    def test_parse(self):
+        self.assertEquals(('rmem', '>', 1024**3), parser_trigger.parse('rmem > 1g'))
+        self.assertEquals((100, '<=', 'cpu'), parser_trigger.parse(' 100<=cpu\t'))
+        self.assertEquals(('rate(rmem)', '>', 10 * 1024**2 / 60.0),
+                          parser_trigger.parse('rate( rmem ) > 10m/min'))
+
+    def test_fraction(self):
+        self.assertEquals(('cpu', '>', 90.5), parser_trigger.parse('cpu > 90.5'))
+        self.assertEquals((('rmem', '/', 'vmem'), '>', 0.5),
+                          parser_trigger.parse('rmem / vmem > 0.5'))
+        self.assertEquals(('rmem', '>', 2253), parser_trigger.parse('rmem > 2.2k'))
+
+    def test_units(self):
+        self.assertEquals(('rate(fds)', '>', 0.1), parser_trigger.parse('rate(fds) > 0.1/s'))
+        self.assertEquals((512 * 1024 / 3600.0, '<', 'rate(rmem)'),
+                          parser_trigger.parse('0.5m/h < rate(rmem)'))
+        for s in ('rmem > 10/s', 'rate(rmem) + 1 > 10/s', 'rate(rmem) > 1 and fds > 1/s',
+                  'rate(rmem) > 10/s * 2'):
+            self.assertRaises(Exception, parser_trigger.parse, s)
+
+    def test_boolean(self):
+        self.assertEquals((('rmem', '+', 'swap'), '>', 2 * 1024**3),
+                          parser_trigger.parse('rmem + swap > 2g'))
+        self.assertEquals(((('rmem', '-', ('vmem', '/', 2)), '*', 3), '>=', 1),
+                          parser_trigger.parse('(rmem - vmem / 2) * 3 >= 1'))
+        self.assertEquals(((('cpu', '>', 50), 'and', ('fds', '>', 1)), 'or',
+                           ('not', ('rmem', '<', 1))),
+                          parser_trigger.parse('cpu > 50 and fds > 1 or not rmem < 1'))
+        self.assertEquals((('cpu', '>', 50), 'and', (('fds', '>', 1), 'or', ('rmem', '<', 1))),
+                          parser_trigger.parse('cpu > 50 and (fds > 1 or rmem < 1)'))
+
+    def test_division(self):
+        self.assertEquals(((('rmem', '*', 100), '/', 'swap'), '>', 5),
+                          parser_trigger.parse('rmem * 100/swap > 5'))
+        self.assertEquals(('rate(rmem)', '>', 10.0), parser_trigger.parse('rate(rmem) > 10/s'))
+
+    def test_boolean_errors(self):
+        for s in ('rmem + 1', 'rmem and fds > 1', 'not rmem', 'rmem + (fds > 1) > 1',
+                  'rmem > 1 and', '(rmem > 1', 'rmem > 1 andfds > 1', 'rmem > 1 not fds > 1',
+                  'fds > 1 == 2', 'rmem > 1 > 0', '(rmem > 1) > 0'):
+            self.assertRaises(Exception, parser_trigger.parse, s)
+
+    def test_errors(self):
+        for s in ('', 'rmem', '1g', 'rmem >', '> 1', 'rmemx > 1', 'rate(1) > 1',
+                  'rate rmem > 1', 'rmem > 1.2.3', 'rmem = 1', 'rmem > 1 1'):
+            self.assertRaises(Exception, parser_trigger.parse, s)
+
+
+class ActionParserTest(unittest.TestCase):
+    def test_parse(self):
+        self.assertEquals(['term'], parser_action.parse('term'))
+        self.assertEquals(['kill'], parser_action.parse(' kill \n'))
+        self.assertEquals(['stop', '@', 120], parser_action.parse('stop @ 2m'))
+        self.assertEquals(['exec', '@', 3600, 'notify-send $PID'],
+                          parser_action.parse('exec@1h notify-send $PID'))
+        self.assertEquals(['exec', 'termite -e top'], parser_action.parse('exec termite -e top'))
+
+    def test_errors(self):
+        for s in ('', 'term now', 'stop', 'stop @', 'stop @ x', 'exec', 'exec @ 1h',
+                  'fexec @ 1h prog', 'exec @ 1.2.3 prog'):
+            self.assertRaises(Exception, parser_action.parse, s)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+import unittest
+
+import fallfromgrace.proc_events as proc_events
+
+
+def message(what, *args):
+    body = proc_events.PROC_EVENT.pack(what, 0, 0)
+    body += ''.join(proc_events.PID_TGID.pack(*args[i:i + 2]) for i in xrange(0, len(args), 2))
+    cn_msg = proc_events.CN_MSG.pack(proc_events.CN_IDX_PROC, proc_events.CN_VAL_PROC,
+                                     0, 0, len(body), 0)
+    nlmsghdr = proc_events.NLMSGHDR.pack(proc_events.HEADER_SIZE + len(body),
+                                         proc_events.NLMSG_DONE, 0, 0, 0)
+    return nlmsghdr + cn_msg + body
+
+
+class ProcEventsTest(unittest.TestCase):
+    def test_parse(self):
+        data = ''.join([
+                message(proc_events.FORK, 100, 100, 200, 200),
+                # thread creation, ignored
+                message(proc_events.FORK, 200, 200, 201, 200),
+                message(proc_events.EXEC, 200, 200),
+                message(proc_events.EXIT, 201, 200, 0, 0),
+                message(proc_events.EXIT, 200, 200, 0, 0),
+                ])
+        events = []
+        proc_events.parse_messages(data, events)
+
+        self.assertEquals([(proc_events.FORK, 200, 100),
+                           (proc_events.EXEC, 200, None),
+                           (proc_events.EXIT, 200, None)], events)
+
+
+if __name__ == '__main__':
+    unittest.main()
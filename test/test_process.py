@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+import os
+import shutil
+import threading
+import unittest
+
+import fallfromgrace.collector as collector
+import fallfromgrace.process as process
+
+import fakeproc
+
+
+class ProcfsBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.proc = fakeproc.FakeProc()
+
+    def tearDown(self):
+        self.proc.cleanup()
+
+    def test_parse_stat(self):
+        fields = process.parse_stat('42 (a (weird) name) R 7 42 42 0 -1')
+        self.assertEquals('R', fields[0])
+        self.assertEquals('7', fields[process.STAT_PPID])
+
+    def test_snapshot(self):
+        fakeproc.write_process(self.proc.root, 1, 0, '/sbin/init')
+        fakeproc.write_process(self.proc.root, 100, 1, 'firefox -P default')
+        fakeproc.write_process(self.proc.root, 101, 100, 'plugin container',
+                               comm='(plugin) x')
+        os.mkdir(os.path.join(self.proc.root, 'sys'))
+
+        tree, cmdlines = process.get_snapshot(process.ProcfsBackend(self.proc.root))
+
+        self.assertEquals({0: set([1]), 1: set([100]), 100: set([101]), 101: set()}, tree)
+        self.assertEquals({1: '/sbin/init',
+                           100: 'firefox -P default',
+                           101: 'plugin container'}, cmdlines)
+        self.assertEquals([100, 101], list(process.walk_children(tree, 1)))
+
+    def test_snapshot_vanished_pid(self):
+        fakeproc.write_process(self.proc.root, 1, 0, '/sbin/init')
+        os.mkdir(os.path.join(self.proc.root, '200'))
+
+        tree, cmdlines = process.get_snapshot(process.ProcfsBackend(self.proc.root))
+
+        self.assertEquals({1: '/sbin/init'}, cmdlines)
+
+    def test_descendants(self):
+        tree = {0: set([1]), 1: set([2, 5]), 2: set([3]), 3: set([4]), 4: set(), 5: set()}
+        snap = process.Snapshot(tree, {})
+
+        self.assertEquals([2, 3, 4, 5], sorted(snap.descendants(1)))
+        self.assertEquals([3, 4], snap.descendants(2))
+        self.assertEquals([], snap.descendants(5))
+        self.assertEquals([], snap.descendants(42))
+        self.assertEquals(sorted(process.walk_children(tree, 1)), sorted(snap.descendants(1)))
+
+        # Deep trees do not recurse.
+        deep = dict((pid, set([pid + 1])) for pid in xrange(1, 5000))
+        deep[5000] = set()
+        snap = process.Snapshot(deep, {})
+        self.assertEquals(range(2, 5001), snap.descendants(1))
+        self.assertEquals(range(2, 5001), list(process.walk_children(deep, 1)))
+
+    def test_set_backend(self):
+        self.assertRaises(ValueError, lambda: process.set_backend('nosuchbackend'))
+
+
+class CountingBackend(process.ProcfsBackend):
+    def __init__(self, root):
+        process.ProcfsBackend.__init__(self, root)
+        self.reads = []
+
+    def cmdline(self, pid):
+        self.reads.append(pid)
+        return process.ProcfsBackend.cmdline(self, pid)
+
+
+class ProcessTableTest(unittest.TestCase):
+    def setUp(self):
+        self.proc = fakeproc.FakeProc()
+        self.backend = CountingBackend(self.proc.root)
+        self.table = process.ProcessTable(self.backend)
+
+    def tearDown(self):
+        self.proc.cleanup()
+
+    def respawn(self, pid, ppid, cmdline, **kwargs):
+        shutil.rmtree(os.path.join(self.proc.root, str(pid)))
+        fakeproc.write_process(self.proc.root, pid, ppid, cmdline, **kwargs)
+
+    def test_incremental(self):
+        fakeproc.write_process(self.proc.root, 1, 0, '/sbin/init')
+        fakeproc.write_process(self.proc.root, 10, 1, 'make -j4')
+        fakeproc.write_process(self.proc.root, 11, 10, 'gcc foo.c')
+
+        snap = self.table.update()
+        self.assertEquals(set([1, 10, 11]), snap.spawned)
+        self.assertEquals(set(), snap.exited)
+        self.assertEquals(sorted([1, 10, 11]), sorted(self.backend.reads))
+
+        # Nothing changed: nothing is read.
+        self.backend.reads = []
+        snap = self.table.update()
+        self.assertEquals([], self.backend.reads)
+        self.assertEquals(set(), snap.spawned | snap.exited)
+
+        # 11 exits, 12 is spawned, 10 is reparented to 1.
+        shutil.rmtree(os.path.join(self.proc.root, '11'))
+        fakeproc.write_process(self.proc.root, 12, 10, 'gcc bar.c')
+        self.respawn(10, 0, 'make -j4', start_time=1000)
+        snap = self.table.update()
+        self.assertEquals([12], self.backend.reads)
+        self.assertEquals(set([12]), snap.spawned)
+        self.assertEquals(set([11]), snap.exited)
+        self.assertEquals({0: set([1, 10]), 1: set(), 10: set([12]), 12: set()}, snap.tree)
+        self.assertEquals({1: '/sbin/init', 10: 'make -j4', 12: 'gcc bar.c'}, snap.cmdlines)
+
+    def test_pid_reuse_and_exec(self):
+        fakeproc.write_process(self.proc.root, 1, 0, '/sbin/init')
+        fakeproc.write_process(self.proc.root, 20, 1, 'bash', start_time=5)
+        fakeproc.write_process(self.proc.root, 21, 1, 'bash', start_time=5)
+        self.table.update()
+
+        self.backend.reads = []
+        self.respawn(20, 1, 'firefox', start_time=6)
+        self.respawn(21, 1, 'vim foo', start_time=5)
+        snap = self.table.update()
+        self.assertEquals(sorted([20, 21]), sorted(self.backend.reads))
+        self.assertEquals(set([20]), snap.spawned)
+        self.assertEquals(set([20]), snap.exited)
+        self.assertEquals('firefox', snap.cmdlines[20])
+        self.assertEquals('vim foo', snap.cmdlines[21])
+        self.assertEquals(6, snap.start_times[20])
+        self.assertEquals(set([20, 21]), snap.tree[1])
+
+    def test_reused_unreadable(self):
+        fakeproc.write_process(self.proc.root, 1, 0, '/sbin/init')
+        self.table.update()
+        fakeproc.write_process(self.proc.root, 20, 1, 'bash', start_time=5)
+        self.assertEquals(True, self.table.on_fork(20))
+
+        # Reused before the next snapshot, by a process whose cmdline
+        # cannot be read.
+        self.respawn(20, 1, 'vim', start_time=6)
+        os.unlink(os.path.join(self.proc.root, '20', 'cmdline'))
+        snap = self.table.update()
+        self.assertEquals(set(), snap.spawned)
+        self.assertEquals(set([20]), snap.exited)
+        self.assertEquals({1: '/sbin/init'}, snap.cmdlines)
+
+    def test_exit_reparents(self):
+        fakeproc.write_process(self.proc.root, 1, 0, '/sbin/init')
+        fakeproc.write_process(self.proc.root, 10, 1, 'make')
+        fakeproc.write_process(self.proc.root, 11, 10, 'sh -c gcc')
+        fakeproc.write_process(self.proc.root, 12, 11, 'gcc foo.c')
+        self.table.update()
+
+        self.table.on_exit(11)
+        snap = self.table.snapshot()
+        self.assertEquals([10, 12], sorted(snap.descendants(1)))
+        self.assertEquals([], list(snap.descendants(10)))
+        self.assertEquals(1, self.table.ppids[12])
+
+    def test_exec_same_comm(self):
+        fakeproc.write_process(self.proc.root, 1, 0, '/sbin/init')
+        fakeproc.write_process(self.proc.root, 40, 1, 'python server.py', start_time=5)
+        # Seen between fork and exec, with the cmdline of its parent.
+        fakeproc.write_process(self.proc.root, 41, 40, 'python server.py', start_time=6)
+        self.table.update()
+        self.assertEquals({41: 3}, self.table.unsettled)
+
+        self.respawn(41, 40, 'python worker.py', start_time=6)
+        snap = self.table.update()
+        self.assertEquals('python worker.py', snap.cmdlines[41])
+        self.assertEquals({}, self.table.unsettled)
+
+        # Read again only every CMDLINE_REFRESH scans.
+        self.backend.reads = []
+        for _ in xrange(process.ProcessTable.CMDLINE_REFRESH):
+            self.table.update()
+        self.assertEquals([1, 40, 41], sorted(self.backend.reads))
+
+    def test_setproctitle(self):
+        fakeproc.write_process(self.proc.root, 1, 0, '/sbin/init')
+        fakeproc.write_process(self.proc.root, 50, 1, 'postgres', start_time=5)
+        self.table.update()
+
+        self.respawn(50, 1, 'postgres: checkpointer', comm='postgres', start_time=5)
+        for _ in xrange(process.ProcessTable.CMDLINE_REFRESH):
+            snap = self.table.update()
+        self.assertEquals('postgres: checkpointer', snap.cmdlines[50])
+
+    def test_events(self):
+        fakeproc.write_process(self.proc.root, 1, 0, '/sbin/init')
+        self.table.update()
+
+        fakeproc.write_process(self.proc.root, 30, 1, 'bash', start_time=7)
+        self.assertEquals(True, self.table.on_fork(30))
+        self.assertEquals(False, self.table.on_fork(31))
+        self.assertEquals('bash', self.table.cmdlines[30])
+
+        self.respawn(30, 1, 'make all', start_time=7)
+        self.assertEquals(True, self.table.on_exec(30))
+        self.assertEquals('make all', self.table.cmdlines[30])
+
+        snap = self.table.snapshot()
+        self.assertEquals(set([30]), snap.spawned)
+        self.assertEquals(set([30]), snap.tree[1])
+
+        self.table.on_exit(30)
+        snap = self.table.snapshot()
+        self.assertEquals(set([30]), snap.exited)
+        self.assertEquals(set(), snap.tree[1])
+        self.assertEquals({1: '/sbin/init'}, snap.cmdlines)
+
+
+
+class ParallelProcessTableTest(ProcessTableTest):
+    def setUp(self):
+        ProcessTableTest.setUp(self)
+        self.table.collector = collector.Collector(workers=2, timeout=0.1, shard_size=2)
+
+    def test_slow(self):
+        fakeproc.write_process(self.proc.root, 1, 0, '/sbin/init')
+        fakeproc.write_process(self.proc.root, 40, 1, 'make')
+        self.table.update()
+
+        release = threading.Event()
+        stat = self.backend.stat
+
+        def slow_stat(pid):
+            if pid in (40, 41):
+                release.wait()
+            return stat(pid)
+
+        self.backend.stat = slow_stat
+        fakeproc.write_process(self.proc.root, 41, 1, 'make')
+        try:
+            snap = self.table.update()
+        finally:
+            release.set()
+
+        # Processes that could not be read are kept as they were.
+        self.assertEquals({1: '/sbin/init', 40: 'make'}, snap.cmdlines)
+        self.assertEquals(set(), snap.spawned | snap.exited)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
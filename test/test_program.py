@@ -3,19 +3,33 @@
 # Copyright (c) 2012 Björn Edström <be@bjrn.se>
 # See LICENSE for details.
 
+import json
 import logging
 import mock
+import os
+import pstats
+import shutil
 import signal
+import tempfile
+import threading
+import time
 import unittest
 
+import fallfromgrace.cgroup as cgroup
+import fallfromgrace.collector as collector
+import fallfromgrace.orderedyaml as orderedyaml
+import fallfromgrace.process as process
 import fallfromgrace.program as ffg
+import fallfromgrace.ratelimit as ratelimit
+
+import test_cgroup
 
 log = logging.getLogger('fall-from-grace')
 log.addHandler(logging.StreamHandler())
 
 
 class MockAction(ffg.Action):
-    def _do_exec(self, prog):
+    def _do_exec(self, prog, executor=None):
         self._did = ('exec', prog)
 
     def _do_signal(self, pid, sig):
@@ -84,6 +98,51 @@ conkeror:
     rmem > 1073741824: term
 """))
 
+    def test_config_reload(self):
+        config = ffg.Configuration()
+        conf = """a:
+  cmdline: ^a
+  actions:
+    rmem > 1g: term
+
+b:
+  cmdline: ^b
+  actions:
+    rmem > 1g: term
+"""
+        config.load(conf)
+        a, b = config.monitor
+        matcher = config.matcher
+        matcher.match('abc')
+
+        # Identical config keeps everything, including the match cache.
+        config.load(conf)
+        self.assertTrue(matcher is config.matcher)
+        self.assertEquals(1, len(config.matcher.cache))
+
+        config.load(conf.replace('^b', '^bb') + """
+c:
+  cmdline: ^c
+  actions:
+    rmem > 1g: term
+""")
+        self.assertEquals(['a', 'b', 'c'], [m.name for m in config.monitor])
+        self.assertTrue(config.monitor[0] is a)
+        self.assertFalse(config.monitor[1] is b)
+        self.assertFalse(matcher is config.matcher)
+
+        # A failed reload keeps the old monitors.
+        monitors = config.monitor
+        self.assertRaises(ffg.ConfigException, config.load, conf.replace('term', 'terminate'))
+        self.assertTrue(monitors is config.monitor)
+
+        config.load("""b:
+  cmdline: ^bb
+  actions:
+    rmem > 1g: term
+""")
+        self.assertEquals([monitors[1]], config.monitor)
+
     def test_trigger_success(self):
         self.assertEquals(True,
                           ffg.Trigger('rmem   <123').evaluate({
@@ -129,6 +188,55 @@ conkeror:
                     'rmem': '123b',
                     'vmem': 0}))
 
+    def test_trigger_boolean(self):
+        env = {'rmem': 100, 'swap': 50, 'cpu': 10, 'fds': 0}
+        self.assertEquals(True, ffg.Trigger('rmem + swap > 120').evaluate(env))
+        self.assertEquals(True, ffg.Trigger('rmem / 2 - swap == 0').evaluate(env))
+        self.assertEquals(True, ffg.Trigger('rmem / fds == 0').evaluate(env))
+        self.assertEquals(True, ffg.Trigger('rmem / vmem > 0.5').evaluate({'rmem': 9, 'vmem': 10}))
+        self.assertEquals(False, ffg.Trigger('rmem / vmem > 0.95').evaluate({'rmem': 9, 'vmem': 10}))
+        self.assertEquals(False, ffg.Trigger('rmem > 1 and not cpu < 20').evaluate(env))
+        self.assertEquals(True, ffg.Trigger('rmem > 1000 or (cpu < 20 and fds == 0)').evaluate(env))
+
+    def test_trigger_fraction(self):
+        env = {'psi_memory_some': 1.8, 'psi_memory_full': 0.5, 'cpu': 90.7}
+        self.assertEquals(True, ffg.Trigger('psi_memory_some > 1').evaluate(env))
+        self.assertEquals(True, ffg.Trigger('psi_memory_full > 0.4').evaluate(env))
+        self.assertEquals(False, ffg.Trigger('psi_memory_full > 0.6').evaluate(env))
+        self.assertEquals(True, ffg.Trigger('cpu > 90.5').evaluate(env))
+
+    def test_trigger_order(self):
+        class Env(dict):
+            def __getitem__(self, name):
+                read.append(name)
+                return dict.__getitem__(self, name)
+
+        env = Env(rmem=100, pss=100, fds=10, cpu=0)
+        read = []
+        trigger = ffg.Trigger('pss > 1 and fds > 1 and rmem > 1000')
+        self.assertEquals(False, trigger.evaluate(env))
+        self.assertEquals(['rmem'], read)
+        self.assertEquals(set(['pss', 'fds', 'rmem']), trigger.variables)
+        self.assertEquals(set(['rmem']), trigger.required)
+
+        read = []
+        self.assertEquals(True, ffg.Trigger('pss + fds > 1 or cpu == 0').evaluate(env))
+        self.assertEquals(['cpu'], read)
+
+        read = []
+        trigger = ffg.Trigger('not (pss > 1 or rmem > 1) and fds > 1')
+        self.assertEquals(False, trigger.evaluate(env))
+        self.assertEquals(['fds', 'rmem'], read)
+        self.assertEquals(set(['fds']), trigger.required)
+
+        # Rates are sampled even when they do not decide.
+        env.update({'rate(rmem)': 0.0})
+        read = []
+        trigger = ffg.Trigger('rmem > 1000 and (rate(rmem) > 1 or cpu > 1)')
+        self.assertEquals(False, trigger.evaluate(env))
+        self.assertEquals(['cpu', 'rate(rmem)', 'rmem'], read)
+        self.assertEquals(set(['rmem', 'rate(rmem)', 'cpu']), trigger.required)
+
     def test_integer_parse(self):
 
         self.assertEquals(0, ffg.Trigger('0 < rmem').expr[0])
@@ -166,19 +274,183 @@ conkeror:
         action.action(31337, 'bar')
         self.assertEquals(('exec', 'testprogram bar'), action._did)
 
+        limiter = ratelimit.RateLimiter()
         action = MockAction('exec@2m testprogram $PID')
-        action.action(31337, 'bar')
+        action.action(31337, 'bar', limiter=limiter)
         self.assertEquals(('exec', 'testprogram 31337'), action._did)
         action._did = None
-        action.action(31337, 'bar')
+        action.action(31337, 'bar', limiter=limiter)
         self.assertEquals(None, action._did)
 
         action = MockAction('exec @ 1h testprogram $PID')
-        action.action(31337, 'bar')
+        action.action(31337, 'bar', limiter=limiter)
         self.assertEquals(('exec', 'testprogram 31337'), action._did)
 
         self.assertRaises(Exception, lambda: MockAction('fexec @ 1h testprogram $PID'))
 
+    def test_action_rate_limit_per_process(self):
+        limiter = ratelimit.RateLimiter()
+        action = MockAction('stop @ 10m')
+        action.action(100, 'worker', start_time=5000, limiter=limiter)
+        self.assertEquals(('signal', 100, signal.SIGSTOP), action._did)
+
+        action._did = None
+        action.action(100, 'worker', start_time=5000, limiter=limiter)
+        self.assertEquals(None, action._did)
+
+        # Another worker, and a new process reusing the pid.
+        action.action(101, 'worker', start_time=5000, limiter=limiter)
+        self.assertEquals(('signal', 101, signal.SIGSTOP), action._did)
+        action.action(100, 'worker', start_time=6000, limiter=limiter)
+        self.assertEquals(('signal', 100, signal.SIGSTOP), action._did)
+
+
+class ConfigFilesTestCase(unittest.TestCase):
+    """Base for tests on config files in a temporary directory."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+        class MockedConfiguration(ffg.Configuration):
+            CONF_PATH = os.path.join(self.dir, 'fall-from-grace.conf')
+            DOT_D_PATH = os.path.join(self.dir, 'fall-from-grace.d')
+            CACHE_PATH = os.path.join(self.dir, 'config.cache')
+
+        self.Configuration = MockedConfiguration
+        self.write("""firefox:
+  cmdline: firefox$
+  actions:
+    rate(rmem) > 1m/s: exec @ 1h notify-send $PID
+""")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, conf):
+        f = open(self.Configuration.CONF_PATH, 'w')
+        f.write(conf)
+        f.close()
+
+
+class ConfigCacheTest(ConfigFilesTestCase):
+    def test_cache(self):
+        self.Configuration().load_from_file()
+        self.assertTrue(os.path.exists(self.Configuration.CACHE_PATH))
+
+        config = self.Configuration()
+        with mock.patch('fallfromgrace.orderedyaml.load') as load:
+            config.load_from_file()
+            self.assertFalse(load.called)
+
+        self.assertEquals(['firefox'], [m.name for m in config.monitor])
+        trigger, action = config.monitor[0].actions[0]
+        self.assertEquals(set(['rate(rmem)']), trigger.variables)
+        self.assertEquals(True, trigger.evaluate({'rate(rmem)': 2 * 1024**2}))
+        self.assertEquals(3600, action.interval)
+        self.assertEquals(config.monitor, config.matcher.match('firefox'))
+
+        # Changed config is parsed, and the cache updated.
+        self.write(open(self.Configuration.CONF_PATH).read().replace('firefox$', 'firefox-bin$'))
+        config = self.Configuration()
+        config.load_from_file()
+        self.assertEquals([], config.matcher.match('firefox'))
+        self.assertEquals(config.monitor, config.matcher.match('firefox-bin'))
+        self.assertEquals(config.cache_key, self.Configuration().make_cache_key(config.yaml_str))
+
+    def test_bad_cache(self):
+        f = open(self.Configuration.CACHE_PATH, 'w')
+        f.write('garbage')
+        f.close()
+
+        config = self.Configuration()
+        config.load_from_file()
+        self.assertEquals(['firefox'], [m.name for m in config.monitor])
+
+    def test_malformed_cache(self):
+        self.Configuration().load_from_file()
+        key = json.load(open(self.Configuration.CACHE_PATH))['key']
+        for cached in ([1], {'key': key}, {'key': key, 'conf': 5},
+                       {'key': key, 'conf': [['firefox', {'cmdline': 'firefox$'}]]}):
+            f = open(self.Configuration.CACHE_PATH, 'w')
+            json.dump(cached, f)
+            f.close()
+
+            config = self.Configuration()
+            config.load_from_file()
+            self.assertEquals(['firefox'], [m.name for m in config.monitor])
+            self.assertEquals(1, len(config.monitor[0].actions))
+
+    def test_unsafe_cache(self):
+        self.Configuration().load_from_file()
+        os.chmod(self.Configuration.CACHE_PATH, 0o666)
+
+        with mock.patch('fallfromgrace.orderedyaml.load', wraps=orderedyaml.load) as load:
+            self.Configuration().load_from_file()
+            self.assertTrue(load.called)
+
+
+class ConfigWatchTest(ConfigFilesTestCase):
+    def setUp(self):
+        ConfigFilesTestCase.setUp(self)
+        os.mkdir(self.Configuration.DOT_D_PATH)
+
+        class MockedFFG(ffg.FallFromGrace):
+            RELOAD_DELAY = 0.2
+
+        self.grace = MockedFFG(None, None)
+        self.grace.config = self.Configuration()
+        self.grace._read_conf()
+        self.grace._watch_config()
+
+    def tearDown(self):
+        self.grace.inotify.close()
+        ConfigFilesTestCase.tearDown(self)
+
+    def test_reload_on_change(self):
+        grace = self.grace
+        reload = mock.Mock(wraps=grace.reload)
+        grace.reload = reload
+
+        # A burst of changes results in one reload.
+        for i in range(3):
+            f = open(os.path.join(self.Configuration.DOT_D_PATH, '%02d-chrome' % i), 'w')
+            f.write('chrome%d:\n  cmdline: chrome%d$\n  actions:\n    rmem > 1g: term\n' % (i, i))
+            f.close()
+            grace._wait(0.05)
+        self.assertFalse(reload.called)
+        grace._wait(0.5)
+        self.assertEquals(1, reload.call_count)
+        self.assertEquals(['firefox', 'chrome2', 'chrome1', 'chrome0'],
+                          [m.name for m in grace.config.monitor])
+
+        # Replacing the conf file, as editors do, is noticed.
+        tmp = self.Configuration.CONF_PATH + '.tmp'
+        f = open(tmp, 'w')
+        f.write('opera:\n  cmdline: opera$\n  actions:\n    rmem > 1g: term\n')
+        f.close()
+        os.rename(tmp, self.Configuration.CONF_PATH)
+        grace._wait(0.5)
+        self.assertEquals(2, reload.call_count)
+        self.assertEquals(['opera', 'chrome2', 'chrome1', 'chrome0'],
+                          [m.name for m in grace.config.monitor])
+
+        # Other files are ignored.
+        open(os.path.join(self.dir, 'unrelated'), 'w').close()
+        grace._wait(0.5)
+        self.assertEquals(2, reload.call_count)
+
+    def test_sighup_rereads(self):
+        self.write('opera:\n  cmdline: opera$\n  actions:\n    rmem > 1g: term\n')
+        os.utime(self.Configuration.CONF_PATH, (1000, 1000))
+        self.grace.reload()
+        self.assertEquals(['opera'], [m.name for m in self.grace.config.monitor])
+
+        # Same size and mtime, as with cp -p.
+        self.write('operb:\n  cmdline: operb$\n  actions:\n    rmem > 1g: term\n')
+        os.utime(self.Configuration.CONF_PATH, (1000, 1000))
+        self.grace.reload(signal.SIGHUP, None)
+        self.assertEquals(['operb'], [m.name for m in self.grace.config.monitor])
+
 
 class FallFromGraceProgramTest(unittest.TestCase):
     def setUp(self):
@@ -215,26 +487,28 @@ firefox2:
         self.grace._testing = True
 
     @mock.patch('os.kill')
-    @mock.patch('subprocess.call')
+    @mock.patch('subprocess.Popen')
     @mock.patch('fallfromgrace.process.get_snapshot')
     @mock.patch('fallfromgrace.process.get_memory_usage')
     def test_program(self, get_memory_usage, get_snapshot, call, kill):
         get_memory_usage.return_value = {'rmem': 300*1024*1024,
                                          'vmem': 300*1024*1024}
-        get_snapshot.return_value = {1220: set()}, {1220: 'foo'}
+        get_snapshot.return_value = process.Snapshot({1220: set()}, {1220: 'foo'})
 
         self.grace.run()
 
         self.assertEquals(False, call.called)
         self.assertEquals(False, kill.called)
 
-        get_snapshot.return_value = {1220: set()}, {1220: 'firefox'}
+        get_snapshot.return_value = process.Snapshot({1220: set()}, {1220: 'firefox'})
         get_memory_usage.return_value = {'rmem': 800*1024*1024,
                                          'vmem': 300*1024*1024}
 
         self.grace.run()
+        self.grace.executor.join()
 
-        call.assert_called_with('notify-send "firefox (1220) is using too much ram"', shell=True)
+        self.assertEquals(('notify-send "firefox (1220) is using too much ram"',), call.call_args[0])
+        self.assertEquals(True, call.call_args[1]['shell'])
 
         # new test
         get_memory_usage.return_value = {'rmem': 950*1024*1024,
@@ -245,7 +519,7 @@ firefox2:
         kill.assert_called_with(1220, signal.SIGTERM)
 
         # new test
-        get_snapshot.return_value = {4443: set()}, {4443: 'firefox2'}
+        get_snapshot.return_value = process.Snapshot({4443: set()}, {4443: 'firefox2'})
         get_memory_usage.return_value = {'rmem': 1500*1024*1024,
                                          'vmem': 300*1024*1024}
 
@@ -265,7 +539,8 @@ firefox2:
         # test "final"
         get_memory_usage.return_value = {'rmem': 2400*1024*1024,
                                          'vmem': 300*1024*1024}
-        get_snapshot.return_value = {4443: set()}, {4443: 'xulrunner-bin /usr/share/conkeror'}
+        get_snapshot.return_value = process.Snapshot(
+            {4443: set()}, {4443: 'xulrunner-bin /usr/share/conkeror'})
         kill.called = False
         call.called = False
 
@@ -273,11 +548,89 @@ firefox2:
 
         kill.assert_called_with(4443, signal.SIGTERM)
 
+    @mock.patch('os.kill')
+    @mock.patch('subprocess.Popen')
+    @mock.patch('fallfromgrace.process.get_snapshot')
+    @mock.patch('fallfromgrace.process.get_memory_usage')
+    def test_collector(self, get_memory_usage, get_snapshot, call, kill):
+        release = threading.Event()
+
+        def memory_usage(pid):
+            if pid == 1:
+                release.wait()
+            return {'rmem': 950*1024*1024, 'vmem': 300*1024*1024}
+
+        get_memory_usage.side_effect = memory_usage
+        get_snapshot.return_value = process.Snapshot({1: set(), 2: set()},
+                                                     {1: 'firefox', 2: 'firefox'})
+        self.grace.collector = collector.Collector(workers=2, timeout=0.1)
+        try:
+            self.grace.run()
+        finally:
+            release.set()
+
+        # The stuck process is skipped, the other acted on.
+        self.assertEquals([((2, signal.SIGTERM), {})], kill.call_args_list)
+        self.assertEquals(1, self.grace.collector.timeouts)
+
+    @mock.patch('os.kill')
+    @mock.patch('subprocess.Popen')
+    @mock.patch('fallfromgrace.process.get_snapshot')
+    @mock.patch('fallfromgrace.process.get_memory_usage')
+    def test_stats(self, get_memory_usage, get_snapshot, call, kill):
+        get_memory_usage.return_value = {'rmem': 950*1024*1024,
+                                         'vmem': 300*1024*1024}
+        get_snapshot.return_value = process.Snapshot({1: set([2]), 2: set()},
+                                                     {1: 'init', 2: 'firefox'})
+
+        self.grace.run()
+        self.grace.run()
+        self.grace.executor.join()
+
+        self.assertEquals(2, self.grace.ticks.value)
+        self.assertEquals(4, self.grace.scanned.value)
+        self.assertEquals(2, self.grace.tick_seconds.count)
+        self.assertEquals(2, self.grace.stage_seconds['match'].count)
+        # Both firefox triggers hit, the exec is rate limited the
+        # second time.
+        self.assertEquals(4, self.grace.triggers_evaluated.value)
+        self.assertEquals(4, self.grace.triggers_fired.value)
+        self.assertEquals(3, self.grace.actions_taken.value)
+        self.assertEquals(1, self.grace.executor.run_seconds.count)
+
+        lines = self.grace.stats.render().splitlines()
+        self.assertTrue('fallfromgrace_ticks_total 2' in lines)
+        self.assertTrue('fallfromgrace_processes 2' in lines)
+        self.assertTrue('fallfromgrace_exec_queue_depth 0' in lines)
+        self.assertTrue('fallfromgrace_tick_stage_seconds_count{stage="snapshot"} 2' in lines)
+
+    @mock.patch('fallfromgrace.process.get_snapshot')
+    def test_profile(self, get_snapshot):
+        get_snapshot.return_value = process.Snapshot({1: set()}, {1: 'init'})
+        self.grace.PROFILE_DIR = tempfile.mkdtemp()
+        self.grace.PROFILE_TICKS = 2
+        try:
+            self.grace.profile()
+            self.grace.run()
+            self.assertEquals([], os.listdir(self.grace.PROFILE_DIR))
+            self.grace.run()
+            self.grace.run()
+
+            self.assertEquals(0, self.grace._profile_ticks)
+            self.assertEquals(None, self.grace._profiler)
+            files = os.listdir(self.grace.PROFILE_DIR)
+            self.assertEquals(1, len(files))
+            stats = pstats.Stats(os.path.join(self.grace.PROFILE_DIR, files[0]))
+            self.assertTrue([func for func in stats.stats if func[2] == '_tick'])
+        finally:
+            shutil.rmtree(self.grace.PROFILE_DIR)
+
     # TODO (bjorn): Below test is very hacky
     @mock.patch('os.kill')
     @mock.patch('fallfromgrace.process.get_snapshot')
     def test_children(self, get_snapshot, kill):
-        get_snapshot.return_value = {4443: set([5555]), 5555: set()}, {4443: 'firefox2', 5555: 'subproc'}
+        get_snapshot.return_value = process.Snapshot(
+            {4443: set([5555]), 5555: set()}, {4443: 'firefox2', 5555: 'subproc'})
 
         get_memory_usage_orig = ffg.process.get_memory_usage
 
@@ -297,6 +650,311 @@ firefox2:
         finally:
             ffg.process.get_memory_usage = get_memory_usage_orig
 
+    @mock.patch('fallfromgrace.process.get_snapshot')
+    def test_children_once_per_tick(self, get_snapshot):
+        # make -> sh -> gcc, where both make and sh match
+        get_snapshot.return_value = process.Snapshot(
+            {1: set([2]), 2: set([3]), 3: set()},
+            {1: 'firefox2', 2: 'sh -c firefox2', 3: 'gcc'})
+
+        acted = []
+        self.grace._act = lambda pid, monitor: acted.append((pid, monitor.name))
+        self.grace.run()
+
+        self.assertEquals([(1, 'firefox2'), (2, 'firefox2'), (3, 'firefox2')], sorted(acted))
+
+
+class ShortCircuitTest(unittest.TestCase):
+    def setUp(self):
+        class MockedFFG(ffg.FallFromGrace):
+            def _read_conf(self):
+                self.config.load("""firefox:
+  cmdline: firefox$
+  actions:
+    pss > 1g and rmem > 1g: term
+""")
+
+        self.grace = MockedFFG(None, None)
+        self.grace._testing = True
+        self.grace.collector = collector.Collector(workers=2)
+
+    @mock.patch('os.kill')
+    @mock.patch('fallfromgrace.process.get_smaps')
+    @mock.patch('fallfromgrace.process.get_snapshot')
+    @mock.patch('fallfromgrace.process.get_memory_usage')
+    def test_lazy(self, get_memory_usage, get_snapshot, get_smaps, kill):
+        get_memory_usage.side_effect = lambda pid: {
+            'rmem': pid * 1024**3, 'vmem': 0}
+        get_smaps.return_value = {'pss': 2 * 1024**3, 'uss': 0, 'swap': 0}
+        get_snapshot.return_value = process.Snapshot({1: set(), 2: set()},
+                                                     {1: 'firefox', 2: 'firefox'})
+        self.grace.run()
+
+        # smaps is only read where the cheap rmem does not decide.
+        self.assertEquals([((2,), {})], get_smaps.call_args_list)
+        self.assertEquals([((2, signal.SIGTERM), {})], kill.call_args_list)
+
+
+class AggregateTest(unittest.TestCase):
+    def setUp(self):
+        class MockedFFG(ffg.FallFromGrace):
+            def _read_conf(self):
+                self.config.load("""chrome:
+  cmdline: chrome
+  aggregate: sum
+  target: tree
+  actions:
+    rmem > 1g: term
+    count > 4: exec logger too many chrome processes
+
+chrome-max:
+  cmdline: chrome
+  aggregate: max
+  actions:
+    rmem > 500m: kill
+""")
+
+        self.grace = MockedFFG(None, None)
+        self.grace._testing = True
+
+    def test_config(self):
+        config = ffg.Configuration()
+        self.assertRaises(ffg.ConfigException, lambda: config.load("""foo:
+  cmdline: foo
+  actions:
+    count > 3: term
+"""))
+        self.assertRaises(ffg.ConfigException, lambda: config.load("""foo:
+  cmdline: foo
+  aggregate: avg
+  actions:
+    rmem > 3: term
+"""))
+
+    @mock.patch('os.kill')
+    @mock.patch('subprocess.Popen')
+    @mock.patch('fallfromgrace.process.get_snapshot')
+    @mock.patch('fallfromgrace.process.get_memory_usage')
+    def test_aggregate(self, get_memory_usage, get_snapshot, popen, kill):
+        # chrome (1) -> renderers (2, 3) -> helper (4); sh (5) elsewhere.
+        get_snapshot.return_value = process.Snapshot(
+            {0: set([1, 5]), 1: set([2, 3]), 2: set([4]), 3: set(), 4: set(), 5: set()},
+            {1: 'chrome', 2: 'chrome --type=renderer', 3: 'chrome --type=renderer',
+             4: 'helper', 5: 'sh'})
+        get_memory_usage.return_value = {'rmem': 300*1024*1024, 'vmem': 0}
+
+        self.grace.run()
+        self.grace.executor.join()
+
+        self.assertEquals(False, popen.called)
+        self.assertEquals([1, 2, 3, 4], sorted(args[0][0] for args in kill.call_args_list))
+        for args in kill.call_args_list:
+            self.assertEquals(signal.SIGTERM, args[0][1])
+
+        get_snapshot.return_value.tree[3].add(6)
+        get_snapshot.return_value.tree[6] = set()
+        get_snapshot.return_value.spans = None
+        get_memory_usage.side_effect = lambda pid: {'rmem': (pid == 6 and 600 or 1)*1024*1024,
+                                                    'vmem': 0}
+        kill.reset_mock()
+
+        self.grace.run()
+        self.grace.executor.join()
+
+        self.assertEquals(True, popen.called)
+        kill.assert_called_once_with(1, signal.SIGKILL)
+
+    @mock.patch('os.kill')
+    @mock.patch('fallfromgrace.process.get_smaps')
+    @mock.patch('fallfromgrace.process.get_snapshot')
+    @mock.patch('fallfromgrace.process.get_memory_usage')
+    def test_variables_per_monitor(self, get_memory_usage, get_snapshot, get_smaps, kill):
+        self.grace._read_conf = lambda: self.grace.config.load("""chrome:
+  cmdline: chrome
+  aggregate: sum
+  actions:
+    rmem > 1g: term
+
+postgres:
+  cmdline: postgres
+  aggregate: sum
+  actions:
+    pss > 1g: term
+""")
+        get_snapshot.return_value = process.Snapshot(
+            {0: set([1, 3]), 1: set([2]), 2: set(), 3: set([4]), 4: set()},
+            {1: 'chrome', 2: 'chrome --type=renderer', 3: 'postgres', 4: 'postgres: writer'})
+        get_memory_usage.return_value = {'rmem': 1, 'vmem': 0}
+        get_smaps.return_value = {'pss': 1, 'uss': 1, 'swap': 0}
+
+        self.grace.run()
+
+        self.assertEquals([3, 4], sorted(args[0][0] for args in get_smaps.call_args_list))
+        self.assertEquals(False, kill.called)
+
+
+
+class CgroupTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.old_root = cgroup.CGROUP_ROOT
+        cgroup.CGROUP_ROOT = self.root
+        open(os.path.join(self.root, 'cgroup.controllers'), 'w').close()
+        test_cgroup.write_cgroup(self.root, 'system.slice/nginx.service', memory=3 << 20,
+                                 pids=[10, 11])
+        test_cgroup.write_cgroup(self.root, 'system.slice/nginx.service/worker', pids=[12])
+        test_cgroup.write_cgroup(self.root, 'system.slice/cron.service', memory=1 << 20,
+                                 pids=[20])
+
+        class MockedFFG(ffg.FallFromGrace):
+            def _read_conf(self):
+                self.config.load("""web:
+  cgroup: ^system\\.slice/nginx\\.service$
+  final: true
+  actions:
+    rmem > 2m: term
+services:
+  cgroup: \\.service$
+  actions:
+    pids > 0: exec @ 1h notify-send "$NAME $CGROUP $PID"
+""")
+
+        self.grace = MockedFFG(None, None)
+        self.grace._testing = True
+
+    def tearDown(self):
+        cgroup.CGROUP_ROOT = self.old_root
+        shutil.rmtree(self.root)
+
+    def test_config(self):
+        config = ffg.Configuration()
+        for conf in ["""a:
+  cgroup: foo
+  cmdline: foo
+  actions:
+    rmem > 1g: term
+""", """a:
+  cgroup: foo
+  actions:
+    vmem > 1g: term
+""", """a:
+  cmdline: foo
+  actions:
+    pids > 1: term
+"""]:
+            self.assertRaises(ffg.ConfigException, config.load, conf)
+
+    @mock.patch('os.kill')
+    @mock.patch('subprocess.Popen')
+    @mock.patch('fallfromgrace.process.get_snapshot')
+    def test_cgroup(self, get_snapshot, popen, kill):
+        get_snapshot.return_value = process.Snapshot({}, {})
+        self.grace.run()
+        self.grace.executor.join()
+
+        kill.assert_has_calls([mock.call(pid, signal.SIGTERM) for pid in (10, 11, 12)],
+                              any_order=True)
+        self.assertEquals(3, kill.call_count)
+        self.assertEquals([('notify-send "services system.slice/cron.service 20"',)],
+                          [args for args, kwargs in popen.call_args_list])
+
+        # The exec is rate limited per cgroup.
+        self.grace.run()
+        self.grace.executor.join()
+        self.assertEquals(1, popen.call_count)
+        self.assertEquals(set(['system.slice/nginx.service', 'system.slice/cron.service']),
+                          self.grace._cgroup_paths)
+
+        # Removed cgroups are forgotten.
+        shutil.rmtree(os.path.join(self.root, 'system.slice/cron.service'))
+        self.grace.run()
+        self.assertEquals(set(['system.slice/nginx.service']), self.grace._cgroup_paths)
+        self.assertEquals(0, len(self.grace.limiter))
+
+    @mock.patch('os.kill')
+    @mock.patch('fallfromgrace.process.get_snapshot')
+    def test_pressure(self, get_snapshot, kill):
+        get_snapshot.return_value = process.Snapshot({}, {})
+        for path in ('system.slice/nginx.service', 'system.slice/cron.service'):
+            open(os.path.join(self.root, path, 'memory.pressure'), 'w').close()
+        # Stands in for the system wide trigger.
+        self.grace.psi = mock.Mock()
+
+        self.grace.run()
+        triggers = self.grace._psi_cgroups
+        self.assertEquals(set(['system.slice/nginx.service', 'system.slice/cron.service']),
+                          set(triggers))
+        self.assertEquals('some 200000 2000000\0', open(
+                os.path.join(self.root, 'system.slice/cron.service/memory.pressure')).read())
+        fd = triggers['system.slice/cron.service'].fileno()
+        self.assertTrue(fd in self.grace.handlers)
+
+        shutil.rmtree(os.path.join(self.root, 'system.slice/cron.service'))
+        self.grace.run()
+        self.assertEquals(['system.slice/nginx.service'], list(triggers))
+        self.assertFalse(fd in self.grace.handlers)
+
+
+
+class PressureTest(unittest.TestCase):
+    def setUp(self):
+        class MockedFFG(ffg.FallFromGrace):
+            PSI_MIN_INTERVAL = 0.2
+
+        self.grace = MockedFFG(None, None)
+        self.rfd, self.wfd = os.pipe()
+
+        # A pipe standing in for a PSI trigger.
+        def handle():
+            os.read(self.rfd, 1)
+            self.grace._handle_pressure()
+        self.grace._watch(self.rfd, handle)
+
+    def tearDown(self):
+        os.close(self.rfd)
+        os.close(self.wfd)
+
+    def test_wake(self):
+        grace = self.grace
+        grace.last_tick = time.time() - 10
+        os.write(self.wfd, '.')
+        start = time.time()
+        grace._wait(5)
+        self.assertTrue(time.time() - start < 0.1)
+
+        # Not more often than PSI_MIN_INTERVAL.
+        grace.last_tick = time.time()
+        os.write(self.wfd, '.')
+        start = time.time()
+        grace._wait(5)
+        self.assertTrue(0.15 < time.time() - start < 0.5)
+
+    @mock.patch('fallfromgrace.psi.get_system')
+    def test_sleep_time(self, get_system):
+        grace = self.grace
+        self.assertEquals(grace.SLEEP_TIME, grace._sleep_time())
+
+        grace.psi = mock.Mock()
+        get_system.return_value = {'psi_memory_some': 0.0}
+        self.assertEquals(grace.PSI_SLEEP_TIME, grace._sleep_time())
+        get_system.return_value = {'psi_memory_some': 0.5}
+        self.assertEquals(grace.SLEEP_TIME, grace._sleep_time())
+
+    def test_config(self):
+        config = ffg.Configuration()
+        config.load("""a:
+  cmdline: ^a
+  actions:
+    psi_memory_full > 10: term
+""")
+        self.assertEquals(set(['psi_memory_full']), config.monitor[0].variables)
+        self.assertRaises(ffg.ConfigException, config.load, """b:
+  cmdline: ^b
+  aggregate: sum
+  actions:
+    rate(psi_memory_some) > 1/s: term
+""")
+
 
 if __name__ == '__main__':
     unittest.main()
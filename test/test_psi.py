@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+import os
+import select
+import shutil
+import tempfile
+import unittest
+
+import fallfromgrace.metrics as metrics
+import fallfromgrace.psi as psi
+
+
+class PsiTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.old_root = psi.PRESSURE_ROOT
+        psi.PRESSURE_ROOT = self.root
+        psi._system = (None, None)
+
+    def tearDown(self):
+        psi.PRESSURE_ROOT = self.old_root
+        shutil.rmtree(self.root)
+
+    def write(self, resource, data):
+        f = open(os.path.join(self.root, resource), 'w')
+        f.write(data)
+        f.close()
+
+    def test_parse(self):
+        self.assertEquals({'some': {'avg10': 1.5, 'avg60': 0.25, 'avg300': 0.0, 'total': 1234.0},
+                           'full': {'avg10': 0.0, 'avg60': 0.0, 'avg300': 0.0, 'total': 0.0}},
+                          psi.parse('some avg10=1.50 avg60=0.25 avg300=0.00 total=1234\n'
+                                    'full avg10=0.00 avg60=0.00 avg300=0.00 total=0\n'))
+
+    def test_variables(self):
+        self.write('memory', 'some avg10=12.50 avg60=3.00 avg300=1.00 total=100\n'
+                   'full avg10=2.50 avg60=1.00 avg300=0.00 total=50\n')
+        self.write('cpu', 'some avg10=40.00 avg60=30.00 avg300=20.00 total=1000\n')
+
+        env = metrics.Environment(1, now=1)
+        self.assertEquals(12.5, env['psi_memory_some'])
+        self.assertEquals(2.5, env['psi_memory_full'])
+        self.assertEquals(40.0, env['psi_cpu_some'])
+        self.assertEquals(0.0, env['psi_cpu_full'])
+        self.assertEquals(0.0, env['psi_io_some'])
+
+        # Read once per tick.
+        self.write('memory', 'some avg10=50.00 avg60=3.00 avg300=1.00 total=100\n')
+        self.assertEquals(12.5, metrics.Environment(2, now=1)['psi_memory_some'])
+        self.assertEquals(50.0, metrics.Environment(2, now=2)['psi_memory_some'])
+
+    def test_trigger(self):
+        path = os.path.join(self.old_root, 'memory')
+        if not os.path.exists(path):
+            self.skipTest('no PSI')
+        trigger = psi.Trigger(path, 0.2, 2)
+        self.assertEquals('some 200000 2000000', trigger.spec)
+        try:
+            trigger.open()
+        except OSError, e:
+            self.skipTest('cannot register PSI trigger: %s' % e)
+        try:
+            poller = select.poll()
+            poller.register(trigger.fileno(), select.POLLPRI)
+            self.assertEquals([], poller.poll(0))
+        finally:
+            trigger.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
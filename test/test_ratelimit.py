@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+import unittest
+
+import fallfromgrace.ratelimit as ratelimit
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_allow(self):
+        limiter = ratelimit.RateLimiter()
+        key = ('foo', 'stop @ 10m', 100, 5000)
+
+        self.assertTrue(limiter.allow(key, 0))
+        limiter.record(key, 100, 600, 0)
+        self.assertFalse(limiter.allow(key, 600))
+        self.assertTrue(limiter.allow(key, 601))
+        self.assertTrue(limiter.allow(('foo', 'stop @ 10m', 101, 5000), 1))
+
+    def test_expire(self):
+        limiter = ratelimit.RateLimiter()
+        limiter.record('a', 1, 10, 0)
+        limiter.record('b', 2, 20, 0)
+        # Taken again, so the first expiry of a is stale.
+        limiter.record('a', 1, 10, 15)
+
+        limiter.expire(11)
+        self.assertEquals(2, len(limiter))
+        limiter.expire(21)
+        self.assertEquals(1, len(limiter))
+        self.assertEquals({1: set(['a'])}, limiter.pids)
+        limiter.expire(26)
+        self.assertEquals((0, {}), (len(limiter), limiter.pids))
+
+    def test_forget(self):
+        limiter = ratelimit.RateLimiter()
+        limiter.record('a', 1, 10, 0)
+        limiter.record('b', 1, 10, 0)
+        limiter.record('c', 2, 10, 0)
+
+        limiter.forget([1, 3])
+        self.assertEquals(['c'], limiter.until.keys())
+        self.assertTrue(limiter.allow('a', 1))
+        limiter.expire(11)
+        self.assertEquals(([], {}), (limiter.until.keys(), limiter.pids))
+
+    def test_max_size(self):
+        limiter = ratelimit.RateLimiter(max_size=100)
+        for i in xrange(1000):
+            limiter.record(i, i, 1 + i, 0)
+            self.assertTrue(len(limiter) <= 100)
+            self.assertTrue(len(limiter.heap) <= 200)
+        # The ones expiring first were evicted.
+        self.assertEquals(range(900, 1000), sorted(limiter.until))
+        self.assertEquals(900, limiter.evicted)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012 Björn Edström <be@bjrn.se>
+# See LICENSE for details.
+
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+import fallfromgrace.stats as stats
+
+
+class RegistryTest(unittest.TestCase):
+    def test_render(self):
+        registry = stats.Registry()
+        ticks = registry.counter('ticks_total', 'Ticks.')
+        ticks.inc()
+        ticks.inc(2)
+        registry.register('depth', 'gauge', 'Queue depth.', lambda: 7)
+        seconds = registry.histogram('seconds', 'Time.', {'stage': 'a'}, buckets=(0.1, 1))
+        seconds.observe(0.05)
+        seconds.observe(0.5)
+        seconds.observe(5)
+
+        self.assertEquals("""# HELP ticks_total Ticks.
+# TYPE ticks_total counter
+ticks_total 3
+# HELP depth Queue depth.
+# TYPE depth gauge
+depth 7
+# HELP seconds Time.
+# TYPE seconds histogram
+seconds_bucket{le="0.1",stage="a"} 1
+seconds_bucket{le="1.0",stage="a"} 2
+seconds_bucket{le="+Inf",stage="a"} 3
+seconds_sum{stage="a"} 5.55
+seconds_count{stage="a"} 3
+""", registry.render())
+
+    def test_labels(self):
+        registry = stats.Registry()
+        registry.counter('x', 'X.', {'stage': 'a'}).inc()
+        registry.counter('x', 'X.', {'stage': 'b"c'})
+        self.assertEquals(['# HELP x X.', '# TYPE x counter',
+                           'x{stage="a"} 1', 'x{stage="b\\"c"} 0'],
+                          registry.render().splitlines())
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_unix_socket(self):
+        registry = stats.Registry()
+        registry.counter('ticks_total', 'Ticks.').inc()
+        path = os.path.join(self.dir, 'stats.sock')
+        server = stats.Server(registry, path)
+        server.start()
+        try:
+            sock = socket.socket(socket.AF_UNIX)
+            sock.connect(path)
+            sock.sendall('GET /metrics HTTP/1.0\r\n\r\n')
+            response = ''
+            while True:
+                data = sock.recv(4096)
+                if not data:
+                    break
+                response += data
+            sock.close()
+        finally:
+            server.stop()
+
+        self.assertTrue(response.startswith('HTTP/1.0 200'))
+        self.assertTrue(response.endswith('\r\n\r\n' + registry.render()))
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == '__main__':
+    unittest.main()